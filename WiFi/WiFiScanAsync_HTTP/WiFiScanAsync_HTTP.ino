@@ -21,6 +21,12 @@ const char* INGEST_URL    = "http://3.230.116.138:8000/ingest"; // AWS
 // Must match an assigned_node in the Admin Map Studio — unknown nodes are rejected.
 const char* NODE_TAG      = "ESP32-LAB-01";
 
+// Body encoding for POST /ingest.
+// true  -> MessagePack (application/msgpack): same fields as the JSON, but
+//          binary — noticeably smaller on the air and cheaper for the server to parse.
+// false -> JSON (application/json), for servers without the msgpack package.
+const bool  USE_MSGPACK   = true;
+
 // DHT22 data pin
 const int   DHT_PIN       = 4;   // GPIO 4
 
@@ -39,12 +45,17 @@ const int   MQ135_PIN     = 34;  // GPIO 34
 // ===========================================================
 DHTesp dht;
 
+// batch_id = "<boot id>-<sequence>": unique per payload, and reused when a POST
+// is retried, so the server stores a retried payload only once.
+uint32_t bootId   = 0;
+uint32_t batchSeq = 0;
+
 // FUNCTION DECLARATIONS
 // ===========================================================
 void connectWiFi();
 void startWiFiScan();
 void postScannedNetworks(int16_t networksFound);
-int  httpPostPayload(const String& payload);
+int  httpPostPayload(const uint8_t* body, size_t len, const char* contentType);
 
 // CONNECT TO WIFI 
 // ===========================================================
@@ -86,14 +97,20 @@ void startWiFiScan() {
 }
 
 // ===========================================================
-// HTTP POST HELPER — send JSON payload to FastAPI
+// HTTP POST HELPER — send encoded payload to FastAPI
 // ===========================================================
-int httpPostPayload(const String& payload) {
+int httpPostPayload(const uint8_t* body, size_t len, const char* contentType) {
   HTTPClient http;
   http.begin(INGEST_URL);
-  http.addHeader("Content-Type", "application/json");
-
-  int code = http.POST(payload);
+  http.addHeader("Content-Type", contentType);
+
+  int code = http.POST((uint8_t*)body, len);
+  if (code < 0) {
+    // Timeout or dropped connection — the server may have stored it anyway.
+    // Resend the same bytes; the batch_id lets the server drop the duplicate.
+    delay(500);
+    code = http.POST((uint8_t*)body, len);
+  }
   http.end();
 
   Serial.printf("📡 POST /ingest -> %d\n", code);
@@ -101,11 +118,12 @@ int httpPostPayload(const String& payload) {
 }
 
 // ===========================================================
-// BUILD JSON PAYLOAD FROM SCAN RESULTS + SEND TO SERVER
+// BUILD PAYLOAD FROM SCAN RESULTS + SEND TO SERVER
 //
 // Payload format (matches FastAPI /ingest endpoint):
 // {
 //   "node": "ESP32-LAB-01",
+//   "batch_id": "9f3a21c4-17",
 //   "scans": [
 //     { "ssid": "ATU-WiFi", "bssid": "aa:bb:cc:dd:ee:ff",
 //       "rssi": -65, "channel": 6, "enc": 4 }
@@ -122,7 +140,8 @@ void postScannedNetworks(int16_t networksFound) {
   StaticJsonDocument<4096> doc;
 
   // Top-level fields
-  doc["node"] = NODE_TAG;
+  doc["node"]     = NODE_TAG;
+  doc["batch_id"] = String(bootId, HEX) + "-" + String(++batchSeq);
 
   // Scans array — one object per SSID found
   JsonArray scans = doc.createNestedArray("scans");
@@ -165,9 +184,15 @@ void postScannedNetworks(int16_t networksFound) {
     Serial.println("MQ-135 read zero - omitting air_quality block this cycle");
   }
 
-  String payload;
-  serializeJson(doc, payload);
-  httpPostPayload(payload);
+  if (USE_MSGPACK) {
+    static uint8_t body[4096];
+    size_t len = serializeMsgPack(doc, body, sizeof(body));
+    httpPostPayload(body, len, "application/msgpack");
+  } else {
+    String payload;
+    serializeJson(doc, payload);
+    httpPostPayload((const uint8_t*)payload.c_str(), payload.length(), "application/json");
+  }
 
   WiFi.scanDelete();  // clear results
 }
@@ -179,6 +204,10 @@ void setup() {
   Serial.begin(115200);
   delay(1000);
 
+  // Boot id - a new batch_id prefix after every reboot, so the server's
+  // duplicate check never mistakes a fresh batch for one sent before the reset.
+  bootId = esp_random();
+
   // Initialise DHT22
   dht.setup(DHT_PIN, DHTesp::DHT22);
   Serial.printf("DHT22 on GPIO %d\n", DHT_PIN);
@@ -0,0 +1,180 @@
+# access_points.py
+#
+# The access_point dimension of wifi_scan.
+#
+# A scan row used to repeat the AP's ssid, bssid and enc strings; on a campus
+# that is the same few hundred access points stored millions of times.  Each
+# distinct (bssid, ssid, enc) now has one access_point row (models.py) and
+# wifi_scan stores its integer id.  The BSSID is kept as a 48-bit integer
+# (mac); its text is only stored as well when it is not spelled the canonical
+# way ("AA:BB:CC:DD:EE:FF"), or is not a MAC at all, so it reads back exactly
+# as it was sent.  An AP that changes its SSID or encryption gets a new row —
+# its history is the access_point rows sharing its mac, by first_seen.
+#
+# Ingest resolves keys through an in-memory intern cache (one per process).
+# Keys not in the cache are looked up, and created if new, in one short
+# transaction of their own for the whole batch — so a new AP is committed even
+# if the batch that brought it is rolled back (an unused access_point row is
+# harmless).  Workers creating the same AP are serialised by an advisory lock
+# per BSSID, so it is created once while unrelated APs are created in
+# parallel.  That transaction runs on a small engine of its own
+# (ACCESS_POINT_POOL_SIZE connections): the ingest request already holds a
+# connection from the main pool, and waiting on the same pool for a second one
+# would exhaust it under a burst of new BSSIDs.
+#
+# Row dicts keep their ssid / bssid / enc fields all the way to write_batch()
+# (and the on-disk spool), which swaps them for access_point_id when the
+# rows are inserted.  The wifi_scan_v view (and WifiScanDB's ssid / bssid /
+# enc properties) give the old columns back for reading.
+
+import os
+import re
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import create_engine, insert, or_, select, text
+
+from database import DATABASE_URL, SQL_ECHO, connect_args
+from models import AccessPointDB, format_mac
+
+MAX_ENTRIES   = int(os.getenv("ACCESS_POINT_CACHE_MAX", "100000"))
+POOL_SIZE     = int(os.getenv("ACCESS_POINT_POOL_SIZE", "2"))
+ADVISORY_LOCK = 0x41505430   # "APT0" — the class of the per-BSSID advisory locks
+
+# AP creation only (see module notes); no connection is opened until it is used
+_engine = create_engine(DATABASE_URL, pool_pre_ping=True, echo=SQL_ECHO, connect_args=connect_args,
+                        pool_size=POOL_SIZE, max_overflow=0)
+
+_MAC = re.compile(r"[0-9A-Fa-f]{2}(?:[:-][0-9A-Fa-f]{2}){5}")
+
+# (bssid, ssid, enc) exactly as received
+Key = Tuple[Optional[str], Optional[str], Optional[str]]
+
+
+def parse_mac(bssid: Optional[str]) -> Optional[int]:
+    """48-bit integer of a MAC written as six hex pairs (":" or "-"), else None."""
+    if bssid is None or not _MAC.fullmatch(bssid):
+        return None
+    return int(re.sub("[:-]", "", bssid), 16)
+
+
+def split_bssid(bssid: Optional[str]) -> Tuple[Optional[int], Optional[str]]:
+    """(mac, bssid_text) to store for a bssid — bssid_text only when mac does not spell it exactly."""
+    mac = parse_mac(bssid)
+    if mac is not None and format_mac(mac) == bssid:
+        return mac, None
+    return mac, bssid
+
+
+def _lock_key(bssid: Optional[str]) -> int:
+    """Advisory lock key of a BSSID (a signed 32-bit hash of its text)."""
+    h = zlib.crc32((bssid or "").encode())
+    return h - (1 << 32) if h >= 1 << 31 else h
+
+
+def bssid_of(mac: Optional[int], bssid_text: Optional[str]) -> Optional[str]:
+    """The bssid as it was received, from the stored (mac, bssid_text)."""
+    if bssid_text is not None:
+        return bssid_text
+    return format_mac(mac) if mac is not None else None
+
+
+class AccessPointCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids: Dict[Key, int] = {}
+
+        # metrics
+        self.hits     = 0
+        self.misses   = 0
+        self.created  = 0
+
+    def _lookup(self, db, keys: List[Key]) -> Dict[Key, int]:
+        macs  = [m for m in (split_bssid(k[0])[0] for k in keys) if m is not None]
+        texts = [k[0] for k in keys if k[0] is not None]
+        rows = db.execute(
+            select(AccessPointDB.id, AccessPointDB.mac, AccessPointDB.bssid_text,
+                   AccessPointDB.ssid, AccessPointDB.enc)
+            .where(or_(AccessPointDB.mac.in_(macs),
+                       AccessPointDB.bssid_text.in_(texts),
+                       AccessPointDB.mac.is_(None) & AccessPointDB.bssid_text.is_(None)))
+        ).all()
+        wanted = set(keys)
+        found = {}
+        for ap_id, mac, bssid_text, ssid, enc in rows:
+            key = (bssid_of(mac, bssid_text), ssid, enc)
+            if key in wanted:
+                found[key] = ap_id
+        return found
+
+    def _resolve_missing(self, keys: List[Key]) -> Dict[Key, int]:
+        with _engine.begin() as conn:
+            found = self._lookup(conn, keys)
+            missing = [k for k in keys if k not in found]
+            if missing:
+                # Another worker may be creating the same APs: lock their
+                # BSSIDs (in one order, so two batches cannot deadlock), look
+                # again, then create what is still missing.
+                for key in sorted({_lock_key(k[0]) for k in missing}):
+                    conn.execute(text("SELECT pg_advisory_xact_lock(:c, :k)"), {"c": ADVISORY_LOCK, "k": key})
+                found.update(self._lookup(conn, missing))
+                missing = [k for k in missing if k not in found]
+            if missing:
+                values = []
+                for bssid, ssid, enc in missing:
+                    mac, bssid_text = split_bssid(bssid)
+                    values.append({"mac": mac, "bssid_text": bssid_text, "ssid": ssid, "enc": enc})
+                ids = conn.execute(insert(AccessPointDB).returning(AccessPointDB.id, sort_by_parameter_order=True),
+                                   values).scalars().all()
+                found.update(zip(missing, ids))
+        self.created += len(missing)
+        return found
+
+    def resolve(self, keys: Iterable[Key]) -> Dict[Key, int]:
+        """access_point id of every (bssid, ssid, enc) key, creating the ones never seen."""
+        keys = set(keys)
+        with self._lock:
+            known = {k: self._ids[k] for k in keys if k in self._ids}
+        missing = [k for k in keys if k not in known]
+        self.hits   += len(known)
+        self.misses += len(missing)
+        if missing:
+            found = self._resolve_missing(missing)
+            with self._lock:
+                if len(self._ids) + len(found) > MAX_ENTRIES:
+                    self._ids.clear()
+                self._ids.update(found)
+            known.update(found)
+        return known
+
+    def scan_rows(self, rows: List[dict]) -> List[dict]:
+        """wifi_scan insert parameters for row dicts: ssid / bssid / enc replaced by access_point_id."""
+        ids = self.resolve((r["bssid"], r["ssid"], r["enc"]) for r in rows)
+        return [
+            {
+                "node":            r["node"],
+                "received_at":     r["received_at"],
+                "scan_point_id":   r["scan_point_id"],
+                "device_ts_ms":    r.get("device_ts_ms"),
+                "access_point_id": ids[(r["bssid"], r["ssid"], r["enc"])],
+                "rssi":            r["rssi"],
+                "channel":         r["channel"],
+            }
+            for r in rows
+        ]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._ids.clear()
+
+    def stats(self) -> dict:
+        return {
+            "cached":  len(self._ids),
+            "hits":    self.hits,
+            "misses":  self.misses,
+            "created": self.created,
+        }
+
+
+access_point_cache = AccessPointCache()
@@ -0,0 +1,323 @@
+# archive.py
+#
+# Parquet cold archive of the raw reading tables.
+#
+# Before retention.py drops or deletes raw rows past their tier, archive_range()
+# writes them to Parquet files under ARCHIVE_DIR, hive-partitioned by floor
+# plan and UTC day:
+#
+#   archive/wifi_scan/floorplan_id=1/day=2025-10-01/wifi_scan-<range start>-<written at>-0.parquet
+#   archive/dht22_reading/floorplan_id=__HIVE_DEFAULT_PARTITION__/day=...   (no scan point)
+#
+# wifi_scan is archived as wifi_scan_v reads (ssid / bssid / enc inline), so
+# the files stand on their own.  Rows are sorted by scan point and time and
+# written in row groups of ROW_GROUP_ROWS with min / max statistics, so a
+# reader filtering on scan_point_id and received_at skips whole files (by
+# directory) and row groups (by statistics).
+#
+# A range can be archived more than once — a retention run that failed before
+# (or while) deleting its rows comes back to it — so archive_range() first
+# reads the ids already archived for the range (the id column of its days'
+# files only) and writes just the rows that are not among them: the rows left
+# by an interrupted delete are not written twice, and rows backfilled into an
+# already archived day get a file of their own.
+#
+# read_buckets() is rollups.read_buckets() for the history endpoints, with the
+# part of the window that is older than the scan point's oldest rollup bucket
+# (rollup tiers expired, see retention.py) aggregated from the archive instead
+# — with pyarrow's dataset scanner and group_by, never row by row in Python.
+#
+# The archive needs the optional pyarrow package.  Without it (or with
+# ARCHIVE_DIR set to "") nothing is archived: retention deletes expired rows
+# as before, and history older than the rollups is empty.
+#
+#   python archive.py query wifi_scan --floorplan 1 --since 2025-10-01 --until 2025-10-02
+
+import argparse
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from sqlalchemy import func, select, text
+
+import rollups
+from database import engine
+from models import ScanPointDB
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+except ImportError:   # optional — no archive without it
+    pa = None
+
+ARCHIVE_DIR    = os.getenv("ARCHIVE_DIR", "archive")
+ROW_GROUP_ROWS = int(os.getenv("ARCHIVE_ROW_GROUP_ROWS", "65536"))
+FETCH_ROWS     = int(os.getenv("ARCHIVE_FETCH_ROWS", "50000"))   # rows per server-side cursor fetch
+
+# table → (columns read, SQL source); floorplan_id and day become directories
+_SOURCES = {
+    "wifi_scan": (
+        ("id", "received_at", "node", "device_ts_ms", "scan_point_id", "bssid", "ssid", "enc", "rssi", "channel"),
+        "wifi_scan_v",
+    ),
+    "dht22_reading": (
+        ("id", "received_at", "node", "scan_point_id", "temperature_c", "humidity_pct"),
+        "dht22_reading",
+    ),
+    "mq135_reading": (
+        ("id", "received_at", "node", "scan_point_id", "ppm", "raw_value"),
+        "mq135_reading",
+    ),
+}
+
+# table → (rollup column, archived column, aggregate) for read_buckets()
+_AGGREGATES = {
+    "wifi_scan": (
+        ("wifi_count", "id", "count"), ("rssi_n", "rssi", "count"), ("rssi_sum", "rssi", "sum"),
+        ("rssi_min", "rssi", "min"), ("rssi_max", "rssi", "max"),
+    ),
+    "dht22_reading": (
+        ("dht_count", "id", "count"),
+        ("temp_sum", "temperature_c", "sum"), ("temp_min", "temperature_c", "min"),
+        ("temp_max", "temperature_c", "max"),
+        ("hum_sum", "humidity_pct", "sum"), ("hum_min", "humidity_pct", "min"),
+        ("hum_max", "humidity_pct", "max"),
+    ),
+    "mq135_reading": (
+        ("mq_count", "id", "count"),
+        ("ppm_sum", "ppm", "sum"), ("ppm_min", "ppm", "min"), ("ppm_max", "ppm", "max"),
+        ("raw_n", "raw_value", "count"), ("raw_sum", "raw_value", "sum"),
+    ),
+}
+
+_lock = threading.Lock()
+_stats = {"rows_archived": 0, "files_written": 0, "bucket_reads": 0, "rows_read": 0}
+
+
+def enabled() -> bool:
+    return pa is not None and ARCHIVE_DIR != ""
+
+
+def _schemas():
+    """table → Arrow schema of the archived rows, plus the partitioning."""
+    ts = pa.timestamp("us", tz="UTC")
+    columns = {
+        "id": pa.int64(), "received_at": ts, "node": pa.string(), "device_ts_ms": pa.int64(),
+        "scan_point_id": pa.int32(), "bssid": pa.string(), "ssid": pa.string(), "enc": pa.string(),
+        "rssi": pa.int16(), "channel": pa.int16(),
+        "temperature_c": pa.float64(), "humidity_pct": pa.float64(),
+        "ppm": pa.float64(), "raw_value": pa.int32(),
+    }
+    partitioning = pa.schema([("floorplan_id", pa.int32()), ("day", pa.date32())])
+    schemas = {
+        table: pa.schema([(c, columns[c]) for c in names] + list(zip(partitioning.names, partitioning.types)))
+        for table, (names, _) in _SOURCES.items()
+    }
+    return schemas, partitioning
+
+
+# ── Writing ──────────────────────────────────────────────────────────────────
+
+def _day_filter(lo: datetime, hi: datetime):
+    """Dataset filter for rows in [lo, hi): day directories first, then received_at statistics."""
+    ts = pa.timestamp("us", tz="UTC")
+    return ((ds.field("day") >= pa.scalar(lo.astimezone(timezone.utc).date(), pa.date32()))
+            & (ds.field("day") <= pa.scalar(hi.astimezone(timezone.utc).date(), pa.date32()))
+            & (ds.field("received_at") >= pa.scalar(lo, ts))
+            & (ds.field("received_at") < pa.scalar(hi, ts)))
+
+
+def _archived_ids(table: str, lo: datetime, hi: datetime, partitioning):
+    """Ids of table's rows in [lo, hi) that are already archived, or None if there are none."""
+    path = os.path.join(ARCHIVE_DIR, table)
+    if not os.path.isdir(path):
+        return None
+    dataset = ds.dataset(path, format="parquet", partitioning=ds.partitioning(partitioning, flavor="hive"))
+    ids = dataset.to_table(columns=["id"], filter=_day_filter(lo, hi))["id"].combine_chunks()
+    return ids if len(ids) else None
+
+
+def _batches(conn, table: str, schema, lo: datetime, hi: datetime, skip, written: List[int]) -> Iterator:
+    """Record batches of table's rows in [lo, hi) whose ids are not in skip; counts them into written."""
+    names, source = _SOURCES[table]
+    result = conn.execution_options(stream_results=True, yield_per=FETCH_ROWS).execute(text(
+        f"SELECT {', '.join('r.' + c for c in names)}, sp.floorplan_id, "
+        "       (r.received_at AT TIME ZONE 'UTC')::date AS day "
+        f"FROM {source} r LEFT JOIN scan_point sp ON sp.id = r.scan_point_id "
+        "WHERE r.received_at >= :lo AND r.received_at < :hi "
+        "ORDER BY sp.floorplan_id, day, r.scan_point_id, r.received_at"
+    ), {"lo": lo, "hi": hi})
+    for rows in result.partitions():
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)],
+            schema=schema,
+        )
+        if skip is not None:
+            batch = batch.filter(pc.invert(pc.is_in(batch["id"], value_set=skip)))
+        if batch.num_rows:
+            written[0] += batch.num_rows
+            yield batch
+
+
+def archive_range(table: str, lo: datetime, hi: datetime) -> int:
+    """
+    Write table's rows in [lo, hi) that are not archived yet to the archive;
+    returns the number of rows written.
+    """
+    schemas, partitioning = _schemas()
+    with engine.connect() as conn:
+        n = conn.execute(text(
+            f"SELECT count(*) FROM {table} WHERE received_at >= :lo AND received_at < :hi"
+        ), {"lo": lo, "hi": hi}).scalar()
+        if not n:
+            return 0
+        skip = _archived_ids(table, lo, hi, partitioning)
+        rows: List[int] = [0]
+        files: List[str] = []
+        ds.write_dataset(
+            _batches(conn, table, schemas[table], lo, hi, skip, rows),
+            os.path.join(ARCHIVE_DIR, table),
+            schema=schemas[table],
+            format="parquet",
+            partitioning=ds.partitioning(partitioning, flavor="hive"),
+            # a fresh name per write: earlier writes of the range hold other rows and stay
+            basename_template=f"{table}-{lo:%Y%m%dT%H%M%S}-{time.time_ns()}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            file_options=ds.ParquetFileFormat().make_write_options(compression="zstd", write_statistics=True),
+            min_rows_per_group=min(ROW_GROUP_ROWS, n),
+            max_rows_per_group=ROW_GROUP_ROWS,
+            file_visitor=lambda f: files.append(f.path),
+        )
+    with _lock:
+        _stats["rows_archived"] += rows[0]
+        _stats["files_written"] += len(files)
+    return rows[0]
+
+
+# ── Reading ──────────────────────────────────────────────────────────────────
+
+def _dataset(table: str, floorplan_id: Optional[int]):
+    """The archived files of one table and floor plan, or None if there are none."""
+    path = os.path.join(ARCHIVE_DIR, table,
+                        f"floorplan_id={floorplan_id if floorplan_id is not None else '__HIVE_DEFAULT_PARTITION__'}")
+    if not os.path.isdir(path):
+        return None
+    return ds.dataset(path, format="parquet",
+                      partitioning=ds.partitioning(pa.schema([("day", pa.date32())]), flavor="hive"))
+
+
+def scan(table: str, floorplan_id: Optional[int], lo: datetime, hi: datetime,
+         scan_point_id: Optional[int] = None, columns: Optional[List[str]] = None):
+    """
+    Archived rows of table in [lo, hi) as an Arrow table (None when nothing is
+    archived for the floor plan).  The day and scan point filters are pushed
+    down to directory and row-group pruning.
+    """
+    dataset = _dataset(table, floorplan_id)
+    if dataset is None:
+        return None
+    where = _day_filter(lo, hi)
+    if scan_point_id is not None:
+        where &= ds.field("scan_point_id") == scan_point_id
+    rows = dataset.to_table(columns=columns, filter=where)
+    with _lock:
+        _stats["rows_read"] += rows.num_rows
+    return rows
+
+
+def _empty(aggregates) -> dict:
+    """Rollup columns of a bucket with no rows (sums of float columns are floats, as in the tables)."""
+    floats = ("temperature_c", "humidity_pct", "ppm")
+    return {name: None if agg in ("min", "max") else 0.0 if src in floats and agg == "sum" else 0
+            for name, src, agg in aggregates}
+
+
+def _archive_buckets(table: str, floorplan_id: int, scan_point_id: int, start: datetime,
+                     step: timedelta, hi: datetime, aggregates) -> Dict[int, dict]:
+    """{bucket index: rollup columns} for table's archived rows of one scan point in [start, hi)."""
+    source = sorted({src for _, src, _ in aggregates} | {"received_at"})
+    rows = scan(table, floorplan_id, start, hi, scan_point_id, source)
+    if rows is None or rows.num_rows == 0:
+        return {}
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    us = timedelta(microseconds=1)
+    index = pc.divide(pc.subtract(pc.cast(rows["received_at"], pa.int64()), (start - epoch) // us), step // us)
+    grouped = rows.append_column("bucket", index).group_by("bucket").aggregate(
+        [(src, agg) for _, src, agg in aggregates]
+    )
+    out = {}
+    for row in grouped.to_pylist():
+        cell = _empty(aggregates)
+        for name, src, agg in aggregates:
+            if row[f"{src}_{agg}"] is not None:
+                cell[name] = row[f"{src}_{agg}"]
+        out[row["bucket"]] = cell
+    return out
+
+
+def read_buckets(db, scan_point_id: int, start: datetime, bucket_minutes: int, n_buckets: int,
+                 columns: Iterable[str]) -> Dict[int, dict]:
+    """
+    rollups.read_buckets(), with the buckets older than the scan point's
+    oldest rollup bucket filled in from the archive.
+    """
+    columns = list(columns)
+    buckets = rollups.read_buckets(db, scan_point_id, start, bucket_minutes, n_buckets, columns)
+    if not enabled():
+        return buckets
+    step = timedelta(minutes=bucket_minutes)
+    end = start + n_buckets * step
+    rollup = rollups.table_for(bucket_minutes)
+    oldest = db.execute(
+        select(func.min(rollup.c.bucket_start)).where(rollup.c.scan_point_id == scan_point_id)
+    ).scalar()
+    hi = min(oldest, end) if oldest is not None else end
+    if hi <= start:
+        return buckets
+
+    floorplan_id = db.execute(
+        select(ScanPointDB.floorplan_id).where(ScanPointDB.id == scan_point_id)
+    ).scalar()
+    for table, aggregates in _AGGREGATES.items():
+        aggregates = [a for a in aggregates if a[0] in columns]
+        if not aggregates:
+            continue
+        with _lock:
+            _stats["bucket_reads"] += 1
+        for i, values in _archive_buckets(table, floorplan_id, scan_point_id, start, step, hi, aggregates).items():
+            rollups.merge(buckets, i, values)
+    return buckets
+
+
+def stats() -> dict:
+    with _lock:
+        return {"enabled": enabled(), "dir": ARCHIVE_DIR or None, **_stats}
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Query the Parquet archive of the reading tables")
+    sub = p.add_subparsers(dest="command", required=True)
+    q = sub.add_parser("query", help="print the archived rows of a table in a time range")
+    q.add_argument("table", choices=sorted(_SOURCES))
+    q.add_argument("--floorplan", type=int, help="floor plan id (omit for rows without a scan point)")
+    q.add_argument("--scan-point", type=int)
+    q.add_argument("--since", required=True, help="ISO date or time (UTC)")
+    q.add_argument("--until", required=True, help="ISO date or time (UTC), exclusive")
+    q.add_argument("--limit", type=int, default=20)
+    args = p.parse_args()
+
+    if not enabled():
+        raise SystemExit("the archive needs pyarrow (pip install pyarrow) and a non-empty ARCHIVE_DIR")
+    utc = lambda v: datetime.fromisoformat(v).replace(tzinfo=timezone.utc)
+    rows = scan(args.table, args.floorplan, utc(args.since), utc(args.until), args.scan_point)
+    if rows is None:
+        raise SystemExit(f"nothing archived for {args.table} on floor plan {args.floorplan}")
+    print(f"{rows.num_rows} rows")
+    print(rows.slice(0, args.limit).to_pandas().to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
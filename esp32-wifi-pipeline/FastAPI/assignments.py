@@ -0,0 +1,194 @@
+# assignments.py
+#
+# In-memory node → scan_point map used to authorise POST /ingest.
+#
+# The assignment only changes when an admin assigns/clears a device or deletes
+# a scan point, so every ingest does not need to ask Postgres.  Each process
+# keeps its own copy of the map, tagged with a version stamp read from a small
+# shared file.  The admin endpoints call invalidate(), which bumps the file, and
+# every worker process sees the new stamp on its next lookup and reloads the
+# whole map with one query.  The file is local to the host (the temp directory
+# by default): workers on other hosts only see a change through ASSIGNMENT_MAX_AGE,
+# unless ASSIGNMENT_VERSION_FILE points them all at a shared filesystem.
+#
+# A node not in the map is looked up in the database; one that is not there
+# either is remembered as a miss for a short TTL.  The number of those lookups
+# is capped per second — so bots hammering /ingest with fake node names never
+# reach Postgres in volume.  A node turned away because the cap was reached is
+# not remembered: once the burst is over it is looked up again, so a device
+# assigned in the studio meanwhile is not refused for the whole TTL.  A lookup
+# that fails because the database is unreachable raises (the endpoints answer
+# 503 with Retry-After) rather than calling the node unassigned.
+
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.orm import Session
+
+from models import ScanPointDB
+
+VERSION_FILE       = os.getenv("ASSIGNMENT_VERSION_FILE",
+                               os.path.join(tempfile.gettempdir(), "mssia_assignments.version"))
+MAX_AGE_S          = float(os.getenv("ASSIGNMENT_MAX_AGE", "300"))   # safety net for edits made outside the API (psql, seed scripts)
+MISS_TTL_S         = float(os.getenv("ASSIGNMENT_MISS_TTL", "30"))
+MISS_LOOKUPS_PER_S = int(os.getenv("ASSIGNMENT_MISS_LOOKUPS_PER_S", "20"))
+RELOAD_RETRY_S     = 5.0
+MAX_MISSES         = 10_000
+
+
+def _read_version() -> Tuple[int, int]:
+    try:
+        st = os.stat(VERSION_FILE)
+        return (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return (0, 0)
+
+
+def _bump_version() -> None:
+    # Append one byte and touch: size and mtime both move, so two bumps within
+    # the same clock tick still produce different stamps.
+    with open(VERSION_FILE, "ab") as f:
+        if f.tell() > 4096:
+            f.truncate(0)
+        f.write(b".")
+    os.utime(VERSION_FILE, None)
+
+
+class AssignmentCache:
+    def __init__(self):
+        self._lock      = threading.Lock()
+        self._nodes:  Dict[str, int]   = {}
+        self._misses: Dict[str, float] = {}    # node → monotonic expiry
+        self._version   = None
+        self._loaded_at = 0.0
+        self._miss_window  = 0
+        self._miss_lookups = 0
+
+    # ── Internals ────────────────────────────────────────────────────────────
+
+    def _ensure_fresh(self, db: Session) -> None:
+        version = _read_version()
+        if version == self._version and time.monotonic() - self._loaded_at < MAX_AGE_S:
+            return
+        with self._lock:
+            if version == self._version and time.monotonic() - self._loaded_at < MAX_AGE_S:
+                return
+            try:
+                rows = db.execute(
+                    select(ScanPointDB.assigned_node, ScanPointDB.id)
+                    .where(ScanPointDB.assigned_node.isnot(None))
+                ).all()
+            except (OperationalError, InterfaceError):
+                # Database down: keep authorising against the last map we had
+                # (ingest is being spooled anyway).  No map yet → let it raise.
+                if not self._loaded_at:
+                    raise
+                db.rollback()
+                self._version   = version
+                self._loaded_at = time.monotonic() - MAX_AGE_S + RELOAD_RETRY_S
+                return
+            self._nodes     = {node: sp_id for node, sp_id in rows}
+            self._misses    = {}
+            self._version   = version
+            self._loaded_at = time.monotonic()
+
+    def _miss_budget_left(self) -> bool:
+        window = int(time.monotonic())
+        if window != self._miss_window:
+            self._miss_window, self._miss_lookups = window, 0
+        self._miss_lookups += 1
+        return self._miss_lookups <= MISS_LOOKUPS_PER_S
+
+    def _remember_miss(self, node: str) -> None:
+        if len(self._misses) >= MAX_MISSES:
+            self._misses.clear()
+        self._misses[node] = time.monotonic() + MISS_TTL_S
+
+    # ── Public API ───────────────────────────────────────────────────────────
+
+    def lookup(self, db: Session, node: str) -> Optional[int]:
+        """
+        scan_point_id the node is assigned to, or None if it is unassigned (or
+        unknown and over the miss budget).  Raises OperationalError /
+        InterfaceError if the database is needed and unreachable.
+        """
+        self._ensure_fresh(db)
+        sp_id = self._nodes.get(node)
+        if sp_id is not None:
+            return sp_id
+
+        expiry = self._misses.get(node)
+        if expiry is not None and expiry > time.monotonic():
+            return None
+
+        # Not in the map — double-check the database (catches assignments made
+        # outside the API) unless unknown names are already arriving too fast.
+        with self._lock:
+            if not self._miss_budget_left():
+                return None
+        try:
+            sp_id = db.execute(
+                select(ScanPointDB.id).where(ScanPointDB.assigned_node == node)
+            ).scalar()
+        except (OperationalError, InterfaceError):
+            db.rollback()
+            raise
+        with self._lock:
+            if sp_id is not None:
+                self._nodes[node] = sp_id
+            else:
+                self._remember_miss(node)
+        return sp_id
+
+    def resolve_many(self, db: Session, nodes: Iterable[str]) -> Dict[str, Optional[int]]:
+        """
+        Look up several nodes at once (POST /ingest/batch): one freshness check,
+        and one query for all the nodes not in the map — as far as the miss
+        budget allows; the rest are None this time.  Raises like lookup().
+        """
+        self._ensure_fresh(db)
+        out: Dict[str, Optional[int]] = {}
+        unknown = []
+        now = time.monotonic()
+        for node in set(nodes):
+            sp_id = self._nodes.get(node)
+            if sp_id is None and self._misses.get(node, 0.0) <= now:
+                unknown.append(node)
+            out[node] = sp_id
+        if not unknown:
+            return out
+
+        with self._lock:
+            asked = [node for node in unknown if self._miss_budget_left()]
+        found: Dict[str, int] = {}
+        if asked:
+            try:
+                found = dict(db.execute(
+                    select(ScanPointDB.assigned_node, ScanPointDB.id)
+                    .where(ScanPointDB.assigned_node.in_(asked))
+                ).all())
+            except (OperationalError, InterfaceError):
+                db.rollback()
+                raise
+        with self._lock:
+            self._nodes.update(found)
+            for node in asked:
+                if node in found:
+                    out[node] = found[node]
+                else:
+                    self._remember_miss(node)
+        return out
+
+    def invalidate(self) -> None:
+        """Call after committing any change to scan_point.assigned_node."""
+        _bump_version()
+        with self._lock:
+            self._version = None
+
+
+assignment_cache = AssignmentCache()
@@ -1,4 +1,5 @@
 # database.py
+import logging
 import os
 import time
 from dotenv import load_dotenv
@@ -17,7 +18,8 @@ SQL_ECHO = os.getenv("SQL_ECHO", "false").lower() == "true"
 RETRIES = int(os.getenv("DB_RETRIES", "10"))
 DELAY = float(os.getenv("DB_RETRY_DELAY", "1.5"))
 
-connect_args = {}
+# Fail fast when Postgres is unreachable so /ingest can spool instead of hanging.
+connect_args = {"connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", "5"))}
 
 # Small retry loop (useful if Postgres is still starting)
 engine = None
@@ -34,9 +36,15 @@ for _ in range(RETRIES):
             pass
         break
     except OperationalError:
+        engine = None
         time.sleep(DELAY)
 
 if engine is None:
+    # Postgres never answered — start anyway so /ingest can spool to disk
+    # (ingest_spool.py) and replay once the database is back.
+    logging.getLogger(__name__).warning(
+        "Database not reachable after %d attempts; starting without a connection", RETRIES
+    )
     engine = create_engine(
         DATABASE_URL,
         pool_pre_ping=True,
@@ -0,0 +1,119 @@
+# downsample.py
+#
+# Point-count reduction for the sensor history charts.
+#
+# The history endpoints (main.py) answer with one reading per time bucket.
+# With ?max_points=N they keep the payload to at most N readings in one of two
+# ways:
+#
+#   envelope   wider buckets — the window split into at most N buckets, each
+#              with its average and min / max (the envelope).  Done entirely
+#              in Postgres over the rollup tables (rollups.read_buckets).
+#   lttb       Largest-Triangle-Three-Buckets over the per-minute averages:
+#              N of the minutes themselves, picked so the line keeps its shape
+#              (peaks and dips survive, flat stretches are thinned out).
+#
+# For LTTB the minute series is fetched from rollup_1m as columns — a
+# server-side cursor read in chunks straight into NumPy arrays — and the
+# selection is vectorised per bucket, so a 30-day window (43 200 minutes) is
+# reduced in a few milliseconds.  Minutes with no readings are not part of the
+# series; minutes older than rollup_1m's retention (retention.py) are not
+# available to it.
+
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import Float, text
+
+from models import Rollup1mDB
+
+FETCH_ROWS = 10_000
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Indices of the n_out points of (x, y) that Largest-Triangle-Three-Buckets
+    keeps — always the first and the last, then one per bucket of the points
+    in between, the one making the largest triangle with the previously kept
+    point and the average of the next bucket.  x must be ascending.
+    """
+    n = len(x)
+    if n <= n_out:
+        return np.arange(n)
+    if n_out < 3:
+        return np.array([0, n - 1][:n_out])
+
+    # n_out - 2 buckets over points 1 .. n-2
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    cx = np.concatenate(([0.0], np.cumsum(x)))
+    cy = np.concatenate(([0.0], np.cumsum(y)))
+    widths = np.diff(edges)
+    mean_x = (cx[edges[1:]] - cx[edges[:-1]]) / widths
+    mean_y = (cy[edges[1:]] - cy[edges[:-1]]) / widths
+    # each bucket is weighed against the next one's average (the last against the last point)
+    next_x = np.append(mean_x[1:], x[-1])
+    next_y = np.append(mean_y[1:], y[-1])
+
+    out = np.empty(n_out, dtype=np.int64)
+    out[0], out[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs((x[a] - next_x[i]) * (y[lo:hi] - y[a])
+                      - (x[a] - x[lo:hi]) * (next_y[i] - y[a]))
+        a = lo + int(area.argmax())
+        out[i + 1] = a
+    return out
+
+
+def lttb_union(x: np.ndarray, ys: Sequence[np.ndarray], n_out: int) -> np.ndarray:
+    """LTTB over several series sharing x: n_out split between them, the kept indices merged (at most n_out)."""
+    per_series = max(n_out // len(ys), 1)
+    return np.unique(np.concatenate([lttb(x, y, per_series) for y in ys]))
+
+
+def read_minutes(db, scan_point_id: int, lo: datetime, hi: datetime, count_column: str,
+                 columns: Iterable[str]) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    (epoch seconds, {column: values}) of the rollup_1m minutes of one scan
+    point in [lo, hi) with count_column > 0, oldest first.
+    """
+    columns = list(columns)
+    result = db.execute(
+        text(f"""
+            SELECT extract(epoch FROM bucket_start)::float8, {", ".join(columns)}
+            FROM rollup_1m
+            WHERE scan_point_id = :sp AND bucket_start >= :lo AND bucket_start < :hi
+              AND {count_column} > 0
+            ORDER BY bucket_start
+        """).execution_options(stream_results=True, yield_per=FETCH_ROWS),
+        {"sp": scan_point_id, "lo": lo, "hi": hi},
+    )
+    chunks: List[np.ndarray] = [np.array(rows, dtype=np.float64).reshape(-1, len(columns) + 1)
+                                for rows in result.partitions()]
+    block = np.concatenate(chunks) if chunks else np.empty((0, len(columns) + 1))
+    return block[:, 0], {c: block[:, j + 1] for j, c in enumerate(columns)}
+
+
+def lttb_minutes(db, scan_point_id: int, lo: datetime, hi: datetime,
+                 series: Sequence[Tuple[str, str]], columns: Iterable[str],
+                 n_out: int) -> List[Tuple[datetime, dict]]:
+    """
+    [(minute start, {column: value})] of at most n_out rollup_1m minutes of
+    one scan point in [lo, hi), chosen by LTTB on the averages given as
+    (sum column, count column) pairs in series.
+    """
+    columns = list(columns)
+    count_column = series[0][1]
+    t, values = read_minutes(db, scan_point_id, lo, hi, count_column, columns)
+    if not len(t):
+        return []
+    keep = lttb_union(t, [values[s] / values[n] for s, n in series], n_out)
+    # back to Python values: integers for the integer columns, NULL for NaN
+    kinds = {c: float if isinstance(Rollup1mDB.__table__.c[c].type, Float) else int for c in columns}
+    return [
+        (datetime.fromtimestamp(t[i], timezone.utc),
+         {c: None if np.isnan(values[c][i]) else kinds[c](values[c][i]) for c in columns})
+        for i in keep
+    ]
@@ -0,0 +1,570 @@
+# import_history.py
+#
+# Bulk import of historical readings into the Postgres store.
+#
+#   SQLite captures   dbs/wifi_scans.db, dbs/wifi_scans2.db, edge logger files —
+#                     any of the tables wifi_scan / dht22_reading / mq135_reading
+#   JSONL logs        one /ingest payload per line, stamped with "received_at"
+#                     (or "ts"), or {"received_at": ..., "payload": {...}}
+#
+#   python import_history.py ../../dbs/wifi_scans2.db
+#   python import_history.py --map ESP32-LAB-01=3 --workers 4 ../../dbs payloads.jsonl
+#
+# Pipeline:
+#
+#   parser threads   stream each source (SQLite cursor / file lines), validate
+#                    rows with ingest.py's row builders, map node → scan point,
+#                    and encode chunks of --chunk-rows rows in COPY text format
+#                    → bounded queue.  The access_point ids of a chunk's WiFi
+#                    rows are resolved together, just before it is encoded
+#                    (access_points.py)
+#   loader threads   one connection each: COPY every table of a chunk, add its
+#                    rows to the rollup tables (rollups.py) and scan_point_state
+#                    (scan_point_state.py) and record the chunk in import_chunk,
+#                    in one transaction
+#
+# Parsing and loading overlap — the parsers build the next chunks while the
+# loaders wait on Postgres.  Loader sessions run with synchronous_commit=off:
+# a crash can only lose the last few chunks, and those are not checkpointed
+# either, so they are loaded again on the next run.
+#
+# Resuming: a chunk covers a range of source positions (SQLite row ids, byte
+# offsets in a JSONL file).  A re-run reads from the end of the finished
+# ranges and skips any later range that was loaded out of order, so an
+# interrupted import is just run again and nothing is stored twice.
+#
+# Node → scan point: --map NODE=ID first, otherwise the node's current
+# assignment (scan_point.assigned_node).  Readings of unassigned nodes are
+# imported with scan_point_id NULL, or left out with --skip-unassigned.
+#
+# Overlapping sources are not deduplicated (wifi_scans2.db repeats most of
+# wifi_scans.db) — pick the ones to import.
+
+import argparse
+import glob
+import io
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, tzinfo
+from typing import Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+import psycopg2
+from sqlalchemy import func, insert, select, text
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+from access_points import access_point_cache
+from database import engine, SessionLocal
+from ingest import dht22_row, mq135_row, parse_time, wifi_row
+from models import ImportChunkDB, ScanPointDB
+from rollups import RollupBatch
+from scan_point_state import StateBatch
+
+# Postgres table → COPY column order
+COPY_COLUMNS = {
+    "wifi_scan":     ("received_at", "node", "scan_point_id", "device_ts_ms",
+                      "access_point_id", "rssi", "channel"),
+    "dht22_reading": ("received_at", "node", "scan_point_id", "temperature_c", "humidity_pct"),
+    "mq135_reading": ("received_at", "node", "scan_point_id", "ppm", "raw_value"),
+}
+
+# SQLite table → columns read from it (missing ones are read as NULL)
+SQLITE_COLUMNS = {
+    "wifi_scan":     ("received_at", "node", "device_ts_ms", "ssid", "bssid", "rssi", "channel", "enc"),
+    "dht22_reading": ("received_at", "node", "temperature_c", "humidity_pct"),
+    "mq135_reading": ("received_at", "node", "ppm", "raw_value"),
+}
+
+JSONL_SUFFIXES = (".jsonl", ".ndjson")
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+LOAD_RETRIES    = 3
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+class Stopped(Exception):
+    pass
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Import old SQLite captures and JSONL payload logs into Postgres")
+    p.add_argument("sources", nargs="+", help=".db / .jsonl files, or directories containing them")
+    p.add_argument("--chunk-rows", type=int, default=50_000, help="rows per COPY transaction")
+    p.add_argument("--workers", type=int, default=2, help="loader connections")
+    p.add_argument("--parsers", type=int, default=2, help="sources parsed at the same time")
+    p.add_argument("--map", action="append", default=[], metavar="NODE=SCAN_POINT_ID",
+                   help="scan point for a node's readings (repeatable); overrides the current assignment")
+    p.add_argument("--skip-unassigned", action="store_true",
+                   help="leave out readings of nodes with no scan point instead of storing them with NULL")
+    p.add_argument("--tz", default="UTC", help="time zone of timestamps stored without an offset")
+    p.add_argument("--status-every", type=float, default=5.0, help="seconds between progress lines")
+    return p.parse_args()
+
+
+def find_sources(paths: List[str]) -> List[str]:
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for suffix in SQLITE_SUFFIXES + JSONL_SUFFIXES:
+                found.extend(sorted(glob.glob(os.path.join(path, f"*{suffix}"))))
+        else:
+            found.append(path)
+    return list(dict.fromkeys(os.path.abspath(p) for p in found))
+
+
+def load_node_map(overrides: List[str]) -> Dict[str, int]:
+    """node → scan_point_id from the current assignments, with --map entries on top."""
+    db = SessionLocal()
+    try:
+        nodes = dict(db.execute(
+            select(ScanPointDB.assigned_node, ScanPointDB.id).where(ScanPointDB.assigned_node.isnot(None))
+        ).all())
+        known = set(db.execute(select(ScanPointDB.id)).scalars())
+    finally:
+        db.close()
+    for entry in overrides:
+        node, _, sp_id = entry.partition("=")
+        if not node or not sp_id.isdigit():
+            sys.exit(f"--map expects NODE=SCAN_POINT_ID, got '{entry}'")
+        if int(sp_id) not in known:
+            sys.exit(f"--map {entry}: scan point {sp_id} does not exist")
+        nodes[node] = int(sp_id)
+    return nodes
+
+
+def finished_ranges(source: str) -> Dict[str, List[Tuple[int, int]]]:
+    """part → sorted, merged [start, end) ranges already imported from this source."""
+    db = SessionLocal()
+    try:
+        rows = db.execute(
+            select(ImportChunkDB.part, ImportChunkDB.start_pos, ImportChunkDB.end_pos)
+            .where(ImportChunkDB.source == source)
+            .order_by(ImportChunkDB.part, ImportChunkDB.start_pos)
+        ).all()
+    finally:
+        db.close()
+    ranges: Dict[str, List[Tuple[int, int]]] = {}
+    for part, start, end in rows:
+        merged = ranges.setdefault(part, [])
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return ranges
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, str):
+        return value.translate(_COPY_ESCAPES)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+class Stats:
+    def __init__(self):
+        self.lock        = threading.Lock()
+        self.read        = 0   # source rows parsed
+        self.rejected    = 0   # rows that failed validation
+        self.unassigned  = 0   # rows left out by --skip-unassigned
+        self.skipped     = 0   # rows of these sources imported by earlier runs
+        self.loaded      = 0   # rows committed to Postgres
+        self.chunks      = 0
+        self.error: Optional[str] = None
+
+    def add(self, **counts) -> None:
+        with self.lock:
+            for name, n in counts.items():
+                setattr(self, name, getattr(self, name) + n)
+
+
+class Chunker:
+    """
+    Groups one source part's rows into chunks of contiguous source positions,
+    encodes them for COPY and queues them.  Positions inside a range that is
+    already imported are skipped, and a chunk never spans one.
+    WiFi rows carry their (bssid, ssid, enc) key in place of access_point_id
+    until the chunk is flushed.
+    """
+
+    def __init__(self, source: str, part: str, done: List[Tuple[int, int]], ctx: "Importer"):
+        self.source, self.part, self.ctx = source, part, ctx
+        self.done  = done
+        self._next = 0           # index of the first finished range not yet passed
+        self.start: Optional[int] = None
+        self.end   = 0
+        self.lines: Dict[str, List[str]] = {table: [] for table in COPY_COLUMNS}
+        self.wifi: List[Tuple] = []
+        self.rows  = 0
+        self.derived = (RollupBatch(), StateBatch())
+
+    def resume_from(self, first_pos: int) -> int:
+        """Where to start reading: after the finished range that covers the start of the source."""
+        if self.done and self.done[0][0] <= first_pos:
+            return self.done[0][1]
+        return first_pos
+
+    def add(self, pos: int, end: int, rows: List[Tuple[str, Tuple]]) -> None:
+        while self._next < len(self.done) and self.done[self._next][1] <= pos:
+            self._next += 1
+        if self._next < len(self.done) and self.done[self._next][0] <= pos:
+            self.flush()
+            return
+        if self.start is None:
+            self.start = pos
+        self.end = end
+        for table, values in rows:
+            if table == "wifi_scan":
+                self.wifi.append(values)
+            else:
+                self.lines[table].append("\t".join(map(_copy_value, values)) + "\n")
+            for derived in self.derived:
+                if table == "wifi_scan":
+                    derived.add_wifi(values[2], values[0], values[5])
+                elif table == "dht22_reading":
+                    derived.add_dht22(values[2], values[0], values[3], values[4])
+                else:
+                    derived.add_mq135(values[2], values[0], values[3], values[4])
+        self.rows += len(rows)
+        if self.rows >= self.ctx.args.chunk_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.start is None:
+            return
+        ids = access_point_cache.resolve({values[4] for values in self.wifi})
+        self.lines["wifi_scan"].extend(
+            "\t".join(map(_copy_value, (*values[:4], ids[values[4]], *values[5:]))) + "\n"
+            for values in self.wifi
+        )
+        self.wifi = []
+        copies = {table: "".join(lines) for table, lines in self.lines.items() if lines}
+        chunk  = (self.source, self.part, self.start, self.end, self.rows, copies, self.derived)
+        self.start, self.rows = None, 0
+        self.lines = {table: [] for table in COPY_COLUMNS}
+        self.derived = (RollupBatch(), StateBatch())
+        self.ctx.put(chunk)
+
+
+class Importer:
+    def __init__(self, args, nodes: Dict[str, int]):
+        self.args   = args
+        self.nodes  = nodes
+        self.tz: tzinfo = ZoneInfo(args.tz)
+        self.stats  = Stats()
+        self.chunks: "queue.Queue" = queue.Queue(maxsize=max(2, args.workers * 2))
+        self.stopping = threading.Event()
+
+    def put(self, chunk) -> None:
+        while True:
+            try:
+                self.chunks.put(chunk, timeout=0.5)
+                return
+            except queue.Full:
+                if self.stopping.is_set():
+                    raise Stopped()
+
+    def fail(self, message: str) -> None:
+        with self.stats.lock:
+            self.stats.error = self.stats.error or message
+        self.stopping.set()
+
+    # ── Row building ─────────────────────────────────────────────────────────
+
+    def _time(self, value, cache: Dict) -> datetime:
+        ts = cache.get(value)
+        if ts is None:
+            if isinstance(value, str):
+                ts = datetime.fromisoformat(value.replace("Z", "+00:00"))
+                ts = ts if ts.tzinfo else ts.replace(tzinfo=self.tz)
+            else:
+                ts = parse_time(value)
+            if len(cache) > 10_000:
+                cache.clear()
+            cache[value] = ts   # scans of one capture share a timestamp
+        return ts
+
+    def _scan_point(self, node) -> Tuple[bool, Optional[int]]:
+        sp_id = self.nodes.get(node)
+        return (sp_id is not None or not self.args.skip_unassigned), sp_id
+
+    def payload_rows(self, node, when, payload: dict, cache: Dict) -> Tuple[List[Tuple[str, Tuple]], int, int]:
+        """(rows, rejected, unassigned) for one /ingest-shaped payload."""
+        scans = payload.get("scans") if "scans" in payload else ([payload] if "bssid" in payload else [])
+        scans = scans if isinstance(scans, list) else []
+        try:
+            if not isinstance(node, str) or when is None:
+                raise ValueError("no node or timestamp")
+            received_at = self._time(when, cache)
+        except (TypeError, ValueError, OverflowError):
+            n = len(scans) + ("temperature" in payload) + ("air_quality" in payload)
+            return [], max(n, 1), 0
+        keep, sp_id = self._scan_point(node)
+
+        rows, rejected = [], 0
+        for s in scans:
+            row = wifi_row(node, sp_id, received_at, s)
+            if row is None:
+                rejected += 1
+                continue
+            ts_ms = s.get("device_ts_ms")
+            rows.append(("wifi_scan", (received_at, node, sp_id,
+                                       ts_ms if type(ts_ms) is int else None,
+                                       (row["bssid"], row["ssid"], row["enc"]), row["rssi"], row["channel"])))
+        if payload.get("temperature") is not None:
+            row = dht22_row(node, sp_id, received_at, payload["temperature"])
+            if row is None:
+                rejected += 1
+            else:
+                rows.append(("dht22_reading", (received_at, node, sp_id, row["temperature_c"], row["humidity_pct"])))
+        if payload.get("air_quality") is not None:
+            row = mq135_row(node, sp_id, received_at, payload["air_quality"])
+            if row is None:
+                rejected += 1
+            else:
+                rows.append(("mq135_reading", (received_at, node, sp_id, row["ppm"], row["raw_value"])))
+        if not keep:
+            return [], rejected, len(rows)
+        return rows, rejected, 0
+
+    # ── Sources ──────────────────────────────────────────────────────────────
+
+    def parse_source(self, source: str) -> None:
+        try:
+            if self.stopping.is_set():
+                return
+            if source.endswith(JSONL_SUFFIXES):
+                self._parse_jsonl(source)
+            else:
+                self._parse_sqlite(source)
+        except Stopped:
+            pass
+        except Exception as exc:
+            self.fail(f"{source}: {exc}")
+
+    def _finish(self, chunker: Chunker, read: int, rejected: int, unassigned: int) -> None:
+        chunker.flush()
+        self.stats.add(read=read, rejected=rejected, unassigned=unassigned)
+
+    def _parse_sqlite(self, source: str) -> None:
+        if os.path.getsize(source) == 0:
+            print(f"{source}: empty file, nothing to import")
+            return
+        conn = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+        try:
+            tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            done   = finished_ranges(source)
+            if not tables & SQLITE_COLUMNS.keys():
+                print(f"{source}: no wifi_scan / dht22_reading / mq135_reading table, skipped")
+            for table in SQLITE_COLUMNS:
+                if table not in tables:
+                    continue
+                present = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                columns = ", ".join(c if c in present else "NULL" for c in SQLITE_COLUMNS[table])
+                chunker = Chunker(source, table, done.get(table, []), self)
+                first   = conn.execute(f"SELECT MIN(id) FROM {table}").fetchone()[0]
+                if first is None:
+                    continue
+                # sqlite3 cursors step through the result as it is fetched — the
+                # table is never materialised in memory.
+                cur = conn.execute(
+                    f"SELECT id, {columns} FROM {table} WHERE id >= ? ORDER BY id",
+                    (chunker.resume_from(first),),
+                )
+                cache: Dict = {}
+                read = rejected = unassigned = 0
+                while not self.stopping.is_set():
+                    batch = cur.fetchmany(5000)
+                    if not batch:
+                        break
+                    for row_id, *values in batch:
+                        record = dict(zip(SQLITE_COLUMNS[table], values))
+                        if table == "wifi_scan":
+                            payload = {"scans": [record]}
+                        elif table == "dht22_reading":
+                            payload = {"temperature": record}
+                        else:
+                            payload = {"air_quality": record}
+                        rows, bad, dropped = self.payload_rows(record["node"], record["received_at"], payload, cache)
+                        chunker.add(row_id, row_id + 1, rows)
+                        read += 1
+                        rejected += bad
+                        unassigned += dropped
+                self._finish(chunker, read, rejected, unassigned)
+        finally:
+            conn.close()
+
+    def _parse_jsonl(self, source: str) -> None:
+        chunker = Chunker(source, "jsonl", finished_ranges(source).get("jsonl", []), self)
+        cache: Dict = {}
+        read = rejected = unassigned = 0
+        with open(source, "rb") as f:
+            pos = chunker.resume_from(0)
+            f.seek(pos)
+            for line in f:
+                if self.stopping.is_set():
+                    break
+                end, start = pos + len(line), pos
+                pos = end
+                if not line.strip():
+                    continue
+                read += 1
+                try:
+                    obj = json.loads(line)
+                except ValueError:
+                    rejected += 1
+                    continue
+                if not isinstance(obj, dict):
+                    rejected += 1
+                    continue
+                inner   = obj.get("payload", obj.get("body"))
+                payload = inner if isinstance(inner, dict) else obj
+                node    = payload.get("node", obj.get("node"))
+                when    = next((v for v in (obj.get("received_at"), obj.get("ts"),
+                                            payload.get("received_at"), payload.get("ts")) if v is not None), None)
+                rows, bad, dropped = self.payload_rows(node, when, payload, cache)
+                chunker.add(start, end, rows)
+                rejected += bad
+                unassigned += dropped
+        self._finish(chunker, read, rejected, unassigned)
+
+    # ── Loading ──────────────────────────────────────────────────────────────
+
+    def _copy(self, conn, chunk) -> None:
+        source, part, start, end, rows, copies, derived = chunk
+        conn.execute(insert(ImportChunkDB.__table__).values(
+            source=source, part=part, start_pos=start, end_pos=end, rows=rows,
+        ))
+        with conn.connection.cursor() as cur:   # COPY needs the psycopg2 cursor
+            for table, data in copies.items():
+                cur.copy_expert(f"COPY {table} ({', '.join(COPY_COLUMNS[table])}) FROM STDIN",
+                                io.StringIO(data))
+        for batch in derived:
+            batch.upsert(conn)
+        conn.commit()
+
+    def _connect(self):
+        conn = engine.connect()
+        conn.execute(text("SET synchronous_commit = off"))
+        conn.commit()
+        return conn
+
+    def load(self) -> None:
+        conn = chunk = None
+        try:
+            while True:
+                try:
+                    chunk = self.chunks.get(timeout=0.5)
+                except queue.Empty:
+                    if self.stopping.is_set():
+                        return
+                    continue
+                if chunk is None or self.stopping.is_set():
+                    return
+                for attempt in range(1, LOAD_RETRIES + 1):
+                    try:
+                        conn = conn or self._connect()
+                        self._copy(conn, chunk)
+                        break
+                    except (psycopg2.OperationalError, psycopg2.InterfaceError,
+                            OperationalError, InterfaceError) as exc:
+                        # Connection lost — reconnect and send the chunk again
+                        # (it was not committed, so it is not checkpointed either).
+                        try:
+                            conn.invalidate()
+                        except Exception:
+                            pass
+                        conn = None
+                        if attempt == LOAD_RETRIES:
+                            raise
+                        print(f"connection lost ({str(exc).strip()}); retrying chunk")
+                        time.sleep(attempt)
+                self.stats.add(loaded=chunk[4], chunks=1)
+        except Exception as exc:
+            where = f"{chunk[0]} [{chunk[1]} {chunk[2]}–{chunk[3]}]: " if chunk else ""
+            self.fail(f"{where}{str(exc).strip()}")
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+    # ── Driver ───────────────────────────────────────────────────────────────
+
+    def status(self, started: float, last: Tuple[float, int]) -> Tuple[float, int]:
+        now, s = time.monotonic(), self.stats
+        print(f"loaded={s.loaded} rows/s={(s.loaded - last[1]) / max(now - last[0], 1e-9):.0f} "
+              f"avg={s.loaded / max(now - started, 1e-9):.0f} chunks={s.chunks} queued={self.chunks.qsize()} "
+              f"read={s.read} rejected={s.rejected} unassigned={s.unassigned} already_imported={s.skipped}")
+        return now, s.loaded
+
+    def run(self, sources: List[str]) -> int:
+        started = time.monotonic()
+        loaders = [threading.Thread(target=self.load, name=f"loader-{i}", daemon=True)
+                   for i in range(self.args.workers)]
+        for t in loaders:
+            t.start()
+
+        parsers = ThreadPoolExecutor(max_workers=self.args.parsers, thread_name_prefix="parser")
+        futures = [parsers.submit(self.parse_source, source) for source in sources]
+        last = (started, 0)
+        try:
+            while not all(f.done() for f in futures):
+                time.sleep(0.2)
+                if time.monotonic() - last[0] >= self.args.status_every:
+                    last = self.status(started, last)
+            for _ in loaders:
+                self.put(None)
+            while any(t.is_alive() for t in loaders):
+                time.sleep(0.2)
+                if time.monotonic() - last[0] >= self.args.status_every:
+                    last = self.status(started, last)
+        except (KeyboardInterrupt, Stopped):
+            self.stopping.set()
+            print("\nStopping — run the same command again to resume.")
+        finally:
+            parsers.shutdown(wait=True)
+            for t in loaders:
+                t.join(30)
+
+        elapsed, s = time.monotonic() - started, self.stats
+        print(f"Imported {s.loaded} rows in {s.chunks} chunks in {elapsed:.1f}s "
+              f"({s.loaded / max(elapsed, 1e-9):.0f} rows/s); {s.rejected} rejected, "
+              f"{s.unassigned} unassigned left out, {s.skipped} already imported.")
+        if s.error:
+            print(f"Import stopped: {s.error}\nFix the problem and run the same command again to resume.")
+            return 1
+        return 1 if self.stopping.is_set() else 0
+
+
+def main() -> None:
+    args = parse_args()
+    if args.chunk_rows < 1 or args.workers < 1 or args.parsers < 1:
+        sys.exit("--chunk-rows, --workers and --parsers must be at least 1")
+    sources = find_sources(args.sources)
+    missing = [s for s in sources if not os.path.isfile(s)]
+    if missing:
+        sys.exit(f"not found: {', '.join(missing)}")
+    ImportChunkDB.__table__.create(bind=engine, checkfirst=True)
+    importer = Importer(args, load_node_map(args.map))
+    db = SessionLocal()
+    try:
+        importer.stats.skipped = db.execute(
+            select(func.coalesce(func.sum(ImportChunkDB.rows), 0)).where(ImportChunkDB.source.in_(sources))
+        ).scalar()
+    finally:
+        db.close()
+    sys.exit(importer.run(sources))
+
+
+if __name__ == "__main__":
+    main()
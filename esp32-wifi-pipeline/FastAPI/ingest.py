@@ -0,0 +1,344 @@
+# ingest.py
+#
+# Set-based write path for sensor payloads.
+#
+# A payload is turned into plain row dicts for the three reading tables
+# (wifi_scan, dht22_reading, mq135_reading) and written with one multi-row
+# INSERT per table — SQLAlchemy's "insertmanyvalues" batches the whole list
+# into a single statement instead of one round trip per access point.
+#
+# Bad rows are dropped as early as possible (in Python, before they reach
+# Postgres).  If the database still refuses the batch, it is retried row by row
+# inside savepoints so only the offending row is lost and the rest is kept.
+#
+# Each payload may carry a dedupe key (ingest_dedupe.py).  write_batch() claims
+# the keys first, in the same transaction, and leaves out the rows of any
+# payload that has already been stored.
+#
+# WiFi rows carry ssid / bssid / enc up to here (and in the spool); write_batch()
+# swaps them for the access_point id (access_points.py) as it inserts them.
+
+import math
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.orm import Session
+
+from access_points import access_point_cache
+from ingest_dedupe import DedupeKey, ingest_dedupe
+from models import WifiScanDB, Dht22ReadingDB, Mq135ReadingDB
+from rollups import RollupBatch
+from scan_point_state import StateBatch
+
+INT16_MIN, INT16_MAX = -2**15, 2**15 - 1
+INT32_MIN, INT32_MAX = -2**31, 2**31 - 1
+
+
+def _as_int(value: Any, lo: int = INT32_MIN, hi: int = INT32_MAX) -> Optional[int]:
+    """int() that only accepts whole numbers — raises ValueError otherwise."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError("boolean is not an integer")
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError("not a whole number")
+        value = int(value)
+    value = int(value)
+    if not (lo <= value <= hi):
+        raise ValueError("out of range")
+    return value
+
+
+def _as_float(value: Any) -> float:
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError("not a finite number")
+    return value
+
+
+def _as_text(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    value = str(value)
+    if "\x00" in value:   # Postgres TEXT cannot store NUL bytes
+        raise ValueError("NUL byte in text")
+    return value
+
+
+def wifi_row(node: str, scan_point_id: int, received_at, s: Any) -> Optional[dict]:
+    """One wifi_scan row from one entry of the payload's scans array, or None if it is bad."""
+    if not isinstance(s, dict):
+        return None
+    try:
+        return {
+            "node":          node,
+            "ssid":          _as_text(s.get("ssid")),
+            "bssid":         _as_text(s.get("bssid")),
+            "rssi":          _as_int(s.get("rssi"), INT16_MIN, INT16_MAX),
+            "channel":       _as_int(s.get("channel"), INT16_MIN, INT16_MAX),
+            "enc":           _as_text(s.get("enc")),
+            "received_at":   received_at,
+            "scan_point_id": scan_point_id,
+        }
+    except (TypeError, ValueError):
+        return None
+
+
+def dht22_row(node: str, scan_point_id: int, received_at, temperature: Any) -> Optional[dict]:
+    """dht22_reading row from the optional temperature block, or None if absent/bad."""
+    if not temperature or not isinstance(temperature, dict):
+        return None
+    temp_c  = temperature.get("temperature_c")
+    hum_pct = temperature.get("humidity_pct")
+    if temp_c is None or hum_pct is None:
+        return None
+    try:
+        return {
+            "node":          node,
+            "scan_point_id": scan_point_id,
+            "temperature_c": _as_float(temp_c),
+            "humidity_pct":  _as_float(hum_pct),
+            "received_at":   received_at,
+        }
+    except (TypeError, ValueError):
+        return None
+
+
+def mq135_row(node: str, scan_point_id: int, received_at, air_quality: Any) -> Optional[dict]:
+    """mq135_reading row from the optional air_quality block, or None if absent/bad."""
+    if not air_quality or not isinstance(air_quality, dict):
+        return None
+    ppm = air_quality.get("ppm")
+    if ppm is None:
+        return None
+    try:
+        return {
+            "node":          node,
+            "scan_point_id": scan_point_id,
+            "ppm":           _as_float(ppm),
+            "raw_value":     _as_int(air_quality.get("raw_value")),
+            "received_at":   received_at,
+        }
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_time(value: Any) -> datetime:
+    """
+    Absolute timestamp from a device: ISO-8601 string (UTC if no offset) or
+    epoch seconds.  Raises ValueError otherwise.
+    """
+    if isinstance(value, bool):
+        raise ValueError("boolean is not a timestamp")
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(_as_float(value), tz=timezone.utc)
+    if isinstance(value, str):
+        ts = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+    raise ValueError("expected an ISO-8601 string or epoch seconds")
+
+
+def record_time(record: Dict[str, Any], boot_time: Optional[datetime]) -> datetime:
+    """
+    When a backfilled record was measured: its absolute "ts", or its "ts_ms"
+    (milliseconds since boot, i.e. millis()) added to the upload's boot time.
+    """
+    if record.get("ts") is not None:
+        return parse_time(record["ts"])
+    if record.get("ts_ms") is not None:
+        if boot_time is None:
+            raise ValueError("'ts_ms' needs 'boot_time' or 'uptime_ms' on the upload")
+        offset = record["ts_ms"]
+        if isinstance(offset, bool) or not isinstance(offset, (int, float)) or not 0 <= offset < 2**32:
+            raise ValueError("'ts_ms' must be a millis() value")
+        return boot_time + timedelta(milliseconds=offset)
+    raise ValueError("record needs 'ts' or 'ts_ms'")
+
+
+class IngestBatch:
+    """
+    Rows for the three reading tables, accumulated from one or more payloads
+    and written together by write_batch().
+
+    add_payload() returns a small per-payload summary so callers can report
+    what happened to their own rows after the shared write.  keys lists each
+    payload's dedupe key with the rows it contributed; write_batch() fills
+    duplicates with the keys whose rows it left out.
+    """
+
+    def __init__(self):
+        self.wifi:  List[dict] = []
+        self.dht22: List[dict] = []
+        self.mq135: List[dict] = []
+        self.keys:  List[Tuple[str, float, List[dict]]] = []
+        self.duplicates: Set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self.wifi) + len(self.dht22) + len(self.mq135)
+
+    def scan_point_ids(self) -> Set[int]:
+        """Scan points the batch has rows for."""
+        return {r["scan_point_id"] for rows in (self.wifi, self.dht22, self.mq135)
+                for r in rows if r.get("scan_point_id") is not None}
+
+    def sort_by_time(self) -> None:
+        """Order rows by received_at — backfilled records often arrive out of order."""
+        for rows in (self.wifi, self.dht22, self.mq135):
+            rows.sort(key=lambda r: r["received_at"])
+
+    def extend(self, other: "IngestBatch") -> None:
+        self.wifi.extend(other.wifi)
+        self.dht22.extend(other.dht22)
+        self.mq135.extend(other.mq135)
+        self.keys.extend(other.keys)
+
+    def _keep_key(self, key: Optional[DedupeKey], summary: dict) -> dict:
+        summary["key"] = key[0] if key else None
+        if key:
+            rows = summary["wifi"] + [r for r in (summary["dht22"], summary["mq135"]) if r is not None]
+            self.keys.append((key[0], key[1], rows))
+        return summary
+
+    def _drop_rows(self, drop: Set[int]) -> None:
+        self.wifi  = [r for r in self.wifi if id(r) not in drop]
+        self.dht22 = [r for r in self.dht22 if id(r) not in drop]
+        self.mq135 = [r for r in self.mq135 if id(r) not in drop]
+
+    def drop_repeated_keys(self) -> None:
+        """Keep only the first payload for a key that appears more than once in this batch."""
+        seen, keep, drop = set(), [], set()
+        for entry in self.keys:
+            if entry[0] in seen:
+                drop.update(id(r) for r in entry[2])
+            else:
+                seen.add(entry[0])
+                keep.append(entry)
+        if drop:
+            self.keys = keep
+            self._drop_rows(drop)
+
+    def key_all_rows(self, key: Optional[DedupeKey]) -> None:
+        """One dedupe key covering every row in the batch (a whole backfill upload)."""
+        if key:
+            self.keys.append((key[0], key[1], self.wifi + self.dht22 + self.mq135))
+
+    def drop_keys(self, keys: Set[str]) -> None:
+        """Leave out every row contributed by a payload with one of these keys."""
+        self._drop_rows({id(r) for key, _, rows in self.keys if key in keys for r in rows})
+        self.duplicates |= keys
+
+    def add_payload(self, node: str, scan_point_id: int, received_at, payload: Dict[str, Any],
+                    key: Optional[DedupeKey] = None) -> dict:
+        scans = payload.get("scans") or []
+        rows, rejected = [], []
+        for i, s in enumerate(scans):
+            row = wifi_row(node, scan_point_id, received_at, s)
+            if row is None:
+                rejected.append(i)
+            else:
+                rows.append(row)
+        self.wifi.extend(rows)
+
+        dht = dht22_row(node, scan_point_id, received_at, payload.get("temperature"))
+        if dht is not None:
+            self.dht22.append(dht)
+        mq = mq135_row(node, scan_point_id, received_at, payload.get("air_quality"))
+        if mq is not None:
+            self.mq135.append(mq)
+
+        return self._keep_key(key, {"wifi": rows, "rejected": rejected, "total": len(scans), "dht22": dht, "mq135": mq})
+
+    def add_packed(self, scan_point_id: int, received_at, packed, key: Optional[DedupeKey] = None) -> dict:
+        """
+        add_payload() for a PackedPayload (ingest_codec.py).  The binary layout
+        already fixes every field's type, so the tuples become rows directly.
+        """
+        node = packed.node
+        rows, rejected = [], []
+        for i, (ssid, bssid, rssi, channel, enc) in enumerate(packed.scans):
+            if "\x00" in ssid:   # Postgres TEXT cannot store NUL bytes
+                rejected.append(i)
+                continue
+            rows.append({
+                "node": node, "ssid": ssid, "bssid": bssid, "rssi": rssi, "channel": channel,
+                "enc": enc, "received_at": received_at, "scan_point_id": scan_point_id,
+            })
+        self.wifi.extend(rows)
+
+        dht = mq = None
+        if packed.temperature is not None:
+            temp_c, hum_pct = packed.temperature
+            dht = {"node": node, "scan_point_id": scan_point_id, "temperature_c": temp_c,
+                   "humidity_pct": hum_pct, "received_at": received_at}
+            self.dht22.append(dht)
+        if packed.air_quality is not None:
+            ppm, raw_value = packed.air_quality
+            mq = {"node": node, "scan_point_id": scan_point_id, "ppm": ppm,
+                  "raw_value": raw_value, "received_at": received_at}
+            self.mq135.append(mq)
+
+        return self._keep_key(key, {"wifi": rows, "rejected": rejected, "total": len(packed.scans), "dht22": dht, "mq135": mq})
+
+
+def _insert_row_by_row(db: Session, model, rows: List[dict], params: List[dict]) -> List[dict]:
+    """Insert params[i] for rows[i] one at a time; returns the rows refused."""
+    failed = []
+    for row, values in zip(rows, params):
+        try:
+            with db.begin_nested():
+                db.execute(insert(model.__table__), [values])
+        except (OperationalError, InterfaceError):
+            raise
+        except DBAPIError:
+            failed.append(row)
+    return failed
+
+
+def _update_derived(db: Session, wifi: List[dict], dht22: List[dict], mq135: List[dict]) -> None:
+    """Add inserted rows to the rollups and the per-point state."""
+    for derived in (RollupBatch(), StateBatch()):
+        derived.add_rows(wifi, dht22, mq135)
+        derived.upsert(db)
+
+
+def write_batch(db: Session, batch: IngestBatch) -> List[dict]:
+    """
+    Insert every row of the batch into the current transaction.
+    The caller commits.  Returns the rows the database refused (normally none).
+    Connection-level failures (database down, timeouts) are raised, not
+    treated as bad rows — the caller spools the batch instead.
+    Payloads whose dedupe key is already claimed are left out (batch.duplicates).
+    The rows inserted are added to the rollup tables and scan_point_state in
+    the same transaction.
+    WiFi rows are inserted with their access_point id, resolved (and new access
+    points created) before the insert; the rows returned are the batch's own.
+    """
+    if batch.keys:
+        batch.drop_repeated_keys()
+        duplicates = ingest_dedupe.claim(db, [(key, ttl_s) for key, ttl_s, _ in batch.keys])
+        if duplicates:
+            batch.drop_keys(duplicates)
+    wifi = access_point_cache.scan_rows(batch.wifi) if batch.wifi else []
+    tables = [(WifiScanDB, batch.wifi, wifi), (Dht22ReadingDB, batch.dht22, batch.dht22),
+              (Mq135ReadingDB, batch.mq135, batch.mq135)]
+    try:
+        with db.begin_nested():
+            for model, _, params in tables:
+                if params:
+                    db.execute(insert(model.__table__), params)
+            _update_derived(db, batch.wifi, batch.dht22, batch.mq135)
+        return []
+    except (OperationalError, InterfaceError):
+        raise
+    except DBAPIError:
+        # One bad row fails the whole multi-row statement — fall back to
+        # per-row savepoints so only that row is rejected.
+        failed: List[dict] = []
+        for model, rows, params in tables:
+            failed.extend(_insert_row_by_row(db, model, rows, params))
+        refused = {id(row) for row in failed}
+        _update_derived(db, *([r for r in rows if id(r) not in refused] for _, rows, _ in tables))
+        return failed
@@ -0,0 +1,241 @@
+# ingest_codec.py
+#
+# Request-body decoding for POST /ingest and /ingest/batch, chosen by Content-Type.
+#
+#   application/json              the original format (default when no Content-Type)
+#   application/msgpack           same structure as the JSON, MessagePack-encoded —
+#                                 ArduinoJson's serializeMsgPack() produces it directly
+#   application/cbor              same structure, CBOR-encoded
+#   application/x-mssia-packed    fixed binary layout below, /ingest only
+#
+# MessagePack and CBOR need the optional msgpack / cbor2 packages; without them
+# those types answer 415 and JSON keeps working.
+#
+# Any of them may also be sent with Content-Encoding: gzip or deflate.  The
+# body is inflated chunk by chunk as it arrives and never allowed to grow past
+# INGEST_MAX_BODY_BYTES, so a small compressed "zip bomb" is cut off (413)
+# instead of being expanded into memory.
+#
+# Packed layout (little-endian, one node per body):
+#
+#   "MS"  u8 version=1  u8 node_len  node[node_len]          header
+#   u8 flags                                                 bit0 temperature, bit1 air quality
+#   [f32 temperature_c  f32 humidity_pct]                    if bit0
+#   [f32 ppm  u16 raw_value]                                 if bit1
+#   u16 count                                                number of access points
+#   count × ( bssid[6]  i8 rssi  u8 channel  u8 enc  u8 ssid_len  ssid[ssid_len] )
+#
+# A packed body is decoded straight into (ssid, bssid, rssi, channel, enc)
+# tuples — no per-scan dicts and no per-field type coercion, because the
+# layout already fixes every type.
+
+import json
+import math
+import os
+import struct
+import zlib
+from typing import Any, List, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:   # optional — application/msgpack answers 415 without it
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:   # optional — application/cbor answers 415 without it
+    cbor2 = None
+
+PACKED_MAGIC   = b"MS"
+PACKED_VERSION = 1
+
+_HEADER = struct.Struct("<2sBB")
+_FLAGS  = struct.Struct("<B")
+_TEMP   = struct.Struct("<ff")
+_AIR    = struct.Struct("<fH")
+_COUNT  = struct.Struct("<H")
+_AP     = struct.Struct("<6sbBBB")
+
+MAX_BODY_BYTES = int(os.getenv("INGEST_MAX_BODY_BYTES", str(1024 * 1024)))   # after decompression
+
+FLAG_TEMPERATURE = 0x01
+FLAG_AIR_QUALITY = 0x02
+
+# media type → format name used in responses and metrics
+MEDIA_TYPES = {
+    "application/json":           "json",
+    "application/msgpack":        "msgpack",
+    "application/x-msgpack":      "msgpack",
+    "application/vnd.msgpack":    "msgpack",
+    "application/cbor":           "cbor",
+    "application/x-mssia-packed": "packed",
+}
+
+CONTENT_ENCODINGS = ("identity", "gzip", "x-gzip", "deflate")
+
+decoded_counts = {name: 0 for name in set(MEDIA_TYPES.values())}
+
+# bytes as received vs. bytes after decompression — the ratio is the saving
+body_stats = {"bodies": 0, "compressed_bodies": 0, "wire_bytes": 0, "decoded_bytes": 0, "too_large": 0}
+
+
+class UnsupportedMediaType(Exception):
+    pass
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class BodyReader:
+    """
+    Accumulates a request body chunk by chunk, inflating it on the fly when it
+    has a Content-Encoding.  Raises BodyTooLarge as soon as the (decompressed)
+    size passes the limit, and ValueError for a corrupt or truncated stream.
+    """
+
+    def __init__(self, content_encoding: Optional[str], limit: int = MAX_BODY_BYTES):
+        encoding = (content_encoding or "identity").strip().lower()
+        if encoding not in CONTENT_ENCODINGS:
+            raise UnsupportedMediaType(f"Unsupported Content-Encoding '{encoding}'")
+        self.encoding = encoding
+        self.limit    = limit
+        self.wire     = 0
+        self._parts: List[bytes] = []
+        self._size    = 0
+        self._inflate = None
+        if encoding in ("gzip", "x-gzip"):
+            self._inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _keep(self, data: bytes) -> None:
+        self._size += len(data)
+        if self._size > self.limit:
+            body_stats["too_large"] += 1
+            raise BodyTooLarge(f"Body larger than {self.limit} bytes")
+        self._parts.append(data)
+
+    def feed(self, chunk: bytes) -> None:
+        if not chunk:
+            return
+        self.wire += len(chunk)
+        if self.encoding == "identity":
+            self._keep(chunk)
+            return
+        if self._inflate is None:
+            # "deflate" is meant to be zlib-wrapped, but some clients send raw
+            # deflate — a zlib header is a multiple of 31 with method 8.
+            zlib_wrapped = len(chunk) >= 2 and chunk[0] & 0x0F == 8 and ((chunk[0] << 8) | chunk[1]) % 31 == 0
+            self._inflate = zlib.decompressobj(zlib.MAX_WBITS if zlib_wrapped else -zlib.MAX_WBITS)
+        try:
+            # Ask for at most one byte more than the limit allows — getting it means too large.
+            self._keep(self._inflate.decompress(chunk, self.limit - self._size + 1))
+        except zlib.error as exc:
+            raise ValueError(f"corrupt {self.encoding} stream: {exc}")
+
+    def finish(self) -> bytes:
+        if self._inflate is not None:
+            try:
+                self._keep(self._inflate.flush())
+            except zlib.error as exc:
+                raise ValueError(f"corrupt {self.encoding} stream: {exc}")
+            if not self._inflate.eof:
+                raise ValueError(f"truncated {self.encoding} stream")
+            body_stats["compressed_bodies"] += 1
+        body = b"".join(self._parts)
+        body_stats["bodies"]        += 1
+        body_stats["wire_bytes"]    += self.wire
+        body_stats["decoded_bytes"] += len(body)
+        return body
+
+
+class PackedPayload:
+    """One node's reading decoded from the packed layout."""
+
+    __slots__ = ("node", "scans", "temperature", "air_quality")
+
+    def __init__(self, node: str, scans: List[Tuple], temperature: Optional[Tuple[float, float]],
+                 air_quality: Optional[Tuple[float, int]]):
+        self.node        = node
+        self.scans       = scans          # [(ssid, bssid, rssi, channel, enc), ...]
+        self.temperature = temperature    # (temperature_c, humidity_pct) or None
+        self.air_quality = air_quality    # (ppm, raw_value) or None
+
+
+def _finite_pair(pair: Tuple[float, Any]) -> Optional[Tuple[float, Any]]:
+    return pair if math.isfinite(pair[0]) and math.isfinite(pair[1]) else None
+
+
+def decode_packed(body: bytes) -> PackedPayload:
+    """Decode the packed layout.  Raises ValueError on a malformed body."""
+    try:
+        magic, version, node_len = _HEADER.unpack_from(body, 0)
+        if magic != PACKED_MAGIC or version != PACKED_VERSION:
+            raise ValueError("not a version 1 packed payload")
+        off  = _HEADER.size
+        node = body[off:off + node_len].decode()
+        off += node_len
+
+        (flags,) = _FLAGS.unpack_from(body, off)
+        off += _FLAGS.size
+        temperature = air_quality = None
+        if flags & FLAG_TEMPERATURE:
+            temperature = _finite_pair(_TEMP.unpack_from(body, off))
+            off += _TEMP.size
+        if flags & FLAG_AIR_QUALITY:
+            air_quality = _finite_pair(_AIR.unpack_from(body, off))
+            off += _AIR.size
+
+        (count,) = _COUNT.unpack_from(body, off)
+        off += _COUNT.size
+        scans = []
+        for _ in range(count):
+            bssid, rssi, channel, enc, ssid_len = _AP.unpack_from(body, off)
+            off += _AP.size
+            ssid = body[off:off + ssid_len].decode("utf-8", "replace")
+            off += ssid_len
+            scans.append((ssid, bssid.hex(":").upper(), rssi, channel, str(enc)))
+    except struct.error:
+        raise ValueError("truncated packed payload")
+    if off != len(body) or len(node) != node_len:
+        raise ValueError("packed payload length mismatch")
+    return PackedPayload(node, scans, temperature, air_quality)
+
+
+def media_format(content_type: Optional[str]) -> str:
+    """Format name for a Content-Type header.  Raises UnsupportedMediaType."""
+    media = (content_type or "application/json").split(";", 1)[0].strip().lower()
+    if media.endswith("+json"):
+        media = "application/json"
+    fmt = MEDIA_TYPES.get(media)
+    if fmt is None:
+        raise UnsupportedMediaType(f"Unsupported Content-Type '{media}'")
+    if (fmt == "msgpack" and msgpack is None) or (fmt == "cbor" and cbor2 is None):
+        raise UnsupportedMediaType(f"'{media}' is not available on this server")
+    return fmt
+
+
+def decode_body(fmt: str, body: bytes) -> Any:
+    """
+    Decode a request body in the given format.  JSON, MessagePack and CBOR give
+    the same plain structure; "packed" gives a PackedPayload.
+    Raises ValueError on a malformed body.
+    """
+    if fmt == "packed":
+        value = decode_packed(body)
+    elif fmt == "msgpack":
+        try:
+            value = msgpack.unpackb(body, raw=False, strict_map_key=False)
+        except Exception as exc:   # msgpack raises several unrelated exception types
+            raise ValueError(f"invalid MessagePack: {exc}")
+    elif fmt == "cbor":
+        try:
+            value = cbor2.loads(body)
+        except Exception as exc:
+            raise ValueError(f"invalid CBOR: {exc}")
+    else:
+        try:
+            value = json.loads(body)
+        except (UnicodeDecodeError, json.JSONDecodeError) as exc:
+            raise ValueError(f"invalid JSON: {exc}")
+    decoded_counts[fmt] += 1
+    return value
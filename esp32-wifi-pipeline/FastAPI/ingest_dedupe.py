@@ -0,0 +1,206 @@
+# ingest_dedupe.py
+#
+# Drops retried ingest payloads without a unique index on wifi_scan.
+#
+# Every payload gets a dedupe key:
+#
+#   id:<node>:<batch_id>   when the client sends a "batch_id" — remembered for
+#                          INGEST_DEDUPE_BATCH_TTL seconds (default one day)
+#   hash:<digest>          otherwise, a hash of the decoded payload — remembered
+#                          for INGEST_DEDUPE_HASH_WINDOW seconds.  Off by default
+#                          (0): identical readings a few seconds apart are
+#                          legitimate, so only turn it on for clients that retry
+#                          without a batch_id.
+#
+# Keys are checked in two places:
+#
+#   1. an in-memory TTL map (O(1), per process) — a retry that reaches the same
+#      worker is answered "Duplicate" before any rows are built;
+#   2. the small ingest_batch table — write_batch() claims the batch's keys in
+#      the same transaction as its rows, so a retry that reaches another worker,
+#      or arrives after a restart, is still stored only once.
+#
+# A background thread deletes expired keys from ingest_batch in small chunks.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from ingest_codec import PackedPayload
+from models import IngestBatchDB
+
+log = logging.getLogger(__name__)
+
+BATCH_ID_TTL_S   = float(os.getenv("INGEST_DEDUPE_BATCH_TTL", "86400"))
+HASH_WINDOW_S    = float(os.getenv("INGEST_DEDUPE_HASH_WINDOW", "0"))     # e.g. 30 — 0 leaves content-hash dedupe off
+MEMORY_KEYS      = int(os.getenv("INGEST_DEDUPE_MEMORY_KEYS", "100000"))
+PRUNE_INTERVAL_S = float(os.getenv("INGEST_DEDUPE_PRUNE_INTERVAL", "600"))
+PRUNE_CHUNK      = 5000
+MAX_BATCH_ID_LEN = 128
+
+DedupeKey = Tuple[str, float]   # (key, seconds it stays a duplicate)
+
+
+def payload_key(node: str, payload: Any) -> Optional[DedupeKey]:
+    """
+    Dedupe key for one payload, or None when it cannot be deduplicated
+    (no batch_id and content hashing switched off).
+    Raises ValueError for an unusable batch_id.
+    """
+    if isinstance(payload, dict) and payload.get("batch_id") is not None:
+        batch_id = payload["batch_id"]
+        if isinstance(batch_id, bool) or not isinstance(batch_id, (str, int)):
+            raise ValueError("'batch_id' must be a string or an integer")
+        batch_id = str(batch_id)
+        if not batch_id or len(batch_id) > MAX_BATCH_ID_LEN or "\x00" in batch_id:
+            raise ValueError(f"'batch_id' must be 1–{MAX_BATCH_ID_LEN} characters")
+        return f"id:{node}:{batch_id}", BATCH_ID_TTL_S
+
+    if HASH_WINDOW_S <= 0:
+        return None
+    if isinstance(payload, PackedPayload):
+        material = repr((payload.node, payload.scans, payload.temperature, payload.air_quality)).encode()
+    else:
+        # Canonical form, so the same reading hashes the same in JSON, MessagePack or CBOR.
+        material = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str).encode()
+    return f"hash:{hashlib.blake2b(material, digest_size=16).hexdigest()}", HASH_WINDOW_S
+
+
+class IngestDedupe:
+    def __init__(self, max_keys: int = MEMORY_KEYS):
+        self.max_keys  = max_keys
+        self._lock     = threading.Lock()
+        self._recent: "OrderedDict[str, float]" = OrderedDict()   # key → monotonic expiry
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # metrics
+        self.memory_hits = 0
+        self.db_hits     = 0
+        self.claimed     = 0
+        self.pruned      = 0
+        self.last_error  = None
+
+    # ── In-memory window ─────────────────────────────────────────────────────
+
+    def seen(self, key: str) -> bool:
+        """True if this process has accepted the key within its TTL."""
+        with self._lock:
+            expiry = self._recent.get(key)
+            if expiry is None:
+                return False
+            if expiry <= time.monotonic():
+                del self._recent[key]
+                return False
+            self.memory_hits += 1
+            return True
+
+    def remember(self, key: str, ttl_s: float) -> None:
+        with self._lock:
+            self._recent[key] = time.monotonic() + ttl_s
+            self._recent.move_to_end(key)
+            while len(self._recent) > self.max_keys:
+                self._recent.popitem(last=False)
+
+    # ── Persisted claims ─────────────────────────────────────────────────────
+
+    def claim(self, db: Session, keys: Iterable[DedupeKey]) -> Set[str]:
+        """
+        Claim keys in ingest_batch inside the caller's transaction.
+        Returns the keys that were already claimed within their TTL (duplicates).
+        An expired claim is taken over, so a hash key only blocks for its window.
+        """
+        by_ttl: Dict[float, Dict[str, None]] = {}
+        duplicates: Set[str] = set()
+        for key, ttl_s in keys:
+            by_ttl.setdefault(ttl_s, {})[key] = None
+
+        now   = datetime.now(timezone.utc)
+        table = IngestBatchDB.__table__
+        for ttl_s, group in by_ttl.items():
+            stmt = pg_insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["batch_key"],
+                set_={"received_at": stmt.excluded.received_at},
+                where=table.c.received_at < now - timedelta(seconds=ttl_s),
+            ).returning(table.c.batch_key)
+            won = set(db.execute(stmt, [{"batch_key": k, "received_at": now} for k in group]).scalars())
+            duplicates.update(k for k in group if k not in won)
+            self.claimed += len(won)
+        self.db_hits += len(duplicates)
+        for key in duplicates:
+            self.remember(key, HASH_WINDOW_S if key.startswith("hash:") else BATCH_ID_TTL_S)
+        return duplicates
+
+    # ── Pruning ──────────────────────────────────────────────────────────────
+
+    def prune_once(self) -> int:
+        """Delete ingest_batch keys older than the longest TTL, a chunk at a time."""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=max(BATCH_ID_TTL_S, HASH_WINDOW_S))
+        table  = IngestBatchDB.__table__
+        total  = 0
+        while not self._stopping.is_set():
+            db = SessionLocal()
+            try:
+                chunk = (
+                    select(table.c.batch_key)
+                    .where(table.c.received_at < cutoff)
+                    .limit(PRUNE_CHUNK)
+                    .scalar_subquery()
+                )
+                n = db.execute(delete(table).where(table.c.batch_key.in_(chunk))).rowcount
+                db.commit()
+            finally:
+                db.close()
+            total += n
+            if n < PRUNE_CHUNK:
+                break
+        self.pruned += total
+        return total
+
+    def _run(self) -> None:
+        while not self._stopping.wait(PRUNE_INTERVAL_S):
+            try:
+                self.prune_once()
+            except Exception as exc:
+                self.last_error = str(exc)[:200]
+                log.warning("ingest_batch prune failed, will retry: %s", exc)
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="ingest-dedupe-prune", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    # ── Metrics ──────────────────────────────────────────────────────────────
+
+    def stats(self) -> dict:
+        return {
+            "memory_keys":     len(self._recent),
+            "memory_hits":     self.memory_hits,
+            "db_hits":         self.db_hits,
+            "claimed":         self.claimed,
+            "pruned":          self.pruned,
+            "hash_window_s":   HASH_WINDOW_S,
+            "batch_id_ttl_s":  BATCH_ID_TTL_S,
+            "last_error":      self.last_error,
+        }
+
+
+ingest_dedupe = IngestDedupe()
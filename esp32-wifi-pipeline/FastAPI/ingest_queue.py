@@ -0,0 +1,196 @@
+# ingest_queue.py
+#
+# Write-behind queue for POST /ingest?mode=async.
+#
+# The request handler validates the payload, turns it into rows (ingest.py) and
+# appends them here — the ESP32 gets its 202 without waiting for a Postgres
+# commit.  A single background flusher thread drains the queue every
+# INGEST_FLUSH_MS milliseconds, or sooner once INGEST_FLUSH_ROWS rows are
+# waiting, and writes everything it drained in one transaction.
+#
+# The queue is bounded by rows, not requests.  When it is full offer() returns
+# False; the endpoint then falls back to the on-disk spool, and only answers
+# 429 with Retry-After once the spool is full too.  A flush that fails because
+# the database is down hands its rows to the spool (ingest_spool.py), which
+# replays them once Postgres is back.  Any other failure is a problem with the
+# batch itself, not the database: it is logged and counted (rows_errored), and
+# neither marks the database down nor goes to the spool, where it would fail
+# again on every replay.
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Optional
+
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+from database import SessionLocal
+from ingest import IngestBatch, write_batch
+from ingest_spool import SpoolFull, ingest_spool
+from response_cache import response_cache
+
+log = logging.getLogger(__name__)
+
+INGEST_MODE    = os.getenv("INGEST_MODE", "sync")   # default for /ingest when ?mode= is not given
+QUEUE_MAX_ROWS = int(os.getenv("INGEST_QUEUE_MAX_ROWS", "50000"))
+FLUSH_MS       = int(os.getenv("INGEST_FLUSH_MS", "250"))
+FLUSH_ROWS     = int(os.getenv("INGEST_FLUSH_ROWS", "5000"))
+RETRY_DELAY_S  = float(os.getenv("INGEST_RETRY_DELAY", "1.0"))
+
+
+class IngestQueue:
+    def __init__(self, max_rows: int = QUEUE_MAX_ROWS):
+        self.max_rows = max_rows
+        self._cond     = threading.Condition()
+        self._items: Deque[IngestBatch] = deque()
+        self._rows     = 0
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+        # metrics
+        self.flushes         = 0
+        self.rows_written    = 0
+        self.rows_failed     = 0
+        self.rows_spooled    = 0
+        self.rejected_full   = 0
+        self.flush_errors    = 0
+        self.rows_errored    = 0
+        self.last_flush_ms   = None
+        self.total_flush_ms  = 0.0
+        self.last_batch_rows = 0
+        self.max_batch_rows  = 0
+
+    # ── Producer side ────────────────────────────────────────────────────────
+
+    def offer(self, batch: IngestBatch) -> bool:
+        """Queue a batch for the flusher.  False means the queue is full."""
+        n = len(batch)
+        with self._cond:
+            if self._rows + n > self.max_rows:
+                self.rejected_full += 1
+                return False
+            was_empty = not self._items
+            self._items.append(batch)
+            self._rows += n
+            # Wake the flusher to start its timer, or to flush early when full enough.
+            if was_empty or self._rows >= FLUSH_ROWS:
+                self._cond.notify()
+        return True
+
+    def retry_after_s(self) -> int:
+        """Rough seconds until there is room again — used for the Retry-After header."""
+        per_flush = max(self.last_batch_rows, 1)
+        flushes   = self._rows / per_flush
+        return max(1, int(flushes * FLUSH_MS / 1000) + 1)
+
+    # ── Flusher ──────────────────────────────────────────────────────────────
+
+    def _drain(self) -> IngestBatch:
+        merged = IngestBatch()
+        with self._cond:
+            while self._items:
+                merged.extend(self._items.popleft())
+        return merged
+
+    def _flush(self, batch: IngestBatch) -> None:
+        started = time.perf_counter()
+        db = SessionLocal()
+        try:
+            failed = write_batch(db, batch)
+            db.commit()
+        finally:
+            db.close()
+        response_cache.touch(batch.scan_point_ids())
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        n = len(batch)   # after duplicates were left out
+        self.flushes        += 1
+        self.rows_written   += n - len(failed)
+        self.rows_failed    += len(failed)
+        self.last_flush_ms   = round(elapsed_ms, 2)
+        self.total_flush_ms += elapsed_ms
+        self.last_batch_rows = n
+        self.max_batch_rows  = max(self.max_batch_rows, n)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._items and not self._stopping:
+                    self._cond.wait()
+                if self._stopping and not self._items:
+                    return
+                # Give the batch time to grow unless it is already big enough.
+                if self._rows < FLUSH_ROWS and not self._stopping:
+                    self._cond.wait(FLUSH_MS / 1000)
+
+            batch = self._drain()
+            queued = len(batch)   # write_batch() may leave duplicates out
+            if not batch:
+                continue
+            while True:
+                try:
+                    if ingest_spool.db_recently_down():
+                        raise ConnectionError("database marked down")
+                    self._flush(batch)
+                    break
+                except (OperationalError, InterfaceError, ConnectionError) as exc:
+                    self.flush_errors += 1
+                    ingest_spool.mark_db_down()
+                    try:
+                        ingest_spool.append(batch, wait=False)   # its 202 was already sent
+                        self.rows_spooled += len(batch)
+                        log.warning("ingest flush failed (%s); %d rows spooled", exc, len(batch))
+                        break
+                    except SpoolFull:
+                        # Spool full too — keep the rows (they still count
+                        # against max_rows, so producers see backpressure) and retry.
+                        log.error("ingest flush failed and spool is full; retrying in %.1fs", RETRY_DELAY_S)
+                        if self._stopping:
+                            return
+                        time.sleep(RETRY_DELAY_S)
+                except Exception:
+                    self.flush_errors += 1
+                    self.rows_errored += len(batch)
+                    log.exception("ingest flush failed; %d rows not written", len(batch))
+                    break
+            with self._cond:
+                self._rows -= queued
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="ingest-flusher", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Flush whatever is queued, then stop the flusher thread."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "depth_rows":       self._rows,
+            "depth_batches":    len(self._items),
+            "max_rows":         self.max_rows,
+            "flush_ms":         FLUSH_MS,
+            "flush_rows":       FLUSH_ROWS,
+            "flushes":          self.flushes,
+            "rows_written":     self.rows_written,
+            "rows_failed":      self.rows_failed,
+            "rows_spooled":     self.rows_spooled,
+            "rejected_full":    self.rejected_full,
+            "flush_errors":     self.flush_errors,
+            "rows_errored":     self.rows_errored,
+            "last_flush_ms":    self.last_flush_ms,
+            "avg_flush_ms":     round(self.total_flush_ms / self.flushes, 2) if self.flushes else None,
+            "last_batch_rows":  self.last_batch_rows,
+            "max_batch_rows":   self.max_batch_rows,
+        }
+
+
+ingest_queue = IngestQueue()
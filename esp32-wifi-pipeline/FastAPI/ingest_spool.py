@@ -0,0 +1,435 @@
+# ingest_spool.py
+#
+# Durable on-disk spool for ingest batches the database cannot take right now.
+#
+# When Postgres is down or restarting, /ingest (and the async flusher) append
+# the already-validated rows here instead of failing.  The spool is a directory
+# of append-only segment files, one JSON record per line:
+#
+#   spool/seg-01760000000000000000-4242.log
+#     {"key": "spool:<uuid>", "wifi": [...], "dht22": [...], "mq135": [...], "dedupe": [...]}
+#
+# A segment is named after its creation time (ns) and the pid of the worker
+# writing it, so API workers sharing SPOOL_DIR never write to the same file.
+# A worker only appends to its own ".log" segment; sealing renames it to
+# ".sealed", and only sealed segments of the worker's own pid are replayed and
+# removed.  Segments left by a worker that is gone (crashed, or an earlier run
+# with the same pid, as in a container) are adopted: renamed to the adopting
+# worker's pid and sealed, so each is replayed by exactly one worker.  Nothing
+# touches the directory until start() (the API's lifespan, the serial bridge):
+# importing this module has no side effects.
+#
+# append() returns only once its record is fsync'd, so a 202 "Spooled" is never
+# lost to a crash.  Appends are fsync'd in groups — concurrent appends share
+# one fsync, issued after SPOOL_FSYNC_EVERY records or SPOOL_FSYNC_MS
+# milliseconds, whichever comes first — so a burst of ESP32 posts does not pay
+# one fsync each; the price is at most SPOOL_FSYNC_MS of extra latency on a
+# spooled request.  Callers that acknowledge nothing to a device (the async
+# flusher, whose 202 "Queued" was already sent, and the serial bridge) pass
+# wait=False and rely on the group fsync alone: a crash can lose what was
+# appended in the last SPOOL_FSYNC_MS / SPOOL_FSYNC_EVERY records.
+#
+# A background replayer seals the active segment and drains sealed segments
+# oldest-first, one bulk transaction per segment.  A segment that fails for any
+# reason other than the database being unreachable (a malformed record, a bug)
+# is moved to quarantine/ under the spool directory and counted, and replay
+# goes on with the next one — it is never retried forever, and it does not make
+# ingest treat the database as down.  Every record carries a unique
+# key that is claimed in the ingest_batch table in the same transaction as its
+# rows, so replaying a segment twice (crash between commit and unlink) never
+# stores anything twice.  Rows keep the server-stamped received_at from the
+# moment they were accepted, not the moment they were replayed.
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+from database import SessionLocal
+from ingest import IngestBatch, write_batch
+from models import IngestBatchDB
+from response_cache import response_cache
+
+log = logging.getLogger(__name__)
+
+SPOOL_DIR         = os.getenv("SPOOL_DIR", "spool")
+SEGMENT_BYTES     = int(os.getenv("SPOOL_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+MAX_BYTES         = int(os.getenv("SPOOL_MAX_BYTES", str(1024 * 1024 * 1024)))
+FSYNC_EVERY       = int(os.getenv("SPOOL_FSYNC_EVERY", "64"))
+FSYNC_MS          = int(os.getenv("SPOOL_FSYNC_MS", "200"))
+REPLAY_INTERVAL_S = float(os.getenv("SPOOL_REPLAY_INTERVAL", "2.0"))
+DB_DOWN_BACKOFF_S = float(os.getenv("SPOOL_DB_BACKOFF", "5.0"))
+
+_ROW_TIME_FIELDS = ("received_at",)
+
+
+class SpoolFull(Exception):
+    pass
+
+
+def _encode_rows(rows: List[dict]) -> List[dict]:
+    return [
+        {k: (v.isoformat() if isinstance(v, datetime) else v) for k, v in r.items()}
+        for r in rows
+    ]
+
+
+def _decode_rows(rows: List[dict]) -> List[dict]:
+    for r in rows:
+        for field in _ROW_TIME_FIELDS:
+            if isinstance(r.get(field), str):
+                r[field] = datetime.fromisoformat(r[field])
+    return rows
+
+
+def _encode_keys(batch: IngestBatch) -> list:
+    """Dedupe keys with their rows as (table, index) pairs, so replay can claim them."""
+    where = {id(r): [t, i] for t, rows in (("wifi", batch.wifi), ("dht22", batch.dht22), ("mq135", batch.mq135))
+             for i, r in enumerate(rows)}
+    return [[key, ttl_s, [where[id(r)] for r in rows if id(r) in where]] for key, ttl_s, rows in batch.keys]
+
+
+def _decode_record(record: dict, into: IngestBatch) -> None:
+    tables = {t: _decode_rows(record[t]) for t in ("wifi", "dht22", "mq135")}
+    into.wifi.extend(tables["wifi"])
+    into.dht22.extend(tables["dht22"])
+    into.mq135.extend(tables["mq135"])
+    for key, ttl_s, refs in record.get("dedupe", []):
+        into.keys.append((key, ttl_s, [tables[t][i] for t, i in refs]))
+
+
+class IngestSpool:
+    def __init__(self, directory: str = SPOOL_DIR):
+        self.dir = directory
+        self._lock        = threading.Lock()
+        self._synced_cond = threading.Condition(self._lock)
+        self._fh          = None
+        self._active_path: Optional[str] = None
+        self._unsynced    = 0
+        self._written     = 0   # records written, ever
+        self._synced      = 0   # … of which known to be on disk
+        self._last_sync   = time.monotonic()
+        self._db_down_at  = 0.0
+        self._stopping    = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self._pid      = os.getpid()
+        self._bytes    = 0
+        self._pending  = 0
+
+        # metrics
+        self.appended       = 0
+        self.replayed       = 0
+        self.duplicates     = 0
+        self.fsyncs         = 0
+        self.replay_errors  = 0
+        self.quarantined    = 0
+        self.last_replay_at = None
+        self.last_error     = None
+
+    # ── Segment helpers ──────────────────────────────────────────────────────
+
+    @staticmethod
+    def _parse(name: str) -> Optional[Tuple[str, int, str]]:
+        """(creation stamp, pid, suffix) of a segment file name, None for anything else."""
+        stem, dot, suffix = name.partition(".")
+        parts = stem.split("-")
+        if not dot or suffix not in ("log", "sealed") or len(parts) != 3 or parts[0] != "seg":
+            return None
+        try:
+            return parts[1], int(parts[2]), suffix
+        except ValueError:
+            return None
+
+    def _segments(self, suffix: Optional[str] = None) -> List[str]:
+        """This worker's segments (only those with the given suffix, if one is given), oldest first."""
+        names = []
+        if not os.path.isdir(self.dir):
+            return []
+        for n in os.listdir(self.dir):
+            parsed = self._parse(n)
+            if parsed and parsed[1] == self._pid and (suffix is None or parsed[2] == suffix):
+                names.append((parsed[0], n))
+        return [os.path.join(self.dir, n) for _, n in sorted(names)]
+
+    @staticmethod
+    def _alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _adopt_orphans(self, startup: bool = False) -> None:
+        """
+        Take over, sealed, the segments of workers that are gone.  At startup
+        that includes segments carrying our own pid — an earlier process's.
+        """
+        for n in sorted(os.listdir(self.dir)):
+            parsed = self._parse(n)
+            if parsed is None:
+                continue
+            stamp, pid, suffix = parsed
+            ours = pid == self._pid
+            if (ours and not startup) or (not ours and self._alive(pid)):
+                continue
+            if ours and suffix == "sealed":
+                target = os.path.join(self.dir, n)
+            else:
+                target = os.path.join(self.dir, f"seg-{stamp}-{self._pid}.sealed")
+                try:
+                    os.rename(os.path.join(self.dir, n), target)
+                except FileNotFoundError:
+                    continue   # another worker adopted it first
+            self._bytes   += os.path.getsize(target)
+            self._pending += self._count_lines(target)
+
+    @staticmethod
+    def _count_lines(path: str) -> int:
+        with open(path, "rb") as f:
+            return sum(1 for _ in f)
+
+    def _sync_locked(self) -> None:
+        if self._fh is not None and self._unsynced:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self.fsyncs += 1
+        self._unsynced  = 0
+        self._synced    = self._written
+        self._last_sync = time.monotonic()
+        self._synced_cond.notify_all()
+
+    def _seal_locked(self) -> None:
+        if self._fh is not None:
+            self._sync_locked()
+            self._fh.close()
+            os.rename(self._active_path, self._active_path[:-len(".log")] + ".sealed")
+            self._fh, self._active_path = None, None
+
+    # ── Producer side ────────────────────────────────────────────────────────
+
+    def append(self, batch: IngestBatch, wait: bool = True) -> str:
+        """
+        Durably queue a batch for replay.  Returns its idempotency key — with
+        wait, only once the record is fsync'd (sharing the fsync with
+        concurrent appends).
+        """
+        key  = f"spool:{uuid.uuid4().hex}"
+        line = json.dumps({
+            "key":   key,
+            "wifi":  _encode_rows(batch.wifi),
+            "dht22": _encode_rows(batch.dht22),
+            "mq135": _encode_rows(batch.mq135),
+            "dedupe": _encode_keys(batch),
+        }, separators=(",", ":")).encode() + b"\n"
+
+        with self._lock:
+            if self._bytes + len(line) > MAX_BYTES:
+                raise SpoolFull()
+            if self._fh is None:
+                self._active_path = os.path.join(self.dir, f"seg-{time.time_ns():020d}-{self._pid}.log")
+                self._fh = open(self._active_path, "ab")
+            self._fh.write(line)
+            self._bytes    += len(line)
+            self._pending  += 1
+            self._unsynced += 1
+            self._written  += 1
+            self.appended  += 1
+            seq = self._written
+            if self._unsynced >= FSYNC_EVERY:
+                self._sync_locked()
+            if self._fh.tell() >= SEGMENT_BYTES:
+                self._seal_locked()
+            # Group commit: wait for a fsync covering this record, issuing it
+            # ourselves if nobody has within FSYNC_MS.
+            deadline = time.monotonic() + FSYNC_MS / 1000
+            while wait and self._synced < seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._sync_locked()
+                    break
+                self._synced_cond.wait(remaining)
+        return key
+
+    # ── Database health ──────────────────────────────────────────────────────
+
+    def mark_db_down(self) -> None:
+        self._db_down_at = time.monotonic()
+
+    def db_recently_down(self) -> bool:
+        """True for a few seconds after a failure — ingest skips the database and spools directly."""
+        return time.monotonic() - self._db_down_at < DB_DOWN_BACKOFF_S
+
+    # ── Replay ───────────────────────────────────────────────────────────────
+
+    def _replay_segment(self, path: str) -> None:
+        records, lines = [], 0
+        with open(path, "rb") as f:
+            for raw in f:
+                lines += 1
+                try:
+                    records.append(json.loads(raw))
+                except ValueError:
+                    # Torn final line from a crash mid-write — nothing was acknowledged for it.
+                    log.warning("skipping unreadable spool record in %s", path)
+
+        db = SessionLocal()
+        try:
+            claimed = set()
+            if records:
+                claims = [
+                    {"batch_key": r["key"], "received_at": datetime.now(timezone.utc)}
+                    for r in records
+                ]
+                stmt = (
+                    pg_insert(IngestBatchDB.__table__)
+                    .on_conflict_do_nothing(index_elements=["batch_key"])
+                    .returning(IngestBatchDB.__table__.c.batch_key)
+                )
+                claimed = set(db.execute(stmt, claims).scalars())
+
+            batch = IngestBatch()
+            for r in records:
+                if r["key"] in claimed:
+                    _decode_record(r, batch)
+            write_batch(db, batch)
+            db.commit()
+        finally:
+            db.close()
+        response_cache.touch(batch.scan_point_ids())
+
+        size = os.path.getsize(path)
+        os.remove(path)
+        with self._lock:
+            self._bytes     -= size
+            self._pending   -= lines
+        self.replayed   += len(claimed)
+        self.duplicates += len(records) - len(claimed)
+
+    def _quarantine(self, path: str) -> None:
+        """Move a segment that cannot be replayed out of the way (kept for inspection)."""
+        size, lines = os.path.getsize(path), self._count_lines(path)
+        target = os.path.join(self.dir, "quarantine")
+        os.makedirs(target, exist_ok=True)
+        os.rename(path, os.path.join(target, os.path.basename(path)))
+        with self._lock:
+            self._bytes   -= size
+            self._pending -= lines
+        self.quarantined += 1
+
+    def replay_once(self) -> int:
+        """
+        Replay this worker's pending segments.  Returns how many segments were
+        drained.  Raises OperationalError / InterfaceError if the database is
+        unreachable; any other failure quarantines that segment.
+        """
+        with self._lock:
+            self._adopt_orphans()
+            self._seal_locked()
+            segments = self._segments("sealed")
+        drained = 0
+        for path in segments:
+            try:
+                self._replay_segment(path)
+            except (OperationalError, InterfaceError):
+                raise
+            except Exception as exc:
+                self.replay_errors += 1
+                self.last_error = str(exc)[:200]
+                log.exception("spool segment %s cannot be replayed; moved to quarantine", path)
+                self._quarantine(path)
+                continue
+            drained += 1
+        self.last_replay_at = datetime.now(timezone.utc)
+        return drained
+
+    def _run(self) -> None:
+        next_replay = 0.0
+        while not self._stopping.wait(FSYNC_MS / 1000):
+            with self._lock:
+                if self._unsynced and time.monotonic() - self._last_sync >= FSYNC_MS / 1000:
+                    self._sync_locked()
+            if time.monotonic() < next_replay or self.db_recently_down():
+                continue
+            next_replay = time.monotonic() + REPLAY_INTERVAL_S
+            with self._lock:
+                self._adopt_orphans()   # a worker that died with spooled records
+            if self._pending:
+                try:
+                    self.replay_once()
+                except (OperationalError, InterfaceError) as exc:
+                    self.replay_errors += 1
+                    self.last_error = str(exc)[:200]
+                    self.mark_db_down()
+                    log.warning("spool replay failed, will retry: %s", exc)
+                except Exception as exc:
+                    self.replay_errors += 1
+                    self.last_error = str(exc)[:200]
+                    log.exception("spool replay failed, will retry")
+
+    def start(self) -> None:
+        if self._thread is None:
+            # The pid is taken here, not at import — after a fork (gunicorn
+            # --preload) each worker spools as itself.
+            os.makedirs(self.dir, exist_ok=True)
+            with self._lock:
+                self._pid, self._bytes, self._pending = os.getpid(), 0, 0
+                self._adopt_orphans(startup=True)
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="ingest-spool", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+        with self._lock:
+            self._seal_locked()
+
+    # ── Metrics ──────────────────────────────────────────────────────────────
+
+    def _oldest_pending_at(self) -> Optional[datetime]:
+        for path in self._segments():
+            try:
+                with open(path, "rb") as f:
+                    first = json.loads(f.readline())
+            except (OSError, ValueError):
+                continue
+            times = [r["received_at"] for rows in (first["wifi"], first["dht22"], first["mq135"])
+                     for r in rows if r.get("received_at")]
+            if times:
+                return min(datetime.fromisoformat(t) for t in times)
+        return None
+
+    def stats(self) -> dict:
+        oldest = self._oldest_pending_at() if self._pending else None
+        lag = (datetime.now(timezone.utc) - oldest).total_seconds() if oldest else 0.0
+        return {
+            "bytes":              self._bytes,
+            "max_bytes":          MAX_BYTES,
+            "segments":           len(self._segments()),
+            "pending_records":    self._pending,
+            "replay_lag_s":       round(lag, 1),
+            "appended":           self.appended,
+            "replayed":           self.replayed,
+            "duplicates_skipped": self.duplicates,
+            "fsyncs":             self.fsyncs,
+            "replay_errors":      self.replay_errors,
+            "quarantined":        self.quarantined,
+            "db_down":            self.db_recently_down(),
+            "last_replay_at":     self.last_replay_at.isoformat() if self.last_replay_at else None,
+            "last_error":         self.last_error,
+        }
+
+
+ingest_spool = IngestSpool()
@@ -4,19 +4,35 @@ from typing import List, Dict, Any, Optional
 import asyncio, json, math, os, uuid
 from datetime import datetime, timezone
 
-from fastapi import FastAPI, Body, HTTPException, Query, Depends, UploadFile, File, Form, Header
+from fastapi import FastAPI, Body, HTTPException, Query, Depends, UploadFile, File, Form, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy import func
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import func, text
+from sqlalchemy.exc import InterfaceError, OperationalError
 from sqlalchemy.orm import Session
 
 from database import Base, engine, get_db, SessionLocal
 from models import (
     WifiScanDB, BuildingDB, RoomDB,
-    FloorPlanDB, ScanPointDB, Dht22ReadingDB, Mq135ReadingDB,
+    FloorPlanDB, ScanPointDB, Dht22ReadingDB, Mq135ReadingDB, ScanPointStateDB,
 )
+from access_points import access_point_cache
+from assignments import assignment_cache
+from ingest import IngestBatch, parse_time, record_time, write_batch
+from ingest_codec import (
+    MAX_BODY_BYTES, BodyReader, BodyTooLarge, PackedPayload, UnsupportedMediaType,
+    body_stats, decode_body, decoded_counts, media_format,
+)
+from ingest_dedupe import ingest_dedupe, payload_key
+from ingest_queue import INGEST_MODE, ingest_queue
+from ingest_spool import SpoolFull, ingest_spool
+from partitions import partition_manager
+from response_cache import ConditionalGetMiddleware, response_cache
+from retention import retention
+import archive
+import downsample
+import rollups
 from schemas import (
     BuildingCreate, BuildingUpdate,
     RoomCreate, RoomUpdate,
@@ -41,14 +57,35 @@ ADMIN_PASSWORD   = os.getenv("ADMIN_PASSWORD",   "admin123")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    Base.metadata.create_all(bind=engine)
+    try:
+        Base.metadata.create_all(bind=engine)
+    except OperationalError:
+        # Database still down — start anyway; /ingest spools until it is back.
+        pass
+    ingest_spool.start()
+    ingest_queue.start()
+    ingest_dedupe.start()
+    partition_manager.start()
+    retention.start()
+    response_cache.start()
     yield
+    response_cache.stop()
+    retention.stop()
+    partition_manager.stop()
+    ingest_dedupe.stop()
+    ingest_queue.stop()   # flush anything still queued before the process exits
+    ingest_spool.stop()
 
 app = FastAPI(title="Wi-Fi Scan API", version="2.0.0", lifespan=lifespan)
 
 os.makedirs("uploads/floorplans", exist_ok=True)
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
+
+# Added before CORSMiddleware so it runs inside it: 304s and cached bodies
+# still get the CORS headers.
+app.add_middleware(ConditionalGetMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -71,6 +108,30 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics/ingest")
+def ingest_metrics():
+    """Write-behind queue depth, flush latency and batch sizes (ingest_queue.py),
+    plus on-disk spool size and replay lag (ingest_spool.py), duplicates dropped
+    (ingest_dedupe.py), how many bodies arrived in each encoding and how
+    much compression saved (ingest_codec.py), the reading tables'
+    partitions (partitions.py), retention progress (retention.py), the
+    access point intern cache (access_points.py) and the Parquet archive
+    (archive.py), and the conditional-GET response cache (response_cache.py)."""
+    return {
+        "queue":     ingest_queue.stats(),
+        "spool":     ingest_spool.stats(),
+        "dedupe":    ingest_dedupe.stats(),
+        "encodings": dict(decoded_counts),
+        "bodies":    {**body_stats, "compression_ratio": round(body_stats["decoded_bytes"] / body_stats["wire_bytes"], 2)
+                      if body_stats["wire_bytes"] else None},
+        "partitions": partition_manager.stats(),
+        "retention":  retention.stats(),
+        "access_points": access_point_cache.stats(),
+        "archive":    archive.stats(),
+        "response_cache": response_cache.stats(),
+    }
+
+
 # ── Auth ─────────────────────────────────────────────────────────────────────
 #
 # POST /auth/login  — validate credentials, return a signed JWT access token
@@ -124,15 +185,144 @@ def auth_verify(authorization: str = Header(default=None)):
 #
 # Timestamps: received_at is stamped by the server (datetime.now UTC).
 #   The ESP32 does NOT need to send a timestamp — millis() is unreliable anyway.
+#
+# Bad rows: a scan entry that cannot be stored (non-numeric rssi, NUL bytes…)
+#   is rejected on its own and counted in "rejected"; the rest of the batch is kept.
+#
+# Modes: ?mode=sync (default, or INGEST_MODE env) commits before answering 200.
+#   ?mode=async validates, queues the rows for the background flusher and
+#   answers 202 straight away.
+#
+# Outages: if Postgres is down or restarting (or the async queue is full) the
+#   validated rows go to the on-disk spool and the answer is 202 "Spooled";
+#   they are replayed with their original received_at once the database is
+#   back.  Only a full spool answers 429 with Retry-After.
+#
+# Encodings: the body may be JSON, MessagePack, CBOR or the packed binary
+#   layout, selected by Content-Type (see ingest_codec.py), optionally with
+#   Content-Encoding: gzip or deflate.  Unknown types answer 415; bodies over
+#   INGEST_MAX_BODY_BYTES once decompressed answer 413.
+#
+# Retries: a payload may carry an optional "batch_id".  A payload whose
+#   batch_id was already accepted (or, with INGEST_DEDUPE_HASH_WINDOW set,
+#   whose exact content was accepted within that window) is answered
+#   200 "Duplicate" and not stored again — see ingest_dedupe.py.
+
+async def _read_body(request: Request, limit: int) -> Any:
+    """Request body decompressed and decoded according to its Content-Encoding and Content-Type."""
+    try:
+        fmt    = media_format(request.headers.get("content-type"))
+        reader = BodyReader(request.headers.get("content-encoding"), limit)
+    except UnsupportedMediaType as exc:
+        raise HTTPException(status_code=415, detail=str(exc))
+    try:
+        async for chunk in request.stream():
+            reader.feed(chunk)
+        body = reader.finish()
+        if not body:
+            raise HTTPException(status_code=422, detail="Missing request body")
+        return decode_body(fmt, body)
+    except BodyTooLarge as exc:
+        raise HTTPException(status_code=413, detail=str(exc))
+    except ValueError as exc:
+        raise HTTPException(status_code=422, detail=f"Malformed body: {exc}")
+
+
+async def _ingest_body(request: Request) -> Any:
+    return await _read_body(request, MAX_BODY_BYTES)
+
+
+def _spool_or_429(batch: IngestBatch) -> None:
+    try:
+        ingest_spool.append(batch)
+    except SpoolFull:
+        raise HTTPException(
+            status_code=429,
+            detail="Ingest backlog full — retry later",
+            headers={"Retry-After": str(ingest_queue.retry_after_s())},
+        )
+
+
+def _store_batch(db: Session, batch: IngestBatch, mode: Optional[str]):
+    """
+    Write (or queue, or spool) a built batch.
+    Returns (status, ids of rows the database refused) where status is
+    "Assigned" (committed), "Queued" (async flusher) or "Spooled" (on disk).
+    """
+    if (mode or INGEST_MODE) == "async":
+        if ingest_queue.offer(batch):
+            return "Queued", set()
+        _spool_or_429(batch)
+        return "Spooled", set()
+
+    if ingest_spool.db_recently_down():
+        _spool_or_429(batch)
+        return "Spooled", set()
+
+    try:
+        failed = {id(r) for r in write_batch(db, batch)}
+        db.commit()
+        response_cache.touch(batch.scan_point_ids())
+    except (OperationalError, InterfaceError):
+        db.rollback()
+        ingest_spool.mark_db_down()
+        _spool_or_429(batch)
+        return "Spooled", set()
+    return "Assigned", failed
+
+
+def _remember_keys(batch: IngestBatch) -> None:
+    """Accepted keys go into the in-memory window so retries are answered without a write."""
+    for key, ttl_s, _ in batch.keys:
+        if key not in batch.duplicates:
+            ingest_dedupe.remember(key, ttl_s)
+
+
+def _duplicate_result(node: str, scan_point_id: int, server_now: datetime, total: int) -> dict:
+    return {
+        "status":        "Duplicate",
+        "accepted":      0,
+        "total":         total,
+        "rejected":      0,
+        "temp_stored":   False,
+        "air_stored":    False,
+        "node":          node,
+        "scan_point_id": scan_point_id,
+        "received_at":   server_now.isoformat(),
+    }
+
+
+def _ingest_result(status: str, node: str, scan_point_id: int, server_now: datetime,
+                   summary: dict, failed: set, duplicates: set) -> dict:
+    """Per-payload response body — same shape for /ingest and each /ingest/batch envelope."""
+    if summary["key"] in duplicates:
+        return _duplicate_result(node, scan_point_id, server_now, summary["total"])
+    accepted = sum(1 for r in summary["wifi"] if id(r) not in failed)
+    return {
+        "status":        status,
+        "accepted":      accepted,
+        "total":         summary["total"],
+        "rejected":      summary["total"] - accepted,
+        "temp_stored":   summary["dht22"] is not None and id(summary["dht22"]) not in failed,
+        "air_stored":    summary["mq135"] is not None and id(summary["mq135"]) not in failed,
+        "node":          node,
+        "scan_point_id": scan_point_id,
+        "received_at":   server_now.isoformat(),
+    }
+
 
 @app.post("/ingest")
 def ingest(
-    payload: Dict[str, Any] = Body(...),
+    payload: Any = Depends(_ingest_body),
+    mode: Optional[str] = Query(default=None, pattern="^(sync|async)$"),
     db: Session = Depends(get_db),
 ):
-    node        = payload.get("node")
-    scans       = payload.get("scans", [])
-    temperature = payload.get("temperature")   # optional DHT22 block
+    if isinstance(payload, PackedPayload):
+        node, scans = payload.node, payload.scans
+    elif isinstance(payload, dict):
+        node, scans = payload.get("node"), payload.get("scans", [])
+    else:
+        raise HTTPException(status_code=422, detail="Body must be an object")
 
     # ── Validation ────────────────────────────────────────────────────────────
     if not node:
@@ -142,87 +332,257 @@ def ingest(
         raise HTTPException(status_code=400, detail="Missing or empty 'scans' array in payload")
 
     # ── Node validation (security) ────────────────────────────────────────────
-    known = db.query(ScanPointDB).filter(ScanPointDB.assigned_node == node).first()
-    if not known:
+    # Served from the in-memory assignment map — no database read on the hot path.
+    try:
+        scan_point_id = assignment_cache.lookup(db, node)
+    except (OperationalError, InterfaceError):
+        raise HTTPException(status_code=503, detail="Database unavailable", headers={"Retry-After": "5"})
+    if scan_point_id is None:
         raise HTTPException(status_code=403, detail="Unassigned")
 
     # ── Stamp server-side timestamp once for this batch ───────────────────────
-    server_now    = datetime.now(timezone.utc)
-    scan_point_id = known.id
-
-    # ── Store WiFi scans ──────────────────────────────────────────────────────
-    accepted = 0
-    for s in scans:
-        row = WifiScanDB(
-            node          = node,
-            ssid          = s.get("ssid"),
-            bssid         = s.get("bssid"),
-            rssi          = s.get("rssi"),
-            channel       = s.get("channel"),
-            enc           = s.get("enc"),
-            received_at   = server_now,
-            scan_point_id = scan_point_id,
-        )
-        db.add(row)
+    server_now = datetime.now(timezone.utc)
+
+    # ── Retry of a payload this worker already accepted? ──────────────────────
+    try:
+        key = payload_key(node, payload)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    if key and ingest_dedupe.seen(key[0]):
+        return _duplicate_result(node, scan_point_id, server_now, len(scans))
+
+    # ── Build rows for all three tables, then write them set-based ───────────
+    # WiFi scans, the optional DHT22 block (present only when the sensor returns
+    # valid readings) and the optional MQ-135 block (present only when
+    # analogRead returns a non-zero value) go in one multi-row INSERT per table.
+    batch = IngestBatch()
+    if isinstance(payload, PackedPayload):
+        summary = batch.add_packed(scan_point_id, server_now, payload, key)
+    else:
+        summary = batch.add_payload(node, scan_point_id, server_now, payload, key)
+
+    status, failed = _store_batch(db, batch, mode)
+    _remember_keys(batch)
+    result = _ingest_result(status, node, scan_point_id, server_now, summary, failed, batch.duplicates)
+    if status != "Assigned" and result["status"] != "Duplicate":
+        return JSONResponse(status_code=202, content=result)
+    return result
+
+
+# POST /ingest/batch — one request from a gateway carrying several nodes' payloads.
+#
+# Body: [ { "node": "...", "scans": [...], "temperature": {...}, "air_quality": {...} }, ... ]
+#
+# Every envelope is validated on its own; the assignments of all nodes are
+# resolved in one pass over the in-memory map, and all accepted envelopes are
+# written in a single bulk transaction.  The response has one entry per
+# envelope, in request order, with the same fields /ingest returns plus
+# "index" and an HTTP-style "code" (200/202, or 400/403 for that envelope).
+# JSON, MessagePack and CBOR bodies are accepted; the packed layout carries a
+# single node and is only accepted by /ingest.
+
+INGEST_BATCH_MAX_ENVELOPES = int(os.getenv("INGEST_BATCH_MAX_ENVELOPES", "500"))
+
+
+@app.post("/ingest/batch")
+def ingest_batch(
+    envelopes: Any = Depends(_ingest_body),
+    mode: Optional[str] = Query(default=None, pattern="^(sync|async)$"),
+    db: Session = Depends(get_db),
+):
+    if isinstance(envelopes, PackedPayload):
+        raise HTTPException(status_code=415, detail="Packed bodies carry one node — POST them to /ingest")
+    if not isinstance(envelopes, list):
+        raise HTTPException(status_code=422, detail="Body must be an array of envelopes")
+    if not envelopes:
+        raise HTTPException(status_code=400, detail="Empty envelope array")
+    if len(envelopes) > INGEST_BATCH_MAX_ENVELOPES:
+        raise HTTPException(status_code=413, detail=f"At most {INGEST_BATCH_MAX_ENVELOPES} envelopes per request")
+
+    nodes = [e["node"] for e in envelopes if isinstance(e, dict) and isinstance(e.get("node"), str)]
+    try:
+        assignments = assignment_cache.resolve_many(db, nodes)
+    except (OperationalError, InterfaceError):
+        raise HTTPException(status_code=503, detail="Database unavailable", headers={"Retry-After": "5"})
+
+    server_now = datetime.now(timezone.utc)
+    batch      = IngestBatch()
+    results: List[Dict[str, Any]] = []
+    pending: List[tuple] = []   # (index, node, scan_point_id, summary)
+    keys_in_request = set()
+
+    for i, env in enumerate(envelopes):
+        node  = env.get("node") if isinstance(env, dict) else None
+        scans = env.get("scans", []) if isinstance(env, dict) else None
+        if not node or not isinstance(node, str):
+            results.append({"index": i, "code": 400, "detail": "Missing 'node' field in payload"})
+            continue
+        if not isinstance(scans, list) or not scans:
+            results.append({"index": i, "code": 400, "node": node, "detail": "Missing or empty 'scans' array in payload"})
+            continue
+        if assignments.get(node) is None:
+            results.append({"index": i, "code": 403, "node": node, "detail": "Unassigned"})
+            continue
+        scan_point_id = assignments[node]
         try:
-            db.flush()
-            accepted += 1
-        except IntegrityError:
-            db.rollback()
+            key = payload_key(node, env)
+        except ValueError as exc:
+            results.append({"index": i, "code": 400, "node": node, "detail": str(exc)})
+            continue
+        if key and (key[0] in keys_in_request or ingest_dedupe.seen(key[0])):
+            results.append({"index": i, "code": 200, **_duplicate_result(node, scan_point_id, server_now, len(scans))})
             continue
+        if key:
+            keys_in_request.add(key[0])
+        summary = batch.add_payload(node, scan_point_id, server_now, env, key)
+        pending.append((i, node, scan_point_id, summary))
+        results.append(None)
+
+    status, failed = ("Assigned", set())
+    if batch:
+        status, failed = _store_batch(db, batch, mode)
+        _remember_keys(batch)
+    for i, node, scan_point_id, summary in pending:
+        result = _ingest_result(status, node, scan_point_id, server_now, summary, failed, batch.duplicates)
+        code   = 200 if status == "Assigned" or result["status"] == "Duplicate" else 202
+        results[i] = {"index": i, "code": code, **result}
+
+    body = {
+        "status":      status if pending else "Rejected",
+        "envelopes":   len(envelopes),
+        "accepted":    len(pending),
+        "received_at": server_now.isoformat(),
+        "results":     results,
+    }
+    if pending and status != "Assigned":
+        return JSONResponse(status_code=202, content=body)
+    return body
 
-    # ── Store temperature + humidity (optional) ───────────────────────────────
-    # Present only when DHT22 is wired and returns valid readings.
-    temp_stored = False
-    if temperature and isinstance(temperature, dict):
-        temp_c  = temperature.get("temperature_c")
-        hum_pct = temperature.get("humidity_pct")
-        if temp_c is not None and hum_pct is not None:
-            try:
-                db.add(Dht22ReadingDB(
-                    node          = node,
-                    scan_point_id = scan_point_id,
-                    temperature_c = float(temp_c),
-                    humidity_pct  = float(hum_pct),
-                    received_at   = server_now,
-                ))
-                db.flush()
-                temp_stored = True
-            except Exception:
-                db.rollback()
-
-    # ── Store air quality reading (optional) ─────────────────────────────────
-    # Present only when MQ-135 is wired and analogRead returns a non-zero value.
-    air_stored = False
-    air_quality = payload.get("air_quality")
-    if air_quality and isinstance(air_quality, dict):
-        ppm       = air_quality.get("ppm")
-        raw_value = air_quality.get("raw_value")
-        if ppm is not None:
-            try:
-                db.add(Mq135ReadingDB(
-                    node          = node,
-                    scan_point_id = scan_point_id,
-                    ppm           = float(ppm),
-                    raw_value     = int(raw_value) if raw_value is not None else None,
-                    received_at   = server_now,
-                ))
-                db.flush()
-                air_stored = True
-            except Exception:
-                db.rollback()
 
-    db.commit()
-    return {
-        "status":        "Assigned",
-        "accepted":      accepted,
-        "total":         len(scans),
-        "temp_stored":   temp_stored,
-        "air_stored":    air_stored,
-        "node":          node,
-        "scan_point_id": scan_point_id,
-        "received_at":   server_now.isoformat(),
+# POST /ingest/backfill — readings a node buffered while it was offline.
+#
+# Body: { "node": "...", "batch_id": "...",
+#         "boot_time": "<ISO-8601 or epoch s>"   or   "uptime_ms": <millis() when sending>,
+#         "records": [ { "ts": "<ISO-8601 or epoch s>"  or  "ts_ms": <millis() when measured>,
+#                        "scans": [...], "temperature": {...}, "air_quality": {...} }, ... ] }
+#
+# Unlike /ingest, received_at is the time each record was measured.  A node
+# without a real-time clock sends uptime_ms, and the server anchors the
+# records' millis() stamps to (now - uptime_ms).  Records slightly in the
+# future (clock skew) are clamped to now; further ahead, or older than
+# INGEST_BACKFILL_MAX_AGE_DAYS, they are rejected on their own.  Rows are
+# sorted by time and written in one bulk transaction — or queued / spooled,
+# exactly like /ingest.  A batch_id makes a re-sent upload a no-op.
+
+BACKFILL_MAX_RECORDS    = int(os.getenv("INGEST_BACKFILL_MAX_RECORDS", "10000"))
+BACKFILL_MAX_BODY_BYTES = int(os.getenv("INGEST_BACKFILL_MAX_BODY_BYTES", str(16 * 1024 * 1024)))
+BACKFILL_MAX_AGE_DAYS   = int(os.getenv("INGEST_BACKFILL_MAX_AGE_DAYS", "30"))
+BACKFILL_FUTURE_SKEW_S  = 300
+
+
+async def _backfill_body(request: Request) -> Any:
+    return await _read_body(request, BACKFILL_MAX_BODY_BYTES)
+
+
+@app.post("/ingest/backfill")
+def ingest_backfill(
+    payload: Any = Depends(_backfill_body),
+    mode: Optional[str] = Query(default=None, pattern="^(sync|async)$"),
+    db: Session = Depends(get_db),
+):
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=422, detail="Body must be an object")
+    node    = payload.get("node")
+    records = payload.get("records")
+
+    if not node or not isinstance(node, str):
+        raise HTTPException(status_code=400, detail="Missing 'node' field in payload")
+    if not isinstance(records, list) or not records:
+        raise HTTPException(status_code=400, detail="Missing or empty 'records' array in payload")
+    if len(records) > BACKFILL_MAX_RECORDS:
+        raise HTTPException(status_code=413, detail=f"At most {BACKFILL_MAX_RECORDS} records per upload")
+
+    try:
+        scan_point_id = assignment_cache.lookup(db, node)
+    except (OperationalError, InterfaceError):
+        raise HTTPException(status_code=503, detail="Database unavailable", headers={"Retry-After": "5"})
+    if scan_point_id is None:
+        raise HTTPException(status_code=403, detail="Unassigned")
+
+    server_now = datetime.now(timezone.utc)
+    try:
+        boot_time = None
+        if payload.get("boot_time") is not None:
+            boot_time = parse_time(payload["boot_time"])
+        elif payload.get("uptime_ms") is not None:
+            uptime_ms = payload["uptime_ms"]
+            if isinstance(uptime_ms, bool) or not isinstance(uptime_ms, (int, float)) or uptime_ms < 0:
+                raise ValueError("'uptime_ms' must be a millis() value")
+            boot_time = server_now - timedelta(milliseconds=uptime_ms)
+        key = payload_key(node, payload)
+    except (OverflowError, ValueError) as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+    body = {
+        "status":           "Duplicate",
+        "node":             node,
+        "scan_point_id":    scan_point_id,
+        "records":          len(records),
+        "accepted_records": 0,
+        "rejected_records": [],
+        "rows":             0,
+        "rejected_rows":    0,
+        "oldest":           None,
+        "newest":           None,
+        "boot_time":        boot_time.isoformat() if boot_time else None,
     }
+    if key and ingest_dedupe.seen(key[0]):
+        return body
+
+    # ── One row set per record, stamped with the record's own time ───────────
+    too_old   = server_now - timedelta(days=BACKFILL_MAX_AGE_DAYS)
+    too_new   = server_now + timedelta(seconds=BACKFILL_FUTURE_SKEW_S)
+    batch     = IngestBatch()
+    summaries = []
+    times     = []
+    for i, record in enumerate(records):
+        try:
+            if not isinstance(record, dict):
+                raise ValueError("record must be an object")
+            measured_at = record_time(record, boot_time)
+            if measured_at > too_new:
+                raise ValueError("timestamp is in the future")
+            if measured_at < too_old:
+                raise ValueError(f"timestamp is older than {BACKFILL_MAX_AGE_DAYS} days")
+        except (OverflowError, ValueError) as exc:
+            body["rejected_records"].append({"index": i, "detail": str(exc)})
+            continue
+        measured_at = min(measured_at, server_now)
+        summaries.append(batch.add_payload(node, scan_point_id, measured_at, record))
+        times.append(measured_at)
+
+    if not batch:
+        body["status"] = "Rejected"
+        return body
+
+    batch.key_all_rows(key)
+    batch.sort_by_time()
+    status, failed = _store_batch(db, batch, mode)
+    _remember_keys(batch)
+    if key and key[0] in batch.duplicates:
+        return body
+
+    body.update({
+        "status":           status,
+        "accepted_records": len(summaries),
+        "rows":             len(batch) - len(failed),
+        "rejected_rows":    sum(len(s["rejected"]) for s in summaries) + len(failed),
+        "oldest":           min(times).isoformat(),
+        "newest":           max(times).isoformat(),
+    })
+    if status != "Assigned":
+        return JSONResponse(status_code=202, content=body)
+    return body
 
 
 # ── Scan Points ───────────────────────────────────────────────────────────────
@@ -233,8 +593,13 @@ def ingest(
 @app.get("/floorplans/{floorplan_id}/scan-points")
 def list_scan_points(
     floorplan_id: int,
+    include: Optional[str] = Query(default=None, pattern="^counts$"),
     db: Session = Depends(get_db),
 ):
+    """
+    Every scan point on a floor plan.  scan_count (WiFi scans recorded at the
+    point, from scan_point_state's running totals) only with ?include=counts.
+    """
     floorplan = db.get(FloorPlanDB, floorplan_id)
     if not floorplan:
         raise HTTPException(status_code=404, detail="Floor plan not found")
@@ -246,9 +611,10 @@ def list_scan_points(
         .all()
     )
 
+    counts = _scan_counts(db, [p.id for p in points]) if include == "counts" else None
     return {
         "floorplan_id": floorplan_id,
-        "scan_points": [_format_point(p, db) for p in points],
+        "scan_points": [_format_point(p, counts) for p in points],
     }
 
 
@@ -272,7 +638,7 @@ def create_scan_point(
     db.commit()
     db.refresh(point)
 
-    return {"scan_point": _format_point(point, db)}
+    return {"scan_point": _format_point(point, _scan_counts(db, [point.id]))}
 
 
 @app.put("/scan-points/{point_id}")
@@ -300,7 +666,7 @@ def update_scan_point(
 
     db.commit()
     db.refresh(point)
-    return {"scan_point": _format_point(point, db)}
+    return {"scan_point": _format_point(point, _scan_counts(db, [point.id]))}
 
 
 @app.delete("/scan-points/{point_id}")
@@ -317,12 +683,31 @@ def delete_scan_point(point_id: int, db: Session = Depends(get_db)):
     db.query(Mq135ReadingDB).filter(Mq135ReadingDB.scan_point_id == point_id).delete()
     db.delete(point)
     db.commit()
+    assignment_cache.invalidate()
     return {"message": "Scan point deleted"}
 
+# Custom wifi-history windows: the bucket size when none is given is the
+# smallest of these (minutes) that keeps the window to HISTORY_TARGET_BUCKETS.
+HISTORY_BUCKET_STEPS   = (1, 5, 10, 15, 30, 60, 180, 360, 720, 1440)
+HISTORY_TARGET_BUCKETS = 100
+HISTORY_MAX_BUCKETS    = 1440
+
+
+def _bucket_minutes_for(total_minutes: float, max_buckets: int) -> int:
+    """Smallest of HISTORY_BUCKET_STEPS (then whole days) that splits total_minutes into at most max_buckets."""
+    for minutes in HISTORY_BUCKET_STEPS:
+        if total_minutes / minutes <= max_buckets:
+            return minutes
+    return 1440 * math.ceil(total_minutes / max_buckets / 1440)
+
+
 @app.get("/scan-points/{point_id}/wifi-history")
 def get_scan_point_wifi_history(
     point_id: int,
     time_range: str = Query(default="20m", pattern="^(20m|1h|6h|24h|7d)$"),
+    from_: Optional[datetime] = Query(default=None, alias="from"),
+    to: Optional[datetime] = None,
+    bucket: Optional[int] = Query(default=None, ge=1, le=7 * 1440),
     db: Session = Depends(get_db),
 ):
     """
@@ -335,8 +720,20 @@ def get_scan_point_wifi_history(
       24h  → last 24 hours,    1-hour    buckets (24 buckets)
       7d   → last 7 days,      6-hour    buckets (28 buckets)
 
+    Or any window: from / to (ISO timestamps, to defaults to now) with bucket
+    minutes (default: the smallest of HISTORY_BUCKET_STEPS giving at most
+    HISTORY_TARGET_BUCKETS buckets; at most HISTORY_MAX_BUCKETS).  time_range
+    is then ignored and range is "custom".
+
+    Buckets are aligned to the UTC clock — for the fixed ranges the last one
+    is the period in progress.  They are computed in Postgres from the rollup
+    tables (rollups.py), not from wifi_scan, and only one row per bucket comes
+    back; buckets older than the rollups come from the Parquet archive
+    (archive.py).
+
     Each bucket:
       label    : human-readable period label, e.g. "19m", "5h", "3d"
+                 (custom windows: the bucket start, e.g. "14 Oct 09:30")
       count    : scan rows received in that period (busyness)
       avg_rssi : average signal strength, null if no scans
       level    : strong / medium / low / weak / null
@@ -345,8 +742,6 @@ def get_scan_point_wifi_history(
     if not point:
         raise HTTPException(status_code=404, detail="Scan point not found")
 
-    from datetime import datetime, timedelta, timezone
-
     # ── Range config ────────────────────────────────────────────────────────
     RANGE_CONFIG = {
         "20m": {"total_minutes": 20,        "bucket_minutes": 1,   "n_buckets": 20},
@@ -355,140 +750,179 @@ def get_scan_point_wifi_history(
         "24h": {"total_minutes": 1440,      "bucket_minutes": 60,  "n_buckets": 24},
         "7d":  {"total_minutes": 7 * 1440,  "bucket_minutes": 360, "n_buckets": 28},
     }
-    cfg            = RANGE_CONFIG[time_range]
-    total_minutes  = cfg["total_minutes"]
-    bucket_minutes = cfg["bucket_minutes"]
-    n_buckets      = cfg["n_buckets"]
-
-    def _bucket_label(bucket_index: int) -> str:
-        """Human-readable label for the oldest end of this bucket."""
-        periods_ago = n_buckets - 1 - bucket_index
-        minutes_ago = periods_ago * bucket_minutes
-        if bucket_minutes < 60:
-            return f"{minutes_ago}m"
-        elif bucket_minutes < 1440:
-            return f"{minutes_ago // 60}h"
-        else:
-            return f"{minutes_ago // 1440}d"
-
-    def _bucket_start_iso(bucket_index: int) -> str:
-        """ISO timestamp for the start of this bucket (UTC)."""
-        periods_ago = n_buckets - 1 - bucket_index
-        bucket_start = now - timedelta(minutes=(periods_ago + 1) * bucket_minutes)
-        return bucket_start.isoformat()
-
-    now    = datetime.now(timezone.utc)
-    cutoff = now - timedelta(minutes=total_minutes)
-
-    rows = (
-        db.query(WifiScanDB)
-        .filter(
-            WifiScanDB.scan_point_id == point_id,
-            WifiScanDB.received_at >= cutoff,
-        )
-        .order_by(WifiScanDB.received_at)
-        .all()
-    )
-
-    # Build buckets: index 0 = oldest, index (n_buckets-1) = most recent
-    buckets: dict[int, dict] = {
-        i: {"label": _bucket_label(i), "count": 0, "rssi_sum": 0.0, "rssi_n": 0}
-        for i in range(n_buckets)
-    }
-
-    for row in rows:
-        ts = row.received_at
-        if ts.tzinfo is None:
-            ts = ts.replace(tzinfo=timezone.utc)
-        delta_minutes = (now - ts).total_seconds() / 60
-        # Which bucket does this row fall into?
-        # Bucket 0 = [total_minutes ago, total_minutes-bucket_minutes ago)
-        bucket_index = int((total_minutes - delta_minutes) / bucket_minutes)
-        if 0 <= bucket_index < n_buckets:
-            buckets[bucket_index]["count"] += 1
-            if row.rssi is not None:
-                buckets[bucket_index]["rssi_sum"] += row.rssi
-                buckets[bucket_index]["rssi_n"]   += 1
+    now = datetime.now(timezone.utc)
+
+    if from_ is not None or to is not None or bucket is not None:
+        if from_ is None:
+            raise HTTPException(status_code=400, detail="from is required for a custom window")
+        lo = from_ if from_.tzinfo else from_.replace(tzinfo=timezone.utc)
+        hi = (to if to.tzinfo else to.replace(tzinfo=timezone.utc)) if to is not None else now
+        if hi <= lo:
+            raise HTTPException(status_code=400, detail="from must be before to")
+        minutes = (hi - lo) / timedelta(minutes=1)
+        bucket_minutes = bucket or _bucket_minutes_for(minutes, HISTORY_TARGET_BUCKETS)
+        start, n_buckets = rollups.window_between(lo, hi, bucket_minutes)
+        if n_buckets > HISTORY_MAX_BUCKETS:
+            raise HTTPException(status_code=400,
+                                detail=f"{n_buckets} buckets requested; use a larger bucket (max {HISTORY_MAX_BUCKETS})")
+        step = timedelta(minutes=bucket_minutes)
+        range_name = "custom"
+
+        def _bucket_label(bucket_index: int) -> str:
+            return (start + bucket_index * step).strftime("%d %b %H:%M")
+    else:
+        cfg            = RANGE_CONFIG[time_range]
+        bucket_minutes = cfg["bucket_minutes"]
+        n_buckets      = cfg["n_buckets"]
+        # index 0 = oldest, index (n_buckets-1) = the period in progress
+        start, step    = rollups.window(now, bucket_minutes, n_buckets)
+        range_name     = time_range
+
+        def _bucket_label(bucket_index: int) -> str:
+            """Human-readable label for the oldest end of this bucket."""
+            periods_ago = n_buckets - 1 - bucket_index
+            minutes_ago = periods_ago * bucket_minutes
+            if bucket_minutes < 60:
+                return f"{minutes_ago}m"
+            elif bucket_minutes < 1440:
+                return f"{minutes_ago // 60}h"
+            else:
+                return f"{minutes_ago // 1440}d"
+
+    buckets = archive.read_buckets(db, point_id, start, bucket_minutes, n_buckets,
+                                   ("wifi_count", "rssi_n", "rssi_sum"))
 
     result = []
     for i in range(n_buckets):
         b = buckets[i]
         avg_rssi = round(b["rssi_sum"] / b["rssi_n"], 1) if b["rssi_n"] > 0 else None
         result.append({
-            "label":        b["label"],
-            "bucket_start": _bucket_start_iso(i),   # ISO UTC timestamp for this bucket
-            "count":        b["count"],
+            "label":        _bucket_label(i),
+            "bucket_start": (start + i * step).isoformat(),   # ISO UTC timestamp for this bucket
+            "count":        b["wifi_count"],
             "avg_rssi":     avg_rssi,
             "level":        _signal_level(avg_rssi),
         })
 
-    return {
+    response = {
         "scan_point_id": point_id,
         "label":         point.label,
-        "range":         time_range,
+        "range":         range_name,
         "bucket_minutes": bucket_minutes,
         "n_buckets":     n_buckets,
         "total_scans":   sum(b["count"] for b in result),
         "buckets":       result,
     }
+    if range_name == "custom":
+        response["from"] = start.isoformat()
+        response["to"]   = (start + n_buckets * step).isoformat()
+    return response
+
+
 
+# time_range → (bucket minutes, number of buckets) for the sensor history endpoints
+SENSOR_HISTORY_BUCKETS = {
+    "1h":  (1,   60),
+    "6h":  (5,   72),
+    "24h": (15,  96),
+    "7d":  (60,  168),
+    "30d": (360, 120),
+}
+SENSOR_HISTORY_MAX_POINTS = 5000
+
+
+def _sensor_history(db: Session, point_id: int, time_range: str, columns,
+                    max_points: Optional[int] = None, method: str = "envelope", series=()):
+    """
+    (bucket_minutes, [(bucket_start, rollup columns)] oldest first) for a sensor history window.
+    With max_points: at most that many buckets — wider or narrower ones (envelope), or
+    1-minute buckets picked by LTTB on the averages in series (see downsample.py).
+    """
+    bucket_minutes, n_buckets = SENSOR_HISTORY_BUCKETS[time_range]
+    now = datetime.now(timezone.utc)
+    if max_points and method == "lttb":
+        start, step = rollups.window(now, bucket_minutes, n_buckets)
+        return 1, downsample.lttb_minutes(db, point_id, start, start + n_buckets * step,
+                                          series, columns, max_points)
+    if max_points:
+        total_minutes  = bucket_minutes * n_buckets
+        bucket_minutes = _bucket_minutes_for(total_minutes, max_points)
+        n_buckets      = math.ceil(total_minutes / bucket_minutes)
+    start, step = rollups.window(now, bucket_minutes, n_buckets)
+    buckets = archive.read_buckets(db, point_id, start, bucket_minutes, n_buckets, columns)
+    return bucket_minutes, [(start + i * step, buckets[i]) for i in sorted(buckets)]
 
 
 @app.get("/scan-points/{point_id}/dht22-history")
 def get_dht22_history(
     point_id: int,
     time_range: str = Query(default="24h", pattern="^(1h|6h|24h|7d|30d)$"),
+    max_points: Optional[int] = Query(default=None, ge=3, le=SENSOR_HISTORY_MAX_POINTS),
+    method: str = Query(default="envelope", alias="downsample", pattern="^(envelope|lttb)$"),
     db: Session = Depends(get_db),
 ):
     """
-    Returns recent temperature and humidity readings for a scan point.
+    Returns temperature and humidity history for a scan point.
 
     time_range: 1h | 6h | 24h | 7d | 30d
-    Each reading: received_at (ISO UTC), temperature_c (°C), humidity_pct (%)
+    One reading per bucket of bucket_minutes that has data (see SENSOR_HISTORY_BUCKETS),
+    read from the rollup tables:
+      received_at (ISO UTC, bucket start), temperature_c (°C), humidity_pct (%) — averages,
+      temperature_min/max, humidity_min/max, samples (readings in the bucket)
+
+    max_points caps the number of readings (see downsample.py):
+      downsample=envelope  buckets widened (or narrowed) to fit — min/avg/max per bucket
+      downsample=lttb      the 1-minute averages that keep the curves' shape (LTTB
+                           on temperature and humidity); bucket_minutes is then 1
     """
     point = db.get(ScanPointDB, point_id)
     if not point:
         raise HTTPException(status_code=404, detail="Scan point not found")
 
-    from datetime import datetime, timedelta, timezone
+    bucket_minutes, buckets = _sensor_history(db, point_id, time_range,
+        ("dht_count", "temp_sum", "temp_min", "temp_max", "hum_sum", "hum_min", "hum_max"),
+        max_points, method, (("temp_sum", "dht_count"), ("hum_sum", "dht_count")))
+    readings = [
+        {
+            "received_at":     bucket_start.isoformat(),
+            "temperature_c":   round(b["temp_sum"] / b["dht_count"], 2),
+            "humidity_pct":    round(b["hum_sum"] / b["dht_count"], 2),
+            "temperature_min": b["temp_min"],
+            "temperature_max": b["temp_max"],
+            "humidity_min":    b["hum_min"],
+            "humidity_max":    b["hum_max"],
+            "samples":         b["dht_count"],
+        }
+        for bucket_start, b in buckets if b["dht_count"]
+    ]
 
-    RANGE_MINUTES = {"1h": 60, "6h": 360, "24h": 1440, "7d": 10080, "30d": 43200}
-    cutoff = datetime.now(timezone.utc) - timedelta(minutes=RANGE_MINUTES[time_range])
+    return {
+        "scan_point_id":  point_id,
+        "time_range":     time_range,
+        "bucket_minutes": bucket_minutes,
+        "downsample":     method if max_points else None,
+        "count":          len(readings),
+        "readings":       readings,
+    }
 
-    rows = (
-        db.query(Dht22ReadingDB)
-        .filter(
-            Dht22ReadingDB.scan_point_id == point_id,
-            Dht22ReadingDB.received_at   >= cutoff,
-        )
-        .order_by(Dht22ReadingDB.received_at.asc())
+
+def _scan_counts(db: Session, point_ids: List[int]) -> Dict[int, int]:
+    """{scan point id: WiFi scans recorded there} — scan_point_state's running totals, one query."""
+    if not point_ids:
+        return {}
+    return dict(
+        db.query(ScanPointStateDB.scan_point_id, ScanPointStateDB.wifi_count)
+        .filter(ScanPointStateDB.scan_point_id.in_(point_ids))
         .all()
     )
 
-    return {
-        "scan_point_id": point_id,
-        "time_range":    time_range,
-        "count":         len(rows),
-        "readings": [
-            {
-                "received_at":   r.received_at.isoformat(),
-                "temperature_c": r.temperature_c,
-                "humidity_pct":  r.humidity_pct,
-            }
-            for r in rows
-        ],
-    }
-
 
-def _format_point(point: ScanPointDB, db: Session) -> dict:
+def _format_point(point: ScanPointDB, scan_counts: Optional[Dict[int, int]] = None) -> dict:
     """Helper — serialise a ScanPointDB row.
     assigned_node lives directly on scan_point now — no join needed.
+    scan_count is included when scan_counts (see _scan_counts) is given.
     """
-    scan_count = db.query(func.count(WifiScanDB.id)).filter(
-        WifiScanDB.scan_point_id == point.id
-    ).scalar() or 0
-
-    return {
+    result = {
         "id": point.id,
         "floorplan_id": point.floorplan_id,
         "x": point.x,
@@ -496,10 +930,12 @@ def _format_point(point: ScanPointDB, db: Session) -> dict:
         "label": point.label,
         "created_at": point.created_at,
         "assigned_at": point.assigned_at,
-        "scan_count": scan_count,
         "assigned_node": point.assigned_node,
         "is_active": point.assigned_node is not None,
     }
+    if scan_counts is not None:
+        result["scan_count"] = scan_counts.get(point.id, 0)
+    return result
 
 
 # ── Device Management ────────────────────────────────────────────────────────
@@ -558,6 +994,7 @@ def assign_point_to_device(
     point.assigned_node = node
     point.assigned_at   = func.now()
     db.commit()
+    assignment_cache.invalidate()
     db.refresh(point)
 
     return {
@@ -579,6 +1016,7 @@ def clear_point_from_device(node: str, db: Session = Depends(get_db)):
     point.assigned_node = None
     point.assigned_at   = None
     db.commit()
+    assignment_cache.invalidate()
     return {"node": node, "scan_point_id": None, "message": "Device unassigned"}
 
 @app.get("/devices/known")
@@ -597,14 +1035,17 @@ def list_known_nodes(db: Session = Depends(get_db)):
         .filter(ScanPointDB.assigned_node.isnot(None))
         .all()
     }
-    # Nodes seen in wifi_scan
-    scanned = {
-        row.node
-        for row in db.query(WifiScanDB.node)
-        .filter(WifiScanDB.node.isnot(None))
-        .distinct()
-        .all()
-    }
+    # Nodes seen in wifi_scan — a "skip scan" of the node index: one index
+    # probe per distinct node instead of reading every scan row.
+    scanned = set(db.execute(text("""
+        WITH RECURSIVE nodes(node) AS (
+            SELECT min(node) FROM wifi_scan
+            UNION ALL
+            SELECT (SELECT min(node) FROM wifi_scan WHERE node > nodes.node)
+            FROM nodes WHERE nodes.node IS NOT NULL
+        )
+        SELECT node FROM nodes WHERE node IS NOT NULL
+    """)).scalars())
     all_nodes = sorted(assigned | scanned)
     return {"nodes": all_nodes}
 
@@ -676,6 +1117,7 @@ def delete_building(building_id: int, db: Session = Depends(get_db)):
 
     db.delete(building)
     db.commit()
+    assignment_cache.invalidate()
     return {"message": f"Building '{building.name}' and all associated data deleted"}
 
 
@@ -732,7 +1174,8 @@ def delete_room(room_id: int, db: Session = Depends(get_db)):
 
 @app.get("/wifi/rawScans")
 def list_raw_scans(limit: int = Query(25, ge=1, le=1000), db: Session = Depends(get_db)):
-    rows = db.query(WifiScanDB).order_by(WifiScanDB.id.desc()).limit(limit).all()
+    # Newest by received_at (the partition key): only the latest partitions are read.
+    rows = db.query(WifiScanDB).order_by(WifiScanDB.received_at.desc(), WifiScanDB.id.desc()).limit(limit).all()
     return {
         "rows": [
             {
@@ -756,7 +1199,7 @@ def list_raw_scans(limit: int = Query(25, ge=1, le=1000), db: Session = Depends(
 
 @app.get("/dht22/tempHumidityHistory")
 def list_dht22_raw_scans(limit: int = Query(25, ge=1, le=1000), db: Session = Depends(get_db)):
-    rows = db.query(Dht22ReadingDB).order_by(Dht22ReadingDB.id.desc()).limit(limit).all()
+    rows = db.query(Dht22ReadingDB).order_by(Dht22ReadingDB.received_at.desc(), Dht22ReadingDB.id.desc()).limit(limit).all()
     return {
         "rows": [
             {
@@ -780,7 +1223,7 @@ def list_mq135_raw_scans(limit: int = Query(25, ge=1, le=1000), db: Session = De
     """Returns most recent MQ-135 readings across all scan points.
     Mirrors /wifi/rawScans and /dht22/tempHumidityHistory — used in the admin raw data view.
     """
-    rows = db.query(Mq135ReadingDB).order_by(Mq135ReadingDB.id.desc()).limit(limit).all()
+    rows = db.query(Mq135ReadingDB).order_by(Mq135ReadingDB.received_at.desc(), Mq135ReadingDB.id.desc()).limit(limit).all()
     return {
         "rows": [
             {
@@ -803,90 +1246,95 @@ def list_mq135_raw_scans(limit: int = Query(25, ge=1, le=1000), db: Session = De
 def get_mq135_history(
     point_id: int,
     time_range: str = Query(default="24h", pattern="^(1h|6h|24h|7d|30d)$"),
+    max_points: Optional[int] = Query(default=None, ge=3, le=SENSOR_HISTORY_MAX_POINTS),
+    method: str = Query(default="envelope", alias="downsample", pattern="^(envelope|lttb)$"),
     db: Session = Depends(get_db),
 ):
-    """Returns recent MQ-135 air quality readings for a specific scan point.
-    Same pattern as /scan-points/{id}/dht22-history.
+    """Returns MQ-135 air quality history for a specific scan point.
+    Same pattern as /scan-points/{id}/dht22-history: one reading per bucket,
+    ppm / raw_value averaged, plus ppm_min, ppm_max and samples.
     time_range: 1h | 6h | 24h | 7d | 30d
+    max_points / downsample as for dht22-history (lttb on ppm).
     """
     point = db.get(ScanPointDB, point_id)
     if not point:
         raise HTTPException(status_code=404, detail="Scan point not found")
 
-    from datetime import timedelta
-    RANGE_MINUTES = {"1h": 60, "6h": 360, "24h": 1440, "7d": 10080, "30d": 43200}
-    cutoff = datetime.now(timezone.utc) - timedelta(minutes=RANGE_MINUTES[time_range])
-
-    rows = (
-        db.query(Mq135ReadingDB)
-        .filter(
-            Mq135ReadingDB.scan_point_id == point_id,
-            Mq135ReadingDB.received_at   >= cutoff,
-        )
-        .order_by(Mq135ReadingDB.received_at.asc())
-        .all()
-    )
+    bucket_minutes, buckets = _sensor_history(db, point_id, time_range,
+        ("mq_count", "ppm_sum", "ppm_min", "ppm_max", "raw_n", "raw_sum"),
+        max_points, method, (("ppm_sum", "mq_count"),))
+    readings = [
+        {
+            "received_at": bucket_start.isoformat(),
+            "ppm":         round(b["ppm_sum"] / b["mq_count"], 2),
+            "raw_value":   round(b["raw_sum"] / b["raw_n"]) if b["raw_n"] else None,
+            "ppm_min":     b["ppm_min"],
+            "ppm_max":     b["ppm_max"],
+            "samples":     b["mq_count"],
+        }
+        for bucket_start, b in buckets if b["mq_count"]
+    ]
 
     return {
-        "scan_point_id": point_id,
-        "time_range":    time_range,
-        "count":         len(rows),
-        "readings": [
-            {
-                "received_at": r.received_at.isoformat(),
-                "ppm":         r.ppm,
-                "raw_value":   r.raw_value,
-            }
-            for r in rows
-        ],
+        "scan_point_id":  point_id,
+        "time_range":     time_range,
+        "bucket_minutes": bucket_minutes,
+        "downsample":     method if max_points else None,
+        "count":          len(readings),
+        "readings":       readings,
     }
 
 
 @app.get("/heatmap/floorplan/{floorplan_id}/mq135")
 def get_mq135_heatmap(floorplan_id: int, db: Session = Depends(get_db)):
     """Returns latest MQ-135 reading per scan point for the air quality heatmap mode.
-    Same pattern as /heatmap/floorplan/{id}/dht22.
+    Same pattern as /heatmap/floorplan/{id}/dht22 — read from scan_point_state.
     air_level: good | moderate | poor — thresholds adjusted for 3.3V operation.
     """
     if not db.get(FloorPlanDB, floorplan_id):
         raise HTTPException(status_code=404, detail="Floor plan not found")
 
-    def _air_level(raw):
-        # Thresholds adjusted for 3.3V power supply (sensor calibrated for 5V).
-        # New sensor burn-in and 3.3V power shift values upward vs true PPM.
-        if raw is None:       return None
-        if raw < 2000:        return "good"
-        if raw < 2800:        return "moderate"
-        return "poor"
+    return [_mq135_point(row) for row in _floorplan_state(db, [floorplan_id], *_MQ135_STATE)]
 
-    points = (
-        db.query(ScanPointDB)
-        .filter(ScanPointDB.floorplan_id == floorplan_id)
-        .all()
-    )
 
-    result = []
-    for pt in points:
-        # Get most recent MQ-135 reading for this scan point
-        latest = (
-            db.query(Mq135ReadingDB)
-            .filter(Mq135ReadingDB.scan_point_id == pt.id)
-            .order_by(Mq135ReadingDB.received_at.desc())
-            .first()
-        )
-        result.append({
-            "scan_point_id": pt.id,
-            "label":         pt.label or f"Point {pt.id}",
-            "x":             pt.x,
-            "y":             pt.y,
-            "assigned_node": pt.assigned_node,
-            "ppm":           latest.ppm       if latest else None,
-            "raw_value":     latest.raw_value if latest else None,
-            "air_level":     _air_level(latest.raw_value if latest else None),
-            "received_at":   latest.received_at.isoformat() if latest else None,
-        })
+@app.get("/heatmap/mq135")
+def get_mq135_heatmap_many(
+    floorplan_id: List[int] = Query(..., description="repeat for each floor plan"),
+    db: Session = Depends(get_db),
+):
+    """Latest MQ-135 reading per scan point of several floor plans in one query,
+    e.g. every floor of a building: ?floorplan_id=1&floorplan_id=2.
+    Same points as /heatmap/floorplan/{id}/mq135, each with its floorplan_id,
+    ordered by floor plan then point.
+    """
+    floorplan_ids = sorted(set(floorplan_id))
+    found = {fp_id for (fp_id,) in db.query(FloorPlanDB.id).filter(FloorPlanDB.id.in_(floorplan_ids))}
+    missing = [fp_id for fp_id in floorplan_ids if fp_id not in found]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Floor plan not found: {', '.join(map(str, missing))}")
+
+    return [
+        {"floorplan_id": row.floorplan_id, **_mq135_point(row)}
+        for row in _floorplan_state(db, floorplan_ids, *_MQ135_STATE)
+    ]
 
-    return result
+
+_MQ135_STATE = (ScanPointStateDB.ppm, ScanPointStateDB.raw_value, ScanPointStateDB.mq_at)
+
+
+def _mq135_point(row) -> dict:
+    """One MQ-135 heatmap entry from a _floorplan_state() row."""
+    return {
+        "scan_point_id": row.id,
+        "label":         row.label or f"Point {row.id}",
+        "x":             row.x,
+        "y":             row.y,
+        "assigned_node": row.assigned_node,
+        "ppm":           row.ppm,
+        "raw_value":     row.raw_value,
+        "air_level":     _air_level(row.raw_value),
+        "received_at":   row.mq_at.isoformat() if row.mq_at else None,
+    }
 
 
 # ── Floor Plans ───────────────────────────────────────────────────────────────
@@ -986,6 +1434,7 @@ def delete_floorplan(floorplan_id: int, db: Session = Depends(get_db)):
 
     db.delete(fp)
     db.commit()
+    assignment_cache.invalidate()
     return {"message": f"Floor plan '{fp.floor_name}' and all associated data deleted"}
 
 
@@ -1033,6 +1482,49 @@ def _signal_level(avg_rssi: Optional[float]) -> Optional[str]:
     return "weak"
 
 
+def _air_level(raw: Optional[int]) -> Optional[str]:
+    # Thresholds adjusted for 3.3V power supply (sensor calibrated for 5V).
+    # New sensor burn-in and 3.3V power shift values upward vs true PPM.
+    if raw is None:       return None
+    if raw < 2000:        return "good"
+    if raw < 2800:        return "moderate"
+    return "poor"
+
+
+def _temp_level(t: Optional[float]) -> Optional[str]:
+    # Thresholds adjusted for Irish indoor environment
+    # Cool: below 16°C (cold room, poor heating)
+    # Comfortable: 16–21°C (typical Irish indoor range)
+    # Warm: above 21°C (well heated or warm day)
+    if t is None: return None
+    if t < 16:    return "cool"
+    if t < 21:    return "warm"
+    return "hot"
+
+
+def _humidity_level(h: Optional[float]) -> Optional[str]:
+    if h is None: return None
+    if h < 30:    return "low"
+    if h < 60:    return "medium"
+    return "high"
+
+
+def _floorplan_state(db: Session, floorplan_ids: List[int], *columns):
+    """
+    Every scan point on the given floor plans with the given scan_point_state
+    columns — one row per point, null columns for points that have no readings
+    yet, ordered by floor plan then point.
+    """
+    return (
+        db.query(ScanPointDB.id, ScanPointDB.floorplan_id, ScanPointDB.label, ScanPointDB.x, ScanPointDB.y,
+                 ScanPointDB.assigned_node, *columns)
+        .outerjoin(ScanPointStateDB, ScanPointStateDB.scan_point_id == ScanPointDB.id)
+        .filter(ScanPointDB.floorplan_id.in_(floorplan_ids))
+        .order_by(ScanPointDB.floorplan_id, ScanPointDB.id)
+        .all()
+    )
+
+
 @app.get("/heatmap/floorplan/{floorplan_id}/dht22")
 def get_floorplan_dht22_heatmap(floorplan_id: int, db: Session = Depends(get_db)):
     """
@@ -1044,58 +1536,15 @@ def get_floorplan_dht22_heatmap(floorplan_id: int, db: Session = Depends(get_db)
 
     Points with no DHT22 data are still returned so the frontend knows where
     they are — just with null temperature_c / humidity_pct.
+
+    The latest reading is kept in scan_point_state by ingest, so this reads
+    one row per point, not the dht22_reading history.
     """
     if not db.get(FloorPlanDB, floorplan_id):
         raise HTTPException(status_code=404, detail="Floor plan not found")
 
-    # Subquery: find the most recent received_at per scan_point_id
-    from sqlalchemy import select as sa_select
-    latest_subq = (
-        db.query(
-            Dht22ReadingDB.scan_point_id,
-            func.max(Dht22ReadingDB.received_at).label("max_received_at"),
-        )
-        .group_by(Dht22ReadingDB.scan_point_id)
-        .subquery()
-    )
-
-    # Join scan_points for this floor plan with their latest dht22 reading
-    result = (
-        db.query(
-            ScanPointDB.id,
-            ScanPointDB.label,
-            ScanPointDB.x,
-            ScanPointDB.y,
-            ScanPointDB.assigned_node,
-            Dht22ReadingDB.temperature_c,
-            Dht22ReadingDB.humidity_pct,
-            Dht22ReadingDB.received_at,
-        )
-        .outerjoin(latest_subq, latest_subq.c.scan_point_id == ScanPointDB.id)
-        .outerjoin(
-            Dht22ReadingDB,
-            (Dht22ReadingDB.scan_point_id == ScanPointDB.id) &
-            (Dht22ReadingDB.received_at == latest_subq.c.max_received_at),
-        )
-        .filter(ScanPointDB.floorplan_id == floorplan_id)
-        .all()
-    )
-
-    def _temp_level(t):
-        # Thresholds adjusted for Irish indoor environment
-        # Cool: below 16°C (cold room, poor heating)
-        # Comfortable: 16–21°C (typical Irish indoor range)
-        # Warm: above 21°C (well heated or warm day)
-        if t is None: return None
-        if t < 16:    return "cool"
-        if t < 21:    return "warm"
-        return "hot"
-
-    def _humidity_level(h):
-        if h is None: return None
-        if h < 30:    return "low"
-        if h < 60:    return "medium"
-        return "high"
+    result = _floorplan_state(db, [floorplan_id], ScanPointStateDB.temperature_c,
+                              ScanPointStateDB.humidity_pct, ScanPointStateDB.dht_at)
 
     return [
         {
@@ -1108,7 +1557,7 @@ def get_floorplan_dht22_heatmap(floorplan_id: int, db: Session = Depends(get_db)
             "humidity_pct":  row.humidity_pct,
             "temp_level":    _temp_level(row.temperature_c),
             "humidity_level":_humidity_level(row.humidity_pct),
-            "received_at":   row.received_at.isoformat() if row.received_at else None,
+            "received_at":   row.dht_at.isoformat() if row.dht_at else None,
         }
         for row in result
     ]
@@ -1119,27 +1568,17 @@ def get_floorplan_heatmap(floorplan_id: int, db: Session = Depends(get_db)):
     """
     Returns one HeatmapPoint per scan_point on this floor plan.
     Each point has its (x, y) coordinate and aggregated signal data.
-    No session_id needed — queries wifi_scan directly via scan_point_id.
+    No session_id needed — the running wifi_scan totals per scan point are
+    kept in scan_point_state by ingest.
     """
     if not db.get(FloorPlanDB, floorplan_id):
         raise HTTPException(status_code=404, detail="Floor plan not found")
 
-    result = (
-        db.query(
-            ScanPointDB.id,
-            ScanPointDB.label,
-            ScanPointDB.x,
-            ScanPointDB.y,
-            ScanPointDB.assigned_node,
-            func.avg(WifiScanDB.rssi).label("avg_rssi"),
-            func.count(WifiScanDB.id).label("samples"),
-            func.max(WifiScanDB.received_at).label("last_scan_at"),
-        )
-        .outerjoin(WifiScanDB, WifiScanDB.scan_point_id == ScanPointDB.id)
-        .filter(ScanPointDB.floorplan_id == floorplan_id)
-        .group_by(ScanPointDB.id, ScanPointDB.label, ScanPointDB.x, ScanPointDB.y, ScanPointDB.assigned_node)
-        .all()
-    )
+    result = _floorplan_state(db, [floorplan_id], ScanPointStateDB.wifi_count, ScanPointStateDB.rssi_n,
+                              ScanPointStateDB.rssi_sum, ScanPointStateDB.last_scan_at)
+
+    def _avg_rssi(row) -> Optional[float]:
+        return row.rssi_sum / row.rssi_n if row.rssi_n else None
 
     return [
         HeatmapPoint(
@@ -1147,15 +1586,103 @@ def get_floorplan_heatmap(floorplan_id: int, db: Session = Depends(get_db)):
             room_name=row.label or f"Point {row.id}",
             x=row.x,
             y=row.y,
-            avg_rssi=float(row.avg_rssi) if row.avg_rssi else None,
-            level=_signal_level(float(row.avg_rssi) if row.avg_rssi else None),
-            samples=row.samples or 0,
+            avg_rssi=_avg_rssi(row),
+            level=_signal_level(_avg_rssi(row)),
+            samples=row.wifi_count or 0,
             assigned_node=row.assigned_node,
             last_scan_at=row.last_scan_at.isoformat() if row.last_scan_at else None,
         )
         for row in result
     ]
 
+
+def _iso(t: Optional[datetime]) -> Optional[str]:
+    return t.isoformat() if t else None
+
+
+# layer → (scan_point_state columns, row → layer fields) for the combined heatmap
+HEATMAP_LAYERS = {
+    "wifi": (
+        (ScanPointStateDB.wifi_count, ScanPointStateDB.rssi_n, ScanPointStateDB.rssi_sum,
+         ScanPointStateDB.last_scan_at),
+        lambda row, avg: {
+            "avg_rssi":     avg,
+            "level":        _signal_level(avg),
+            "samples":      row.wifi_count or 0,
+            "last_scan_at": _iso(row.last_scan_at),
+        },
+    ),
+    "temperature": (
+        (ScanPointStateDB.temperature_c, ScanPointStateDB.dht_at),
+        lambda row, avg: {
+            "temperature_c": row.temperature_c,
+            "temp_level":    _temp_level(row.temperature_c),
+            "received_at":   _iso(row.dht_at),
+        },
+    ),
+    "humidity": (
+        (ScanPointStateDB.humidity_pct, ScanPointStateDB.dht_at),
+        lambda row, avg: {
+            "humidity_pct":   row.humidity_pct,
+            "humidity_level": _humidity_level(row.humidity_pct),
+            "received_at":    _iso(row.dht_at),
+        },
+    ),
+    "air": (
+        _MQ135_STATE,
+        lambda row, avg: {
+            "ppm":         row.ppm,
+            "raw_value":   row.raw_value,
+            "air_level":   _air_level(row.raw_value),
+            "received_at": _iso(row.mq_at),
+        },
+    ),
+}
+_LAYER_LIST = "(wifi|temperature|humidity|air)"
+
+
+@app.get("/heatmap/floorplan/{floorplan_id}/combined")
+def get_floorplan_combined_heatmap(
+    floorplan_id: int,
+    layers: str = Query(default="wifi,temperature,humidity,air", pattern=f"^{_LAYER_LIST}(,{_LAYER_LIST})*$"),
+    db: Session = Depends(get_db),
+):
+    """
+    Every layer of the floor plan heatmap in one response — what
+    /heatmap/floorplan/{id}, /dht22 and /mq135 return, from a single query on
+    scan_point_state.
+
+    layers: comma-separated subset of wifi, temperature, humidity, air (default
+    all).  Each point has scan_point_id, label, x, y, assigned_node and one
+    object per requested layer:
+      wifi        : avg_rssi, level, samples, last_scan_at
+      temperature : temperature_c, temp_level, received_at
+      humidity    : humidity_pct, humidity_level, received_at
+      air         : ppm, raw_value, air_level, received_at
+    """
+    wanted = [layer for layer in HEATMAP_LAYERS if layer in layers.split(",")]
+    columns = list(dict.fromkeys(c for layer in wanted for c in HEATMAP_LAYERS[layer][0]))
+    rows = _floorplan_state(db, [floorplan_id], *columns)
+    # The floor plan itself is only looked up when it has no points.
+    if not rows and not db.get(FloorPlanDB, floorplan_id):
+        raise HTTPException(status_code=404, detail="Floor plan not found")
+
+    def _point(row) -> dict:
+        avg = row.rssi_sum / row.rssi_n if "wifi" in wanted and row.rssi_n else None
+        point = {
+            "scan_point_id": row.id,
+            "label":         row.label or f"Point {row.id}",
+            "x":             row.x,
+            "y":             row.y,
+            "assigned_node": row.assigned_node,
+        }
+        for layer in wanted:
+            point[layer] = HEATMAP_LAYERS[layer][1](row, avg)
+        return point
+
+    return {"floorplan_id": floorplan_id, "layers": wanted, "points": [_point(row) for row in rows]}
+
+
 # ── Server-Sent Events — real-time heatmap updates ───────────────────────────
 #
 # GET /events/floorplan/{id}/heatmap
@@ -1177,25 +1704,14 @@ def _latest_ingest_ts(floorplan_id: int):
     """
     db = SessionLocal()
     try:
-        wifi_ts = (
-            db.query(func.max(WifiScanDB.received_at))
-            .join(ScanPointDB, WifiScanDB.scan_point_id == ScanPointDB.id)
-            .filter(ScanPointDB.floorplan_id == floorplan_id)
-            .scalar()
-        )
-        dht_ts = (
-            db.query(func.max(Dht22ReadingDB.received_at))
-            .join(ScanPointDB, Dht22ReadingDB.scan_point_id == ScanPointDB.id)
-            .filter(ScanPointDB.floorplan_id == floorplan_id)
-            .scalar()
-        )
-        mq_ts = (
-            db.query(func.max(Mq135ReadingDB.received_at))
-            .join(ScanPointDB, Mq135ReadingDB.scan_point_id == ScanPointDB.id)
+        row = (
+            db.query(func.max(ScanPointStateDB.last_scan_at), func.max(ScanPointStateDB.dht_at),
+                     func.max(ScanPointStateDB.mq_at))
+            .join(ScanPointDB, ScanPointStateDB.scan_point_id == ScanPointDB.id)
             .filter(ScanPointDB.floorplan_id == floorplan_id)
-            .scalar()
+            .one()
         )
-        candidates = [t for t in [wifi_ts, dht_ts, mq_ts] if t is not None]
+        candidates = [t for t in row if t is not None]
         return max(candidates) if candidates else None
     finally:
         db.close()
@@ -1211,6 +1727,7 @@ def get_alerts(db: Session = Depends(get_db)):
       - low_humidity     : floor average humidity below 30%
       - poor_signal      : >50% of scan points have "weak" or "low" WiFi signal
     Severity escalates to "critical" when >75% of points are affected.
+    Reads scan_point_state (one row per point), not the reading tables.
     """
     HUMIDITY_HIGH        = 70.0
     HUMIDITY_LOW         = 30.0
@@ -1241,65 +1758,31 @@ def get_alerts(db: Session = Depends(get_db)):
     if not all_sp_ids:
         return {"alerts": []}
 
-    # ── Latest MQ-135 air_level per scan point ────────────────────────────────
-    mq_ts_subq = (
-        db.query(
-            Mq135ReadingDB.scan_point_id,
-            func.max(Mq135ReadingDB.received_at).label("max_ts"),
-        )
-        .filter(Mq135ReadingDB.scan_point_id.in_(all_sp_ids))
-        .group_by(Mq135ReadingDB.scan_point_id)
-        .subquery()
-    )
-    mq_rows = (
-        db.query(Mq135ReadingDB.scan_point_id, Mq135ReadingDB.air_level)
-        .join(mq_ts_subq,
-              (Mq135ReadingDB.scan_point_id == mq_ts_subq.c.scan_point_id) &
-              (Mq135ReadingDB.received_at   == mq_ts_subq.c.max_ts))
-        .all()
-    )
-    sp_air: dict[int, str] = {r.scan_point_id: r.air_level for r in mq_rows if r.air_level}
-
-    # ── Latest DHT22 humidity per scan point ──────────────────────────────────
-    dht_ts_subq = (
-        db.query(
-            Dht22ReadingDB.scan_point_id,
-            func.max(Dht22ReadingDB.received_at).label("max_ts"),
-        )
-        .filter(Dht22ReadingDB.scan_point_id.in_(all_sp_ids))
-        .group_by(Dht22ReadingDB.scan_point_id)
-        .subquery()
-    )
-    dht_rows = (
-        db.query(Dht22ReadingDB.scan_point_id, Dht22ReadingDB.humidity_pct)
-        .join(dht_ts_subq,
-              (Dht22ReadingDB.scan_point_id == dht_ts_subq.c.scan_point_id) &
-              (Dht22ReadingDB.received_at   == dht_ts_subq.c.max_ts))
+    # ── Latest readings per scan point (scan_point_state) ─────────────────────
+    state_rows = (
+        db.query(ScanPointStateDB.scan_point_id, ScanPointStateDB.raw_value,
+                 ScanPointStateDB.humidity_pct, ScanPointStateDB.rssi_n, ScanPointStateDB.rssi_sum)
+        .filter(ScanPointStateDB.scan_point_id.in_(all_sp_ids))
         .all()
     )
+    sp_air: dict[int, str] = {
+        r.scan_point_id: _air_level(r.raw_value)
+        for r in state_rows if r.raw_value is not None
+    }
     sp_hum: dict[int, float] = {
         r.scan_point_id: r.humidity_pct
-        for r in dht_rows if r.humidity_pct is not None
+        for r in state_rows if r.humidity_pct is not None
     }
 
     # ── Average RSSI → signal level per scan point ────────────────────────────
-    wifi_agg = (
-        db.query(
-            WifiScanDB.scan_point_id,
-            func.avg(WifiScanDB.rssi).label("avg_rssi"),
-        )
-        .filter(WifiScanDB.scan_point_id.in_(all_sp_ids))
-        .group_by(WifiScanDB.scan_point_id)
-        .all()
-    )
     def _rssi_level(rssi: float) -> str:
         if rssi >= -60: return "strong"
         if rssi >= -70: return "medium"
         if rssi >= -80: return "low"
         return "weak"
     sp_signal: dict[int, str] = {
-        r.scan_point_id: _rssi_level(float(r.avg_rssi))
-        for r in wifi_agg if r.avg_rssi is not None
+        r.scan_point_id: _rssi_level(r.rssi_sum / r.rssi_n)
+        for r in state_rows if r.rssi_n
     }
 
     # ── Compute per-floor alerts ───────────────────────────────────────────────
@@ -1355,15 +1838,21 @@ async def sse_heatmap_updates(floorplan_id: int):
     Clients should close and re-open the connection if they navigate away.
     """
     async def generate():
-        last_ts = None
+        last_mark = None
         while True:
             await asyncio.sleep(3)
             try:
-                latest = await asyncio.get_event_loop().run_in_executor(
-                    None, _latest_ingest_ts, floorplan_id
-                )
-                if latest is not None and latest != last_ts:
-                    last_ts = latest
+                if response_cache.running:
+                    # the watermarks the response cache polls anyway — no query per client
+                    latest = response_cache.last_ingest(floorplan_id)
+                    mark   = response_cache.floorplan_version(floorplan_id)
+                else:
+                    latest = await asyncio.get_event_loop().run_in_executor(
+                        None, _latest_ingest_ts, floorplan_id
+                    )
+                    mark   = latest
+                if latest is not None and mark != last_mark:
+                    last_mark = mark
                     payload = json.dumps({"ts": latest.isoformat()})
                     yield f"data: {payload}\n\n"
                 else:
@@ -0,0 +1,82 @@
+-- Migration 13: access_point dimension for wifi_scan
+--
+-- wifi_scan stored the ssid, bssid and enc strings of every scanned access
+-- point on every row.  They move to access_point — one row per distinct
+-- (bssid, ssid, enc), the BSSID as a 48-bit integer (see access_points.py) —
+-- and wifi_scan keeps an integer access_point_id.  rssi and channel become
+-- SMALLINT.  The view wifi_scan_v reads like the old table.
+--
+-- The type change rewrites every wifi_scan partition, which also gives back
+-- the space of the dropped columns.  Stop the API (and serial_to_postgres.py)
+-- while this runs: it holds an exclusive lock on wifi_scan throughout.
+-- rssi / channel values outside the SMALLINT range (never valid) become NULL.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS access_point (
+    id          SERIAL      PRIMARY KEY,
+    mac         BIGINT,
+    bssid_text  TEXT,
+    ssid        TEXT,
+    enc         TEXT,
+    first_seen  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS ix_access_point_mac ON access_point (mac);
+
+-- One access point per distinct (bssid, ssid, enc) already stored.
+CREATE TEMP TABLE ap_map ON COMMIT DROP AS
+SELECT ROW(bssid, ssid, enc)::text AS key, bssid, ssid, enc, min(received_at) AS first_seen,
+       NULL::integer AS id
+FROM wifi_scan
+GROUP BY bssid, ssid, enc;
+
+UPDATE ap_map SET id = nextval(pg_get_serial_sequence('access_point', 'id'));
+
+INSERT INTO access_point (id, mac, bssid_text, ssid, enc, first_seen)
+SELECT id,
+       CASE WHEN bssid ~ '^[0-9A-Fa-f]{2}([:-][0-9A-Fa-f]{2}){5}$'
+            THEN ('x' || lpad(regexp_replace(bssid, '[:-]', '', 'g'), 16, '0'))::bit(64)::bigint END,
+       CASE WHEN bssid ~ '^[0-9A-F]{2}(:[0-9A-F]{2}){5}$' THEN NULL ELSE bssid END,
+       ssid, enc, first_seen
+FROM ap_map;
+
+CREATE INDEX ON ap_map (key);
+ANALYZE ap_map;
+
+ALTER TABLE wifi_scan ADD COLUMN access_point_id INTEGER;
+
+UPDATE wifi_scan w SET access_point_id = m.id
+FROM ap_map m
+WHERE m.key = ROW(w.bssid, w.ssid, w.enc)::text;
+
+ALTER TABLE wifi_scan
+    DROP COLUMN ssid,
+    DROP COLUMN bssid,
+    DROP COLUMN enc,
+    ALTER COLUMN access_point_id SET NOT NULL,
+    ALTER COLUMN rssi    TYPE SMALLINT USING CASE WHEN rssi    BETWEEN -32768 AND 32767 THEN rssi    END,
+    ALTER COLUMN channel TYPE SMALLINT USING CASE WHEN channel BETWEEN -32768 AND 32767 THEN channel END,
+    ADD CONSTRAINT wifi_scan_access_point_id_fkey FOREIGN KEY (access_point_id) REFERENCES access_point (id);
+
+CREATE INDEX IF NOT EXISTS ix_wifi_scan_access_point_id ON wifi_scan (access_point_id);
+
+-- Same statement as models.WIFI_SCAN_VIEW.
+CREATE OR REPLACE VIEW wifi_scan_v AS
+SELECT w.id, w.received_at, w.node, w.device_ts_ms,
+       ap.ssid,
+       coalesce(ap.bssid_text,
+                upper(regexp_replace(lpad(to_hex(ap.mac), 12, '0'), '(..)(?!$)', '\1:', 'g'))) AS bssid,
+       w.rssi, w.channel, ap.enc, w.scan_point_id, w.room_id
+FROM wifi_scan w
+JOIN access_point ap ON ap.id = w.access_point_id;
+
+COMMIT;
+
+GRANT ALL PRIVILEGES ON TABLE access_point TO mssia_user;
+GRANT USAGE, SELECT ON SEQUENCE access_point_id_seq TO mssia_user;
+GRANT SELECT ON wifi_scan_v TO mssia_user;
+
+ANALYZE access_point;
+ANALYZE wifi_scan;
+
+SELECT 'Migration 13 complete: wifi_scan now references access_point.' AS result;
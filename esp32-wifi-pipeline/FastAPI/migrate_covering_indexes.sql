@@ -0,0 +1,40 @@
+-- Migration 14: composite covering indexes on the reading tables
+--
+-- Every per-point query on the raw tables filters on scan_point_id and
+-- orders or ranges on received_at:
+--
+--   wifi_scan       scan counts per point, scan_point_state rebuild
+--                   (count / sum of rssi per point), deletes by point
+--   dht22_reading   newest reading per point (scan_point_state rebuild)
+--   mq135_reading   newest reading per point — it had no index at all
+--
+-- Each gets one (scan_point_id, received_at [DESC, id DESC]) index that also
+-- INCLUDEs the values those queries read, so they are answered from the
+-- index alone.  The single-column scan_point_id indexes (and dht22's
+-- received_at index, a duplicate of the primary key's first column) are
+-- dropped.  New databases get the same indexes from models.py;
+-- test_query_plans.py checks the read endpoints' plans against them.
+--
+-- CREATE INDEX on a partitioned table cannot run CONCURRENTLY: it blocks
+-- writes to the table while each partition's index is built.  Run it when
+-- ingest is quiet (the spool keeps batches until the lock is released).
+
+CREATE INDEX IF NOT EXISTS ix_wifi_scan_point_time
+    ON wifi_scan (scan_point_id, received_at) INCLUDE (rssi);
+
+CREATE INDEX IF NOT EXISTS ix_dht22_reading_point_time
+    ON dht22_reading (scan_point_id, received_at DESC, id DESC) INCLUDE (temperature_c, humidity_pct);
+
+CREATE INDEX IF NOT EXISTS ix_mq135_reading_point_time
+    ON mq135_reading (scan_point_id, received_at DESC, id DESC) INCLUDE (ppm, raw_value);
+
+DROP INDEX IF EXISTS ix_wifi_scan_scan_point_id;
+DROP INDEX IF EXISTS ix_dht22_reading_scan_point_id;
+DROP INDEX IF EXISTS ix_dht22_reading_received_at;
+DROP INDEX IF EXISTS idx_mq135_scan_point_time;
+
+ANALYZE wifi_scan;
+ANALYZE dht22_reading;
+ANALYZE mq135_reading;
+
+SELECT 'Migration 14 complete: covering (scan_point_id, received_at) indexes created.' AS result;
@@ -0,0 +1,21 @@
+-- Migration 8: import_chunk table
+--
+-- Checkpoints for import_history.py (bulk import of old SQLite captures and
+-- JSONL payload logs).  Each loaded chunk is recorded in the same transaction
+-- as its COPY into wifi_scan / dht22_reading / mq135_reading, so an import
+-- that is interrupted can simply be run again: finished chunks are skipped.
+-- Safe to delete rows for a source to force it to be imported again.
+
+CREATE TABLE IF NOT EXISTS import_chunk (
+    source      TEXT        NOT NULL,
+    part        TEXT        NOT NULL,
+    start_pos   BIGINT      NOT NULL,
+    end_pos     BIGINT      NOT NULL,
+    rows        INTEGER     NOT NULL,
+    imported_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (source, part, start_pos)
+);
+
+GRANT ALL PRIVILEGES ON TABLE import_chunk TO mssia_user;
+
+SELECT 'Migration 8 complete: import_chunk table created.' AS result;
@@ -0,0 +1,19 @@
+-- Migration 7: ingest_batch table
+--
+-- Idempotency keys for ingest batches that have already been written.
+-- The on-disk spool (ingest_spool.py) claims a key here in the same transaction
+-- as the batch's wifi_scan / dht22_reading / mq135_reading rows, so replaying a
+-- spool segment twice never stores the readings twice.
+-- Small table (one row per batch, not per reading) — no unique index is needed
+-- on wifi_scan itself.
+
+CREATE TABLE IF NOT EXISTS ingest_batch (
+    batch_key   TEXT        PRIMARY KEY,
+    received_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_ingest_batch_received_at ON ingest_batch (received_at);
+
+GRANT ALL PRIVILEGES ON TABLE ingest_batch TO mssia_user;
+
+SELECT 'Migration 7 complete: ingest_batch table created.' AS result;
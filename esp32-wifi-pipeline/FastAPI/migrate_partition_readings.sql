@@ -0,0 +1,162 @@
+-- Migration 9: partition the reading tables by received_at
+--
+-- Turns wifi_scan (daily partitions), dht22_reading and mq135_reading (weekly
+-- partitions) into tables range-partitioned by received_at, so history,
+-- heatmap and alert queries that filter on time only read the partitions in
+-- their window.  New databases get this layout from models.py directly; this
+-- script converts an existing database, keeping every row, id, index and
+-- foreign key.
+--
+-- For each table that is not partitioned yet:
+--   1. the table is renamed to <table>_unpartitioned and its indexes dropped
+--      (their definitions are kept and re-created on the new table);
+--   2. a partitioned <table> is created with the same columns, plus a DEFAULT
+--      partition and one partition for every day/week that holds rows, plus
+--      the current one to two weeks ahead (UTC, weeks start on Monday — same
+--      as partitions.py);
+--   3. the rows are copied, the row counts compared, the primary key
+--      (received_at, id), indexes and foreign keys added, and the id sequence
+--      handed over to the new table;
+--   4. the old table is dropped.
+--
+-- Each table is converted in its own transaction: an error leaves that table
+-- as it was.
+-- The tables are locked while it runs (roughly the time it takes to copy them)
+-- — stop the API or expect ingest to wait.  Rows without a received_at cannot
+-- be placed in a partition and are left out (reported as a NOTICE).
+-- Afterwards the API's partition manager (partitions.py) keeps creating
+-- partitions ahead of time.
+--
+-- Run it as the owner of the tables (or a superuser):
+--   psql -d mssia_db -f migrate_partition_readings.sql
+
+CREATE FUNCTION pg_temp.partition_by_received_at(tbl text, unit text) RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    old       text;
+    owner     text;
+    seq       text;
+    pk        text;
+    idx_defs  text[];
+    fk_defs   text[];
+    def       text;
+    p         timestamptz;
+    step      interval;
+    n_old     bigint;
+    n_null    bigint;
+    n_new     bigint;
+BEGIN
+    IF to_regclass(tbl) IS NULL THEN
+        RAISE NOTICE '% does not exist, skipped', tbl;
+        RETURN;
+    END IF;
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(tbl)) THEN
+        RAISE NOTICE '% is already partitioned, skipped', tbl;
+        RETURN;
+    END IF;
+
+    old   := tbl || '_unpartitioned';
+    step  := CASE unit WHEN 'day' THEN interval '1 day' ELSE interval '7 days' END;
+    owner := (SELECT tableowner FROM pg_tables WHERE schemaname = 'public' AND tablename = tbl);
+    seq   := pg_get_serial_sequence(tbl, 'id');
+    pk    := (SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(tbl) AND contype = 'p');
+
+    -- 1. Move the old table out of the way, keeping its index and FK definitions.
+    idx_defs := ARRAY(
+        SELECT indexdef FROM pg_indexes
+        WHERE schemaname = 'public' AND tablename = tbl AND indexname <> coalesce(pk, '')
+    );
+    fk_defs := ARRAY(
+        SELECT format('ALTER TABLE %I ADD CONSTRAINT %I %s', tbl, conname, pg_get_constraintdef(oid))
+        FROM pg_constraint WHERE conrelid = to_regclass(tbl) AND contype = 'f'
+    );
+    FOR def IN SELECT indexname FROM pg_indexes
+               WHERE schemaname = 'public' AND tablename = tbl AND indexname <> coalesce(pk, '')
+    LOOP
+        EXECUTE format('DROP INDEX %I', def);
+    END LOOP;
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', tbl, old);
+    IF pk IS NOT NULL THEN
+        EXECUTE format('ALTER TABLE %I RENAME CONSTRAINT %I TO %I', old, pk, old || '_pkey');
+    END IF;
+
+    -- 2. Partitioned table, owned by the same role so the API can add partitions.
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (received_at)',
+                   tbl, old);
+    EXECUTE format('ALTER TABLE %I ALTER COLUMN received_at SET NOT NULL', tbl);
+    EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', tbl || '_default', tbl);
+
+    -- Only intervals that hold rows, plus the ones live ingest needs: a long
+    -- history with gaps does not turn into hundreds of empty partitions.
+    FOR p IN EXECUTE format(
+        'SELECT DISTINCT date_trunc(%L, received_at) FROM %I WHERE received_at IS NOT NULL '
+        'UNION SELECT generate_series(date_trunc(%L, now()) - %L::interval, now() + interval ''14 days'', %L::interval)',
+        unit, old, unit, step, step)
+    LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                       tbl || '_p' || to_char(p, 'YYYYMMDD'), tbl, p, p + step);
+    END LOOP;
+
+    -- 3. Copy, check, then build the indexes once over the loaded partitions.
+    EXECUTE format('INSERT INTO %I SELECT * FROM %I WHERE received_at IS NOT NULL', tbl, old);
+    GET DIAGNOSTICS n_new = ROW_COUNT;
+    EXECUTE format('SELECT count(*), count(*) FILTER (WHERE received_at IS NULL) FROM %I', old) INTO n_old, n_null;
+    IF n_new <> n_old - n_null THEN
+        RAISE EXCEPTION '%: copied % rows, expected %', tbl, n_new, n_old - n_null;
+    END IF;
+    IF n_null > 0 THEN
+        RAISE NOTICE '%: % rows without received_at left out', tbl, n_null;
+    END IF;
+
+    EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (received_at, id)', tbl);
+    FOREACH def IN ARRAY idx_defs LOOP
+        IF def LIKE 'CREATE UNIQUE%' THEN
+            RAISE NOTICE '%: unique index not carried over (must include received_at): %', tbl, def;
+        ELSE
+            EXECUTE def;   -- the definition names the table as it was before the rename
+        END IF;
+    END LOOP;
+    FOREACH def IN ARRAY fk_defs LOOP
+        EXECUTE def;
+    END LOOP;
+
+    IF seq IS NOT NULL THEN
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.id', seq, tbl);
+    END IF;
+
+    -- 4. Done with the old table.
+    EXECUTE format('DROP TABLE %I', old);
+
+    EXECUTE format('ALTER TABLE %I OWNER TO %I', tbl, owner);
+    FOR def IN SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+               WHERE i.inhparent = to_regclass(tbl)
+    LOOP
+        EXECUTE format('ALTER TABLE %I OWNER TO %I', def, owner);
+    END LOOP;
+    IF EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'mssia_user') THEN
+        EXECUTE format('GRANT ALL PRIVILEGES ON TABLE %I TO mssia_user', tbl);
+    END IF;
+
+    RAISE NOTICE '%: % rows in partitions by %', tbl, n_new, unit;
+END
+$$;
+
+-- One transaction per table keeps the number of locks held at once (a table,
+-- its partitions and their indexes) within max_locks_per_transaction.  If a
+-- long history still hits "out of shared memory", raise that setting.
+BEGIN;
+SET LOCAL TimeZone = 'UTC';
+SELECT pg_temp.partition_by_received_at('wifi_scan', 'day');
+COMMIT;
+
+BEGIN;
+SET LOCAL TimeZone = 'UTC';
+SELECT pg_temp.partition_by_received_at('dht22_reading', 'week');
+COMMIT;
+
+BEGIN;
+SET LOCAL TimeZone = 'UTC';
+SELECT pg_temp.partition_by_received_at('mq135_reading', 'week');
+COMMIT;
+
+SELECT 'Migration 9 complete: reading tables partitioned by received_at.' AS result;
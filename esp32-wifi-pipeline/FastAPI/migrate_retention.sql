@@ -0,0 +1,14 @@
+-- Migration 12: indexes for the retention compactor
+--
+-- retention.py expires rollup rows by bucket_start and checks rollup_1h
+-- counts per time range before raw rows are deleted.  The primary keys lead
+-- with scan_point_id, so both tables get an index on bucket_start.
+-- New databases get these from models.py.
+--
+-- Retention itself needs no schema change: set the RETENTION_*_DAYS
+-- environment variables (see retention.py) before starting the API.
+
+CREATE INDEX IF NOT EXISTS ix_rollup_1m_bucket_start ON rollup_1m (bucket_start);
+CREATE INDEX IF NOT EXISTS ix_rollup_1h_bucket_start ON rollup_1h (bucket_start);
+
+SELECT 'Migration 12 complete: rollup bucket_start indexes created.' AS result;
@@ -0,0 +1,63 @@
+-- Migration 10: rollup_1m / rollup_1h tables
+--
+-- Per-minute and per-hour aggregates of wifi_scan, dht22_reading and
+-- mq135_reading for each scan point (see rollups.py).  The ingest pipeline
+-- and import_history.py keep them up to date from now on; the history
+-- endpoints read them instead of the raw rows.
+--
+-- Readings stored before this migration are not in the rollups yet — fill
+-- them in once, from the FastAPI directory:
+--   python rollups.py rebuild --since <date of the oldest reading>
+
+CREATE TABLE IF NOT EXISTS rollup_1m (
+    scan_point_id INTEGER          NOT NULL REFERENCES scan_point(id) ON DELETE CASCADE,
+    bucket_start  TIMESTAMPTZ      NOT NULL,
+    wifi_count    INTEGER          NOT NULL DEFAULT 0,
+    rssi_n        INTEGER          NOT NULL DEFAULT 0,
+    rssi_sum      BIGINT           NOT NULL DEFAULT 0,
+    rssi_min      INTEGER,
+    rssi_max      INTEGER,
+    dht_count     INTEGER          NOT NULL DEFAULT 0,
+    temp_sum      DOUBLE PRECISION NOT NULL DEFAULT 0,
+    temp_min      DOUBLE PRECISION,
+    temp_max      DOUBLE PRECISION,
+    hum_sum       DOUBLE PRECISION NOT NULL DEFAULT 0,
+    hum_min       DOUBLE PRECISION,
+    hum_max       DOUBLE PRECISION,
+    mq_count      INTEGER          NOT NULL DEFAULT 0,
+    ppm_sum       DOUBLE PRECISION NOT NULL DEFAULT 0,
+    ppm_min       DOUBLE PRECISION,
+    ppm_max       DOUBLE PRECISION,
+    raw_n         INTEGER          NOT NULL DEFAULT 0,
+    raw_sum       BIGINT           NOT NULL DEFAULT 0,
+    PRIMARY KEY (scan_point_id, bucket_start)
+);
+
+CREATE TABLE IF NOT EXISTS rollup_1h (
+    scan_point_id INTEGER          NOT NULL REFERENCES scan_point(id) ON DELETE CASCADE,
+    bucket_start  TIMESTAMPTZ      NOT NULL,
+    wifi_count    INTEGER          NOT NULL DEFAULT 0,
+    rssi_n        INTEGER          NOT NULL DEFAULT 0,
+    rssi_sum      BIGINT           NOT NULL DEFAULT 0,
+    rssi_min      INTEGER,
+    rssi_max      INTEGER,
+    dht_count     INTEGER          NOT NULL DEFAULT 0,
+    temp_sum      DOUBLE PRECISION NOT NULL DEFAULT 0,
+    temp_min      DOUBLE PRECISION,
+    temp_max      DOUBLE PRECISION,
+    hum_sum       DOUBLE PRECISION NOT NULL DEFAULT 0,
+    hum_min       DOUBLE PRECISION,
+    hum_max       DOUBLE PRECISION,
+    mq_count      INTEGER          NOT NULL DEFAULT 0,
+    ppm_sum       DOUBLE PRECISION NOT NULL DEFAULT 0,
+    ppm_min       DOUBLE PRECISION,
+    ppm_max       DOUBLE PRECISION,
+    raw_n         INTEGER          NOT NULL DEFAULT 0,
+    raw_sum       BIGINT           NOT NULL DEFAULT 0,
+    PRIMARY KEY (scan_point_id, bucket_start)
+);
+
+GRANT ALL PRIVILEGES ON TABLE rollup_1m TO mssia_user;
+GRANT ALL PRIVILEGES ON TABLE rollup_1h TO mssia_user;
+
+SELECT 'Migration 10 complete: rollup tables created (run rollups.py rebuild next).' AS result;
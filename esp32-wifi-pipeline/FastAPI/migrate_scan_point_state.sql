@@ -0,0 +1,28 @@
+-- Migration 11: scan_point_state table
+--
+-- One row per scan point with its running WiFi totals and newest DHT22 and
+-- MQ-135 reading (see scan_point_state.py).  Ingest and import_history.py
+-- keep it up to date; the heatmap endpoints and /alerts read it instead of
+-- searching the reading tables.
+--
+-- Fill it in from the existing readings once, from the FastAPI directory:
+--   python scan_point_state.py rebuild
+
+CREATE TABLE IF NOT EXISTS scan_point_state (
+    scan_point_id INTEGER     PRIMARY KEY REFERENCES scan_point(id) ON DELETE CASCADE,
+    wifi_count    BIGINT      NOT NULL DEFAULT 0,
+    rssi_n        BIGINT      NOT NULL DEFAULT 0,
+    rssi_sum      BIGINT      NOT NULL DEFAULT 0,
+    last_scan_at  TIMESTAMPTZ,
+    temperature_c DOUBLE PRECISION,
+    humidity_pct  DOUBLE PRECISION,
+    dht_at        TIMESTAMPTZ,
+    ppm           DOUBLE PRECISION,
+    raw_value     INTEGER,
+    mq_at         TIMESTAMPTZ,
+    updated_at    TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+GRANT ALL PRIVILEGES ON TABLE scan_point_state TO mssia_user;
+
+SELECT 'Migration 11 complete: scan_point_state created (run scan_point_state.py rebuild next).' AS result;
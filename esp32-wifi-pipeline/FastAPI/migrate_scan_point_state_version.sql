@@ -0,0 +1,20 @@
+-- Migration 15: scan_point_state.version
+--
+-- The response cache (response_cache.py) polls scan_point_state to learn which
+-- floor plans have new readings.  updated_at alone cannot tell it: NOW() is
+-- the start of the writing transaction, so a batch that committed after the
+-- last poll can carry an older stamp than rows already seen.
+--
+-- version is taken from a sequence by every insert and every upsert of a row,
+-- so each change gives the row a new, larger value; the sum of a floor plan's
+-- versions moves with every commit that touches it, whatever order the
+-- transactions commit in.  Existing rows get a value when the column is added.
+
+CREATE SEQUENCE IF NOT EXISTS scan_point_state_version_seq;
+
+ALTER TABLE scan_point_state
+    ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('scan_point_state_version_seq');
+
+GRANT USAGE, SELECT ON SEQUENCE scan_point_state_version_seq TO mssia_user;
+
+SELECT 'Migration 15 complete: scan_point_state.version added.' AS result;
@@ -1,13 +1,25 @@
 # models.py
 from datetime import datetime, timezone
 from sqlalchemy import (
-    Column, Integer, BigInteger, Text, DateTime, ForeignKey, Float, CheckConstraint
+    Column, Integer, BigInteger, SmallInteger, Text, DateTime, ForeignKey, Float, CheckConstraint,
+    DDL, Index, PrimaryKeyConstraint, Sequence, event
 )
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, text
 from sqlalchemy.orm import relationship
 from database import Base
 
 
+def _partitioned_by_received_at(*args):
+    """
+    __table_args__ for a reading table range-partitioned by received_at
+    (partitions.py creates the partitions).  The partition key has to be part
+    of the primary key; received_at goes first so the key also serves
+    "newest rows first" and time-range scans.
+    """
+    return (PrimaryKeyConstraint("received_at", "id"), *args,
+            {"postgresql_partition_by": "RANGE (received_at)"})
+
+
 class BuildingDB(Base):
     __tablename__ = "building"
 
@@ -87,26 +99,75 @@ class ScanPointDB(Base):
     mq135_readings  = relationship("Mq135ReadingDB",   back_populates="scan_point")
 
 
+def format_mac(mac: int) -> str:
+    """"AA:BB:CC:DD:EE:FF" spelling of a 48-bit MAC."""
+    digits = f"{mac:012X}"
+    return ":".join(digits[i:i + 2] for i in range(0, 12, 2))
+
+
+class AccessPointDB(Base):
+    """
+    One row per distinct (bssid, ssid, enc) seen in a WiFi scan — wifi_scan
+    rows point here instead of repeating the strings (access_points.py).
+
+    mac         — the BSSID as a 48-bit integer; NULL when it is not a MAC.
+    bssid_text  — the BSSID as received, only when format_mac(mac) does not
+                  spell it exactly (lower case, "-" separators, not a MAC).
+    An AP that changes its SSID or encryption gets a new row, so the rows
+    sharing a mac, by first_seen, are its history.
+    """
+    __tablename__ = "access_point"
+
+    id          = Column(Integer, primary_key=True)
+    mac         = Column(BigInteger, nullable=True, index=True)
+    bssid_text  = Column(Text, nullable=True)
+    ssid        = Column(Text, nullable=True)
+    enc         = Column(Text, nullable=True)
+    first_seen  = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    @property
+    def bssid(self):
+        if self.bssid_text is not None:
+            return self.bssid_text
+        return format_mac(self.mac) if self.mac is not None else None
+
+
 class WifiScanDB(Base):
     __tablename__ = "wifi_scan"
+    __table_args__ = _partitioned_by_received_at(
+        # scan counts and running totals per point — answered from the index alone
+        Index("ix_wifi_scan_point_time", "scan_point_id", "received_at", postgresql_include=["rssi"]),
+    )
 
-    id           = Column(BigInteger, primary_key=True, index=True)
-    received_at  = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
-    node         = Column(Text, index=True)
-    device_ts_ms = Column(BigInteger, index=True)
-    ssid         = Column(Text)
-    bssid        = Column(Text, index=True)
-    rssi         = Column(Integer)
-    channel      = Column(Integer)
-    enc          = Column(Text)
+    id              = Column(BigInteger, autoincrement=True, index=True)
+    received_at     = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    node            = Column(Text, index=True)
+    device_ts_ms    = Column(BigInteger, index=True)
+    access_point_id = Column(Integer, ForeignKey("access_point.id"), nullable=False, index=True)
+    rssi            = Column(SmallInteger)
+    channel         = Column(SmallInteger)
 
     # Coordinate stamped at ingest — look up scan_point by assigned_node
-    scan_point_id = Column(Integer, ForeignKey("scan_point.id", ondelete="SET NULL"), nullable=True, index=True)
+    scan_point_id = Column(Integer, ForeignKey("scan_point.id", ondelete="SET NULL"), nullable=True)
 
     # Organisational only — NOT written at ingest
     room_id = Column(Integer, ForeignKey("room.id", ondelete="SET NULL"), nullable=True, index=True)
 
-    scan_point = relationship("ScanPointDB", back_populates="scans")
+    scan_point   = relationship("ScanPointDB", back_populates="scans")
+    access_point = relationship("AccessPointDB", lazy="joined", innerjoin=True)
+
+    # The columns wifi_scan had before the access_point table (read-only).
+    @property
+    def ssid(self):
+        return self.access_point.ssid
+
+    @property
+    def bssid(self):
+        return self.access_point.bssid
+
+    @property
+    def enc(self):
+        return self.access_point.enc
 
 
 class Dht22ReadingDB(Base):
@@ -118,13 +179,18 @@ class Dht22ReadingDB(Base):
     scan_point_id is looked up by assigned_node at ingest time — same pattern as wifi_scan.
     """
     __tablename__ = "dht22_reading"
+    __table_args__ = _partitioned_by_received_at(
+        # newest readings of a point first, without visiting the table
+        Index("ix_dht22_reading_point_time", "scan_point_id", text("received_at DESC"), text("id DESC"),
+              postgresql_include=["temperature_c", "humidity_pct"]),
+    )
 
-    id            = Column(BigInteger, primary_key=True, index=True)
-    scan_point_id = Column(Integer, ForeignKey("scan_point.id", ondelete="SET NULL"), nullable=True, index=True)
+    id            = Column(BigInteger, autoincrement=True, index=True)
+    scan_point_id = Column(Integer, ForeignKey("scan_point.id", ondelete="SET NULL"), nullable=True)
     node          = Column(Text, index=True)
     temperature_c = Column(Float, nullable=False)   # °C — DHT22 range: -40 to +80
     humidity_pct  = Column(Float, nullable=False)   # % — DHT22 range: 0 to 100
-    received_at   = Column(DateTime(timezone=True), nullable=False, index=True)
+    received_at   = Column(DateTime(timezone=True), nullable=False)   # first column of the primary key
 
     scan_point = relationship("ScanPointDB", back_populates="dht22_readings")
 
@@ -137,8 +203,12 @@ class Mq135ReadingDB(Base):
     raw_value : stored separately in case a real calibration formula is added later(but l don't really need this in my project).
     """
     __tablename__ = "mq135_reading"
+    __table_args__ = _partitioned_by_received_at(
+        Index("ix_mq135_reading_point_time", "scan_point_id", text("received_at DESC"), text("id DESC"),
+              postgresql_include=["ppm", "raw_value"]),
+    )
 
-    id            = Column(BigInteger, primary_key=True, autoincrement=True)
+    id            = Column(BigInteger, autoincrement=True)
     scan_point_id = Column(Integer, ForeignKey("scan_point.id", ondelete="SET NULL"), nullable=True)
     node          = Column(Text,    nullable=True)
     ppm           = Column(Float,   nullable=False)
@@ -146,4 +216,132 @@ class Mq135ReadingDB(Base):
     received_at   = Column(DateTime(timezone=True), nullable=False,
                            default=lambda: datetime.now(timezone.utc))
 
-    scan_point = relationship("ScanPointDB", back_populates="mq135_readings")
\ No newline at end of file
+    scan_point = relationship("ScanPointDB", back_populates="mq135_readings")
+
+
+# Catch-all partition, so an insert never fails for lack of a partition —
+# partitions.py moves its rows into partitions of their own.
+for _table in (WifiScanDB.__table__, Dht22ReadingDB.__table__, Mq135ReadingDB.__table__):
+    event.listen(_table, "after_create",
+                 DDL(f"CREATE TABLE IF NOT EXISTS {_table.name}_default PARTITION OF {_table.name} DEFAULT"))
+
+# wifi_scan as it read before the access_point table, for SQL clients
+# (viewPostgresDB.py, ad-hoc queries).  Same statement as migrate_access_point.sql.
+WIFI_SCAN_VIEW = r"""
+CREATE OR REPLACE VIEW wifi_scan_v AS
+SELECT w.id, w.received_at, w.node, w.device_ts_ms,
+       ap.ssid,
+       coalesce(ap.bssid_text,
+                upper(regexp_replace(lpad(to_hex(ap.mac), 12, '0'), '(..)(?!$)', '\1:', 'g'))) AS bssid,
+       w.rssi, w.channel, ap.enc, w.scan_point_id, w.room_id
+FROM wifi_scan w
+JOIN access_point ap ON ap.id = w.access_point_id
+"""
+event.listen(Base.metadata, "after_create", DDL(WIFI_SCAN_VIEW))
+
+
+class IngestBatchDB(Base):
+    """
+    One row per ingest batch that has already been written.
+    batch_key is claimed in the same transaction as the batch's readings, so a
+    batch replayed from the on-disk spool (or retried) is only stored once —
+    without needing a unique index on the large reading tables.
+    Keys: "spool:<uuid>" (spool records), "id:<node>:<batch_id>" and
+    "hash:<digest>" (client retries, see ingest_dedupe.py).  Expired keys are pruned.
+    """
+    __tablename__ = "ingest_batch"
+
+    batch_key   = Column(Text, primary_key=True)
+    received_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+
+class ImportChunkDB(Base):
+    """
+    One row per chunk loaded by import_history.py, written in the same
+    transaction as the chunk's readings.  A chunk covers the source positions
+    [start_pos, end_pos) — SQLite row ids for a .db table, byte offsets for a
+    .jsonl file — so a re-run skips everything already loaded and resumes
+    after the last contiguous chunk.
+    """
+    __tablename__ = "import_chunk"
+
+    source      = Column(Text,       primary_key=True)   # absolute path of the source file
+    part        = Column(Text,       primary_key=True)   # SQLite table name, or "jsonl"
+    start_pos   = Column(BigInteger, primary_key=True)
+    end_pos     = Column(BigInteger, nullable=False)
+    rows        = Column(Integer,    nullable=False)
+    imported_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class _RollupColumns:
+    """
+    Aggregates of the three reading tables for one scan point and one time
+    bucket (rollups.py).  Only sums, counts, minima and maxima, so rows can be
+    added in any order and averages are sum / n.
+    """
+    scan_point_id = Column(Integer, ForeignKey("scan_point.id", ondelete="CASCADE"), primary_key=True)
+    bucket_start  = Column(DateTime(timezone=True), primary_key=True, index=True)   # retention.py expires by time
+
+    wifi_count    = Column(Integer, nullable=False, default=0)   # wifi_scan rows
+    rssi_n        = Column(Integer, nullable=False, default=0)   # … of which with an rssi
+    rssi_sum      = Column(BigInteger, nullable=False, default=0)
+    rssi_min      = Column(Integer)
+    rssi_max      = Column(Integer)
+
+    dht_count     = Column(Integer, nullable=False, default=0)
+    temp_sum      = Column(Float, nullable=False, default=0)
+    temp_min      = Column(Float)
+    temp_max      = Column(Float)
+    hum_sum       = Column(Float, nullable=False, default=0)
+    hum_min       = Column(Float)
+    hum_max       = Column(Float)
+
+    mq_count      = Column(Integer, nullable=False, default=0)
+    ppm_sum       = Column(Float, nullable=False, default=0)
+    ppm_min       = Column(Float)
+    ppm_max       = Column(Float)
+    raw_n         = Column(Integer, nullable=False, default=0)
+    raw_sum       = Column(BigInteger, nullable=False, default=0)
+
+
+class Rollup1mDB(_RollupColumns, Base):
+    """Per-minute rollup — serves history windows up to a few hours."""
+    __tablename__ = "rollup_1m"
+
+
+class Rollup1hDB(_RollupColumns, Base):
+    """Per-hour rollup — serves the day / week / month history windows."""
+    __tablename__ = "rollup_1h"
+
+
+SCAN_POINT_STATE_VERSION = Sequence("scan_point_state_version_seq")
+
+
+class ScanPointStateDB(Base):
+    """
+    Latest known state of each scan point (scan_point_state.py), upserted in
+    the same transaction as the readings: running WiFi totals, and the newest
+    DHT22 and MQ-135 reading.  The heatmaps and /alerts read this one row per
+    point instead of searching the reading tables.
+    """
+    __tablename__ = "scan_point_state"
+
+    scan_point_id = Column(Integer, ForeignKey("scan_point.id", ondelete="CASCADE"), primary_key=True)
+
+    wifi_count    = Column(BigInteger, nullable=False, default=0)   # wifi_scan rows
+    rssi_n        = Column(BigInteger, nullable=False, default=0)   # … of which with an rssi
+    rssi_sum      = Column(BigInteger, nullable=False, default=0)
+    last_scan_at  = Column(DateTime(timezone=True))
+
+    temperature_c = Column(Float)
+    humidity_pct  = Column(Float)
+    dht_at        = Column(DateTime(timezone=True))   # received_at of that reading
+
+    ppm           = Column(Float)
+    raw_value     = Column(Integer)
+    mq_at         = Column(DateTime(timezone=True))
+
+    updated_at    = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    # new value on every insert / upsert — the response cache's watermark (migrate_scan_point_state_version.sql)
+    version       = Column(BigInteger, SCAN_POINT_STATE_VERSION,
+                           server_default=SCAN_POINT_STATE_VERSION.next_value(), nullable=False)
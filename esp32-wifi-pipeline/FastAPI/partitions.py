@@ -0,0 +1,227 @@
+# partitions.py
+#
+# Range partitions for the reading tables.
+#
+# wifi_scan, dht22_reading and mq135_reading are partitioned by received_at
+# (models.py): one partition per day for wifi_scan, which grows by ~40 rows per
+# node every few seconds, one per week for the two sensor tables.  A query that
+# filters on received_at — every history endpoint — only opens the partitions
+# in its window (partition pruning), and old data can be dropped a partition at
+# a time instead of row by row.
+#
+# Every table also has a DEFAULT partition, so an insert never fails for lack
+# of a partition.  A background thread, once at startup and then every
+# PARTITION_RUN_INTERVAL seconds:
+#
+#   - creates the partitions from one interval back to PARTITION_PREMAKE_DAYS
+#     ahead, so live ingest always lands in a proper partition;
+#   - moves rows that landed in the DEFAULT partition (backfills, imports of old
+#     captures) into partitions of their own, creating them as needed.
+#
+# Each change is its own short transaction, serialised across API workers with
+# an advisory lock and bounded by lock_timeout so it never queues up ingest for
+# long — anything that could not be done is retried on the next run.
+#
+# Tables that are not partitioned yet (databases created before this change)
+# are left alone — see migrate_partition_readings.sql.
+
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Set
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+
+log = logging.getLogger(__name__)
+
+# table → partition width in days
+PARTITIONED_TABLES = {
+    "wifi_scan":     1,
+    "dht22_reading": 7,
+    "mq135_reading": 7,
+}
+
+PREMAKE_DAYS    = int(os.getenv("PARTITION_PREMAKE_DAYS", "14"))
+RUN_INTERVAL_S  = float(os.getenv("PARTITION_RUN_INTERVAL", "3600"))
+MAX_MOVES       = int(os.getenv("PARTITION_MAX_MOVES_PER_RUN", "100"))   # DEFAULT partition ranges split per run
+LOCK_TIMEOUT    = os.getenv("PARTITION_LOCK_TIMEOUT", "5s")
+ADVISORY_LOCK   = 0x50415254   # "PART"
+
+
+def interval_start(ts: datetime, days: int) -> datetime:
+    """Start of the partition holding ts: UTC midnight, or the Monday before for weekly partitions."""
+    day = ts.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return day - timedelta(days=day.weekday()) if days == 7 else day
+
+
+def partition_name(table: str, start: datetime) -> str:
+    return f"{table}_p{start:%Y%m%d}"
+
+
+def is_partitioned(db: Session, table: str) -> bool:
+    return bool(db.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:t))"),
+        {"t": table},
+    ).scalar())
+
+
+def partitions_of(db: Session, table: str) -> Set[str]:
+    return set(db.execute(
+        text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+             "WHERE i.inhparent = to_regclass(:t)"),
+        {"t": table},
+    ).scalars())
+
+
+class PartitionManager:
+    def __init__(self):
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # metrics
+        self.created    = 0
+        self.rows_moved = 0
+        self.runs       = 0
+        self.partitions: Dict[str, Optional[int]] = {}   # table → partition count (None = not partitioned)
+        self.last_run   = None
+        self.last_error = None
+
+    def _begin(self, db: Session) -> bool:
+        """Start a partition-maintenance transaction; False if another worker holds the lock."""
+        db.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+        return bool(db.execute(text("SELECT pg_try_advisory_xact_lock(:k)"), {"k": ADVISORY_LOCK}).scalar())
+
+    def create_partition(self, table: str, start: datetime) -> int:
+        """
+        Create the partition of table that starts at start, in its own
+        transaction.  Rows already sitting in the DEFAULT partition for that
+        range are moved into it.  Returns the number of rows moved.
+        """
+        days    = PARTITIONED_TABLES[table]
+        name    = partition_name(table, start)
+        bounds  = f"FROM ('{start.isoformat()}') TO ('{(start + timedelta(days=days)).isoformat()}')"
+        in_range = "received_at >= :lo AND received_at < :hi"
+        params  = {"lo": start, "hi": start + timedelta(days=days)}
+        db = SessionLocal()
+        try:
+            if not self._begin(db):
+                db.rollback()
+                return 0
+            if name in partitions_of(db, table):
+                db.rollback()
+                return 0
+            moved = 0
+            waiting = db.execute(
+                text(f"SELECT EXISTS (SELECT 1 FROM {table}_default WHERE {in_range})"), params
+            ).scalar()
+            if waiting:
+                # The range cannot be attached while the DEFAULT partition holds
+                # rows for it: build the partition standalone, move the rows, attach.
+                db.execute(text(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+                moved = db.execute(text(
+                    f"WITH moved AS (DELETE FROM {table}_default WHERE {in_range} RETURNING *) "
+                    f"INSERT INTO {name} SELECT * FROM moved"
+                ), params).rowcount
+                db.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES {bounds}"))
+            else:
+                db.execute(text(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES {bounds}"))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        self.created    += 1
+        self.rows_moved += moved
+        if moved:
+            log.info("created %s with %d rows moved from %s_default", name, moved, table)
+        return moved
+
+    def _oldest_waiting(self, table: str) -> Optional[datetime]:
+        db = SessionLocal()
+        try:
+            return db.execute(text(f"SELECT min(received_at) FROM {table}_default")).scalar()
+        finally:
+            db.close()
+
+    def run_once(self) -> None:
+        now = datetime.now(timezone.utc)
+        for table, days in PARTITIONED_TABLES.items():
+            db = SessionLocal()
+            try:
+                if not is_partitioned(db, table):
+                    self.partitions[table] = None
+                    continue
+                existing = partitions_of(db, table)
+            finally:
+                db.close()
+
+            # Ahead of live ingest.
+            start = interval_start(now - timedelta(days=days), days)
+            while start < now + timedelta(days=PREMAKE_DAYS):
+                if partition_name(table, start) not in existing:
+                    self.create_partition(table, start)
+                start += timedelta(days=days)
+
+            # Rows parked in the DEFAULT partition, oldest range first.
+            for _ in range(MAX_MOVES):
+                if self._stopping.is_set():
+                    break
+                oldest = self._oldest_waiting(table)
+                if oldest is None:
+                    break
+                start = interval_start(oldest, days)
+                if partition_name(table, start) in existing or not self.create_partition(table, start):
+                    break   # lock held by another worker, or a range that does not line up — next run
+                existing.add(partition_name(table, start))
+
+            db = SessionLocal()
+            try:
+                self.partitions[table] = len(partitions_of(db, table))
+            finally:
+                db.close()
+        self.runs    += 1
+        self.last_run = now.isoformat()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.run_once()
+                self.last_error = None
+            except Exception as exc:
+                self.last_error = str(exc)[:200]
+                log.warning("partition maintenance failed, will retry: %s", exc)
+            if self._stopping.wait(RUN_INTERVAL_S):
+                return
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="partition-manager", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    # ── Metrics ──────────────────────────────────────────────────────────────
+
+    def stats(self) -> dict:
+        return {
+            "partitions":    dict(self.partitions),
+            "created":       self.created,
+            "rows_moved":    self.rows_moved,
+            "runs":          self.runs,
+            "premake_days":  PREMAKE_DAYS,
+            "last_run":      self.last_run,
+            "last_error":    self.last_error,
+        }
+
+
+partition_manager = PartitionManager()
@@ -0,0 +1,388 @@
+# response_cache.py
+#
+# Conditional GET for the read endpoints the dashboards poll: the heatmaps
+# (refetched on every SSE tick), the sensor histories and /alerts (polled every
+# 30 s by useAlerts).
+#
+# Every response is versioned by watermarks held in memory:
+#
+#   per floor plan   sum(scan_point_state.version) of its points, plus the
+#                    number of points and the sum of their ids — ingest touches
+#                    scan_point_state in the same transaction as the readings
+#                    and rollups, and every write gives the row a new, larger
+#                    version from a sequence, so the sum moves with every
+#                    commit whatever order transactions commit in (a max of
+#                    timestamps would not: one taken at the start of a slow
+#                    transaction can be older than what the last poll saw);
+#   config           a version stamp (a small shared file, as in assignments.py)
+#                    bumped by every successful admin write (POST / PUT / DELETE
+#                    outside /ingest and /auth) — renames, new points, moves.
+#
+# The ETag is a hash of the request (path and query) and those versions.  It
+# is weak (W/"…"): the versions are those of the last poll while the body is
+# rendered from live data, so the same tag means the same data as of that poll
+# — not necessarily the same bytes.  Every worker computes the same tag for the
+# same versions, so a client keeps its 304s behind a load balancer.  A request
+# whose If-None-Match matches gets 304 straight from the middleware, and a
+# repeat of a cached request gets the stored body — neither touches the
+# database.  Bodies are kept in an LRU bounded by entry count and bytes.
+#
+# A background thread re-reads the watermarks (one query, one row per scan
+# point) every RESPONSE_CACHE_POLL seconds, so writes from other workers, the
+# serial bridge or the history importer are seen within one poll.  Ingest in
+# this process calls touch() after it commits: the poll runs at once, and until
+# it has the floor plans of the batch's points are passed through uncached, so
+# this worker never answers 304 for data it knows has changed.  The SSE stream
+# reads the same watermarks instead of querying per client.
+#
+# History windows are relative to the clock, so their key also carries the
+# current UTC minute.  Anything not recognised — a floor plan or scan point the
+# last poll did not see, or anything asked before the first poll — is passed
+# through uncached (and gets no 304), so the handler answers it.
+
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import parse_qs
+
+from sqlalchemy import text
+
+from database import SessionLocal
+
+log = logging.getLogger(__name__)
+
+VERSION_FILE = os.getenv("RESPONSE_CACHE_VERSION_FILE",
+                         os.path.join(tempfile.gettempdir(), "mssia_responses.version"))
+POLL_S       = float(os.getenv("RESPONSE_CACHE_POLL", "1"))
+MAX_ENTRIES  = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+MAX_BYTES    = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+MAX_BODY     = int(os.getenv("RESPONSE_CACHE_MAX_BODY", str(2 * 1024 * 1024)))   # larger bodies are not kept
+
+# path → how its scope (the floor plans it depends on) is found
+_FLOORPLAN_PATH = re.compile(r"^/heatmap/floorplan/(\d+)(?:/(?:dht22|mq135|combined))?$")
+_HISTORY_PATH   = re.compile(r"^/scan-points/(\d+)/(?:wifi|dht22|mq135)-history$")
+_MULTI_PATH     = "/heatmap/mq135"
+_GLOBAL_PATHS   = {"/alerts"}
+
+# writes that do not change what the cached endpoints show (ingest moves the watermarks instead)
+_UNVERSIONED_WRITES = ("/ingest", "/auth")
+
+# floor plan version: (sum of state versions, points, sum of point ids)
+Version = Tuple[int, int, int]
+
+
+def _read_config_version() -> Tuple[int, int]:
+    try:
+        st = os.stat(VERSION_FILE)
+        return (st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return (0, 0)
+
+
+def _bump_config_version() -> None:
+    # Same trick as assignments._bump_version(): size and mtime both move.
+    with open(VERSION_FILE, "ab") as f:
+        if f.tell() > 4096:
+            f.truncate(0)
+        f.write(b".")
+    os.utime(VERSION_FILE, None)
+
+
+class ResponseCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[str, bytes, str]]" = OrderedDict()   # key → (etag, body, media type)
+        self._bytes = 0
+
+        self._floorplans: Dict[int, Version] = {}
+        self._updated: Dict[int, datetime] = {}   # floor plan → newest updated_at
+        self._points: Dict[int, int] = {}   # scan point → floor plan
+        self._dirty: Set[int] = set()       # floor plans changed by local ingest since the poll began
+        self._all: Optional[Version] = None  # across every floor plan
+
+        self._wake     = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        # metrics
+        self.hits          = 0
+        self.not_modified  = 0
+        self.misses        = 0
+        self.evictions     = 0
+        self.polls         = 0
+        self.last_error: Optional[str] = None
+
+    # ── Watermarks ───────────────────────────────────────────────────────────
+
+    def refresh(self) -> None:
+        """Re-read every floor plan's watermark (one query, one row per scan point)."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()   # the query below sees those commits
+        db = SessionLocal()
+        try:
+            rows = db.execute(text("""
+                SELECT sp.id, sp.floorplan_id, s.version, s.updated_at
+                FROM scan_point sp
+                LEFT JOIN scan_point_state s ON s.scan_point_id = sp.id
+            """)).all()
+        except Exception:
+            with self._lock:
+                self._dirty |= dirty
+            raise
+        finally:
+            db.close()
+
+        floorplans: Dict[int, List[int]] = {}
+        updated: Dict[int, datetime] = {}
+        points: Dict[int, int] = {}
+        for sp_id, fp_id, version, updated_at in rows:
+            points[sp_id] = fp_id
+            fp = floorplans.setdefault(fp_id, [0, 0, 0])
+            fp[0] += version or 0
+            fp[1] += 1
+            fp[2] += sp_id
+            if updated_at is not None and (fp_id not in updated or updated_at > updated[fp_id]):
+                updated[fp_id] = updated_at
+        with self._lock:
+            self._floorplans = {fp_id: tuple(v) for fp_id, v in floorplans.items()}
+            self._updated = updated
+            self._points = points
+            self._all = (sum(v[0] for v in floorplans.values()), len(points), sum(points))
+        self.polls += 1
+
+    def touch(self, scan_point_ids: Iterable[int] = ()) -> None:
+        """Ingest committed rows for these points in this process: poll now, uncached until then."""
+        with self._lock:
+            for sp_id in scan_point_ids:
+                fp_id = self._points.get(sp_id)
+                if fp_id is not None:
+                    self._dirty.add(fp_id)
+        self._wake.set()
+
+    def last_ingest(self, floorplan_id: int) -> Optional[datetime]:
+        """Newest scan_point_state change on a floor plan, from the last poll."""
+        return self._updated.get(floorplan_id)
+
+    def floorplan_version(self, floorplan_id: int) -> Optional[Version]:
+        """A floor plan's version from the last poll — changes whenever its points' state does."""
+        return self._floorplans.get(floorplan_id)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._all is not None
+
+    # ── Keys ─────────────────────────────────────────────────────────────────
+
+    def _scope(self, path: str, query: str) -> Optional[str]:
+        """The versions a response to path?query depends on, or None if it is not cached."""
+        if self._all is None:
+            return None
+        m = _FLOORPLAN_PATH.match(path)
+        if m:
+            floorplan_ids = [int(m.group(1))]
+        elif path == _MULTI_PATH:
+            try:
+                floorplan_ids = sorted({int(v) for v in parse_qs(query).get("floorplan_id", [])})
+            except ValueError:
+                return None
+        elif path in _GLOBAL_PATHS:
+            return None if self._dirty else f"all={self._all}"
+        else:
+            m = _HISTORY_PATH.match(path)
+            if not m or int(m.group(1)) not in self._points:
+                return None
+            floorplan_ids = [self._points[int(m.group(1))]]
+            if floorplan_ids[0] in self._dirty:
+                return None
+            # buckets are relative to the clock
+            return f"{self._fp_version(floorplan_ids[0])} minute={int(time.time() // 60)}"
+        # unknown floor plans (or none) are left to the handler — its 404 / 422, never a 304
+        if not floorplan_ids or any(fp_id not in self._floorplans for fp_id in floorplan_ids):
+            return None
+        if self._dirty.intersection(floorplan_ids):
+            return None
+        return " ".join(self._fp_version(fp_id) for fp_id in floorplan_ids)
+
+    def _fp_version(self, floorplan_id: int) -> str:
+        return f"fp{floorplan_id}={self._floorplans.get(floorplan_id)}"
+
+    def etag_for(self, path: str, query: str) -> Optional[str]:
+        scope = self._scope(path, query)
+        if scope is None:
+            return None
+        digest = hashlib.sha1(f"{path}?{query}|{scope}|{_read_config_version()}".encode()).hexdigest()
+        return f'W/"{digest}"'
+
+    # ── Entries ──────────────────────────────────────────────────────────────
+
+    def get(self, key: str, etag: str) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key: str, etag: str, body: bytes, media_type: str) -> None:
+        if len(body) > MAX_BODY:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._entries[key] = (etag, body, media_type)
+            self._bytes += len(body)
+            while self._entries and (len(self._entries) > MAX_ENTRIES or self._bytes > MAX_BYTES):
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self) -> None:
+        """An admin write: every process drops what it has on its next request."""
+        _bump_config_version()
+
+    @staticmethod
+    def versions_write(method: str, path: str) -> bool:
+        """Whether a successful request changes the config version (see module notes)."""
+        return method not in ("GET", "HEAD", "OPTIONS") and not path.startswith(_UNVERSIONED_WRITES)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    # ── Thread ───────────────────────────────────────────────────────────────
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as exc:
+                self.last_error = str(exc)[:200]
+                log.warning("response cache watermark poll failed: %s", exc)
+            self._wake.wait(POLL_S)
+            self._wake.clear()
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="response-cache", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+        self._all = None
+        self.clear()
+
+    # ── Metrics ──────────────────────────────────────────────────────────────
+
+    def stats(self) -> dict:
+        return {
+            "entries":      len(self._entries),
+            "bytes":        self._bytes,
+            "hits":         self.hits,
+            "not_modified": self.not_modified,
+            "misses":       self.misses,
+            "evictions":    self.evictions,
+            "floorplans":   len(self._floorplans),
+            "polls":        self.polls,
+            "last_error":   self.last_error,
+        }
+
+
+response_cache = ResponseCache()
+
+
+class ConditionalGetMiddleware:
+    """
+    ETags, If-None-Match → 304 and cached bodies for the heatmap, history and
+    alert endpoints; successful admin writes bump the config version.  Plain
+    ASGI: every other request — POST /ingest above all — is handed straight to
+    the app with no wrapping.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        method, path = scope["method"], scope["path"]
+        if method == "GET":
+            return await self._get(scope, receive, send, path)
+        if not response_cache.versions_write(method, path):
+            return await self.app(scope, receive, send)
+
+        async def send_versioned(message):
+            # bump before the client sees its 2xx, so a refetch gets the new version
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                response_cache.invalidate()
+            await send(message)
+
+        await self.app(scope, receive, send_versioned)
+
+    async def _get(self, scope, receive, send, path: str) -> None:
+        query = scope["query_string"].decode("latin-1")
+        etag = response_cache.etag_for(path, query)
+        if etag is None:
+            return await self.app(scope, receive, send)
+        extra = [(b"etag", etag.encode()), (b"cache-control", b"no-cache")]
+
+        # weak comparison (RFC 9110 §8.8.3.2): W/"x" and "x" match
+        if_none_match = [t.strip().removeprefix("W/") for h, v in scope["headers"] if h == b"if-none-match"
+                         for t in v.decode("latin-1").split(",")]
+        if etag.removeprefix("W/") in if_none_match or "*" in if_none_match:
+            response_cache.not_modified += 1
+            await send({"type": "http.response.start", "status": 304, "headers": extra})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        key = f"{path}?{query}"
+        cached = response_cache.get(key, etag)
+        if cached is not None:
+            response_cache.hits += 1
+            body, media_type = cached
+            await self._send(send, 200, [(b"content-type", media_type.encode())], extra, body)
+            return
+
+        response_cache.misses += 1
+        start: dict = {}
+        chunks: List[bytes] = []
+
+        async def send_buffered(message):
+            if message["type"] == "http.response.start":
+                if message["status"] != 200:
+                    await send(message)   # errors pass through as they are
+                else:
+                    start.update(message)
+                return
+            if not start:
+                await send(message)
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                body = b"".join(chunks)
+                headers = [(h, v) for h, v in start["headers"] if h in (b"content-type",)]
+                media_type = dict(headers).get(b"content-type", b"application/json").decode("latin-1")
+                response_cache.put(key, etag, body, media_type)
+                await self._send(send, 200, headers, extra, body)
+
+        await self.app(scope, receive, send_buffered)
+
+    @staticmethod
+    async def _send(send, status: int, headers: list, extra: list, body: bytes) -> None:
+        await send({"type": "http.response.start", "status": status,
+                    "headers": headers + extra + [(b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
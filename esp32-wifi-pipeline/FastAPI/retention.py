@@ -0,0 +1,341 @@
+# retention.py
+#
+# Retention tiers: how long each table keeps its rows.
+#
+#   wifi_scan           raw scans         RETENTION_WIFI_RAW_DAYS    (14)
+#   dht22_reading       raw readings      RETENTION_DHT22_RAW_DAYS   (90)
+#   mq135_reading       raw readings      RETENTION_MQ135_RAW_DAYS   (90)
+#   rollup_1m           1-minute rollups  RETENTION_ROLLUP_1M_DAYS   (90)
+#   rollup_1h           1-hour rollups    RETENTION_ROLLUP_1H_DAYS   (0)
+#
+# 0 keeps a table forever.  Older data stays available at the next coarser
+# tier: the rollups (rollups.py) are written at ingest, so by the time a raw
+# row expires it is already counted in rollup_1m / rollup_1h, and the running
+# totals the heatmaps use live in scan_point_state.  Those totals are lifetime
+# totals, and scan_point_state.py rebuild sums them from rollup_1h — so with a
+# rollup_1h tier set, a rebuild counts only what that tier still holds.
+#
+# A background thread, once shortly after startup and then every
+# RETENTION_RUN_INTERVAL seconds, works through the tiers oldest data first:
+#
+#   1. aggregate — before raw rows are removed, their range is checked against
+#      rollup_1h (row counts per range).  A range with more raw rows than the
+#      rollups count (rows loaded before the rollups existed) has that
+#      sensor's rollup columns rebuilt from the raw rows first.  Fewer raw rows
+#      than counted means an earlier delete of the range was interrupted: the
+#      rollups already hold the deleted rows, so they are left alone.  A range
+#      that has passed the check is remembered until its rows are gone, so a
+#      retried run does not count it again;
+#   2. archive — the raw rows are written to the Parquet archive (archive.py),
+#      when it is enabled, so they stay available for analysis;
+#   3. drop whole partitions that are past the cutoff (partitions.py), which
+#      costs nothing however many rows they hold;
+#   4. delete what is left (the DEFAULT partition, a partition straddling the
+#      cutoff, unpartitioned tables, the rollup tables) in chunks of
+#      RETENTION_CHUNK_ROWS rows, each its own transaction.
+#
+# Every statement runs with a short lock_timeout, so retention never queues up
+# ingest behind it: a step that cannot get its lock is retried on the next run.
+# Only one API worker compacts at a time (advisory lock).  Rows without a scan
+# point are not rolled up and simply expire.
+#
+#   python retention.py          one run now, printing what was done
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Set, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import archive
+import rollups
+from database import SessionLocal
+from partitions import PARTITIONED_TABLES, is_partitioned, partitions_of
+
+log = logging.getLogger(__name__)
+
+# table → days kept (0 = forever)
+RAW_TIERS = {
+    "wifi_scan":     int(os.getenv("RETENTION_WIFI_RAW_DAYS", "14")),
+    "dht22_reading": int(os.getenv("RETENTION_DHT22_RAW_DAYS", "90")),
+    "mq135_reading": int(os.getenv("RETENTION_MQ135_RAW_DAYS", "90")),
+}
+ROLLUP_TIERS = {
+    "rollup_1m": int(os.getenv("RETENTION_ROLLUP_1M_DAYS", "90")),
+    "rollup_1h": int(os.getenv("RETENTION_ROLLUP_1H_DAYS", "0")),
+}
+
+RUN_INTERVAL_S = float(os.getenv("RETENTION_RUN_INTERVAL", "3600"))
+START_DELAY_S  = float(os.getenv("RETENTION_START_DELAY", "60"))      # let startup and spool replay settle first
+CHUNK_ROWS     = int(os.getenv("RETENTION_CHUNK_ROWS", "5000"))
+CHUNK_PAUSE_S  = float(os.getenv("RETENTION_CHUNK_PAUSE", "0.05"))    # between delete chunks, to leave room for ingest
+LOCK_TIMEOUT   = os.getenv("RETENTION_LOCK_TIMEOUT", "2s")
+ADVISORY_LOCK  = 0x52455445   # "RETE"
+
+# count column in rollup_1h for each raw table
+_ROLLUP_COUNT = {"wifi_scan": "wifi_count", "dht22_reading": "dht_count", "mq135_reading": "mq_count"}
+
+# primary key of each table, used to pick a chunk of rows to delete
+_KEYS = {
+    "wifi_scan":     ("received_at", "id"),
+    "dht22_reading": ("received_at", "id"),
+    "mq135_reading": ("received_at", "id"),
+    "rollup_1m":     ("scan_point_id", "bucket_start"),
+    "rollup_1h":     ("scan_point_id", "bucket_start"),
+}
+_TIME_COLUMN = {"rollup_1m": "bucket_start", "rollup_1h": "bucket_start"}
+
+
+def cutoff(days: int, now: datetime) -> Optional[datetime]:
+    """Rows older than this expire (whole UTC days); None when the tier keeps everything."""
+    if days <= 0:
+        return None
+    return (now - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _partition_range(table: str, name: str) -> Optional[Tuple[datetime, datetime]]:
+    """[start, end) of a partition named by partitions.partition_name(), or None (DEFAULT, others)."""
+    suffix = name[len(table) + 2:] if name.startswith(f"{table}_p") else ""
+    try:
+        start = datetime.strptime(suffix, "%Y%m%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+    return start, start + timedelta(days=PARTITIONED_TABLES[table])
+
+
+class Stopped(Exception):
+    pass
+
+
+class RetentionCompactor:
+    def __init__(self):
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._checked: Set[Tuple[str, datetime, datetime]] = set()   # ranges already rolled up, until deleted
+
+        # metrics
+        self.deleted: Dict[str, int] = {t: 0 for t in (*RAW_TIERS, *ROLLUP_TIERS)}
+        self.partitions_dropped = 0
+        self.ranges_rebuilt     = 0
+        self.archived: Dict[str, int] = {t: 0 for t in RAW_TIERS}
+        self.oldest: Dict[str, Optional[str]] = {}
+        self.step       = "idle"
+        self.runs       = 0
+        self.last_run   = None
+        self.last_error = None
+
+    # ── Helpers ──────────────────────────────────────────────────────────────
+
+    def _session(self) -> Session:
+        db = SessionLocal()
+        db.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+        return db
+
+    def _check(self) -> None:
+        if self._stopping.is_set():
+            raise Stopped()
+
+    def _oldest(self, table: str) -> Optional[datetime]:
+        column = _TIME_COLUMN.get(table, "received_at")
+        db = SessionLocal()
+        try:
+            return db.execute(text(f"SELECT min({column}) FROM {table}")).scalar()
+        finally:
+            db.close()
+
+    def _roll_up(self, table: str, lo: datetime, hi: datetime, now: datetime) -> None:
+        """
+        Make sure the raw rows of table in [lo, hi) are counted in rollup_1h,
+        rebuilding that sensor's rollups for the range when they are not.
+        Never rebuilds a range once its deletion may have started (see module notes).
+        """
+        if (table, lo, hi) in self._checked:
+            return
+        rollup_before = cutoff(ROLLUP_TIERS["rollup_1h"], now)
+        if rollup_before is not None and rollup_before > lo:
+            return   # the hourly tier has expired this range itself
+        params = {"lo": lo, "hi": hi}
+        db = SessionLocal()
+        try:
+            raw = db.execute(text(
+                f"SELECT count(*) FROM {table} "
+                "WHERE scan_point_id IS NOT NULL AND received_at >= :lo AND received_at < :hi"
+            ), params).scalar()
+            rolled = db.execute(text(
+                f"SELECT coalesce(sum({_ROLLUP_COUNT[table]}), 0) FROM rollup_1h "
+                "WHERE bucket_start >= :lo AND bucket_start < :hi"
+            ), params).scalar()
+            if raw > rolled:
+                rollups.rebuild_sensor(db, table, lo, hi)
+                db.commit()
+        finally:
+            db.close()
+        self._checked.add((table, lo, hi))
+        if raw > rolled:
+            self.ranges_rebuilt += 1
+            log.info("retention: rebuilt %s rollups for %s – %s (%d rows, %d counted)", table, lo, hi, raw, rolled)
+
+    def _archive(self, table: str, lo: datetime, hi: datetime) -> None:
+        if archive.enabled():
+            self.archived[table] += archive.archive_range(table, lo, hi)
+
+    def _delete_chunked(self, table: str, lo: Optional[datetime], hi: datetime) -> int:
+        """Delete the rows of table in [lo, hi) (everything before hi if lo is None), a chunk per transaction."""
+        column = _TIME_COLUMN.get(table, "received_at")
+        keys   = ", ".join(_KEYS[table])
+        where  = f"{column} < :hi" + (f" AND {column} >= :lo" if lo is not None else "")
+        total  = 0
+        while True:
+            self._check()
+            db = self._session()
+            try:
+                n = db.execute(text(
+                    f"DELETE FROM {table} WHERE ({keys}) IN "
+                    f"(SELECT {keys} FROM {table} WHERE {where} LIMIT :n)"
+                ), {"lo": lo, "hi": hi, "n": CHUNK_ROWS}).rowcount
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+            total += n
+            self.deleted[table] += n
+            if n < CHUNK_ROWS:
+                return total
+            time.sleep(CHUNK_PAUSE_S)
+
+    def _drop_partition(self, name: str) -> None:
+        db = self._session()
+        try:
+            db.execute(text(f"DROP TABLE {name}"))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        self.partitions_dropped += 1
+        log.info("retention: dropped partition %s", name)
+
+    # ── Tiers ────────────────────────────────────────────────────────────────
+
+    def _expire_raw(self, table: str, before: datetime, now: datetime) -> None:
+        db = SessionLocal()
+        try:
+            partitioned = is_partitioned(db, table)
+            names = partitions_of(db, table) if partitioned else set()
+        finally:
+            db.close()
+
+        # Whole partitions past the cutoff.
+        expired = sorted((r, name) for name in names
+                         if (r := _partition_range(table, name)) is not None and r[1] <= before)
+        for (lo, hi), name in expired:
+            self._check()
+            self.step = f"{table}: {name}"
+            self._roll_up(table, lo, hi, now)
+            self._archive(table, lo, hi)
+            self._drop_partition(name)
+            self._checked.discard((table, lo, hi))
+
+        # Whatever is left before the cutoff, a day at a time.
+        while True:
+            self._check()
+            oldest = self._oldest(table)
+            if oldest is None or oldest >= before:
+                return
+            lo = oldest.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+            hi = min(lo + timedelta(days=1), before)
+            self.step = f"{table}: {lo:%Y-%m-%d}"
+            self._roll_up(table, lo, hi, now)
+            self._archive(table, lo, hi)
+            self._delete_chunked(table, lo, hi)
+            self._checked.discard((table, lo, hi))
+
+    def run_once(self) -> None:
+        db = SessionLocal()
+        try:
+            locked = db.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": ADVISORY_LOCK}).scalar()
+            db.commit()   # the lock is held by the session; no transaction stays open during the run
+            if not locked:
+                return    # another worker is compacting
+            now = datetime.now(timezone.utc)
+            try:
+                for table, days in RAW_TIERS.items():
+                    before = cutoff(days, now)
+                    if before is not None:
+                        self._expire_raw(table, before, now)
+                for table, days in ROLLUP_TIERS.items():
+                    before = cutoff(days, now)
+                    if before is not None:
+                        self.step = table
+                        self._delete_chunked(table, None, before)
+                for table in (*RAW_TIERS, *ROLLUP_TIERS):
+                    oldest = self._oldest(table)
+                    self.oldest[table] = oldest.isoformat() if oldest else None
+            finally:
+                self.step = "idle"
+                db.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": ADVISORY_LOCK})
+                db.commit()
+            self.runs    += 1
+            self.last_run = now.isoformat()
+        finally:
+            db.close()
+
+    def _run(self) -> None:
+        if self._stopping.wait(START_DELAY_S):
+            return
+        while True:
+            try:
+                self.run_once()
+                self.last_error = None
+            except Stopped:
+                return
+            except Exception as exc:
+                self.last_error = str(exc)[:200]
+                log.warning("retention run failed, will retry: %s", exc)
+            if self._stopping.wait(RUN_INTERVAL_S):
+                return
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    # ── Metrics ──────────────────────────────────────────────────────────────
+
+    def stats(self) -> dict:
+        return {
+            "tiers_days":         {**RAW_TIERS, **ROLLUP_TIERS},
+            "step":               self.step,
+            "deleted":            dict(self.deleted),
+            "partitions_dropped": self.partitions_dropped,
+            "ranges_rebuilt":     self.ranges_rebuilt,
+            "archived":           dict(self.archived),
+            "oldest":             dict(self.oldest),
+            "runs":               self.runs,
+            "last_run":           self.last_run,
+            "last_error":         self.last_error,
+        }
+
+
+retention = RetentionCompactor()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    retention.run_once()
+    for name, value in retention.stats().items():
+        print(f"{name}: {value}")
@@ -0,0 +1,382 @@
+# rollups.py
+#
+# Per-minute and per-hour aggregates of the reading tables, per scan point.
+#
+# rollup_1m / rollup_1h (models.py) hold, for each (scan_point_id, bucket_start):
+#
+#   wifi_count, rssi_n, rssi_sum, rssi_min, rssi_max        wifi_scan
+#   dht_count, temp_sum/min/max, hum_sum/min/max            dht22_reading
+#   mq_count, ppm_sum/min/max, raw_n, raw_sum               mq135_reading
+#
+# They are maintained incrementally: write_batch() (ingest.py) and the history
+# importer add each batch's rows with one upsert per table, in the same
+# transaction as the rows themselves.  Every column is a count, sum, minimum or
+# maximum, so rows may arrive in any order — a backfill of last week simply
+# adds to last week's buckets.  The history endpoints read these tables instead
+# of the raw rows, so their cost depends on the number of buckets in the
+# window, not on the number of readings.
+#
+# Rows without a scan point are not rolled up (there is nothing to chart them
+# against).  Buckets are aligned to UTC.
+#
+# rebuild() recomputes a time range from the raw tables — for rows written
+# before the rollups existed, or loaded some other way (rebuild_sensor() does
+# the same for one sensor, see retention.py):
+#
+#   python rollups.py rebuild --since 2025-10-01
+
+import argparse
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import Float, func, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import Rollup1hDB, Rollup1mDB
+
+ROLLUP_TABLES = (Rollup1mDB.__table__, Rollup1hDB.__table__)
+
+_SUMS = ("wifi_count", "rssi_n", "rssi_sum", "dht_count", "temp_sum", "hum_sum",
+         "mq_count", "ppm_sum", "raw_n", "raw_sum")
+_MINS = ("rssi_min", "temp_min", "hum_min", "ppm_min")
+_MAXS = ("rssi_max", "temp_max", "hum_max", "ppm_max")
+
+Key = Tuple[int, datetime]
+
+
+def _empty(scan_point_id: int, bucket_start: datetime) -> dict:
+    cell = {"scan_point_id": scan_point_id, "bucket_start": bucket_start}
+    cell.update(dict.fromkeys(_SUMS, 0))
+    cell.update(dict.fromkeys(_MINS + _MAXS))
+    return cell
+
+
+def _extend(cell: dict, n: str, s: str, lo: str, hi: str, value) -> None:
+    cell[n] += 1
+    cell[s] += value
+    if cell[lo] is None or value < cell[lo]:
+        cell[lo] = value
+    if cell[hi] is None or value > cell[hi]:
+        cell[hi] = value
+
+
+class RollupBatch:
+    """Rollup cells for a batch of rows, added to the tables by upsert()."""
+
+    def __init__(self):
+        self.minute: Dict[Key, dict] = {}
+        self.hour:   Dict[Key, dict] = {}
+
+    def __len__(self) -> int:
+        return len(self.minute)
+
+    def _cells(self, scan_point_id: int, received_at: datetime):
+        if received_at.utcoffset():
+            received_at = received_at.astimezone(timezone.utc)
+        minute = received_at.replace(second=0, microsecond=0)
+        hour   = minute.replace(minute=0)
+        m = self.minute.get((scan_point_id, minute))
+        if m is None:
+            m = self.minute[(scan_point_id, minute)] = _empty(scan_point_id, minute)
+        h = self.hour.get((scan_point_id, hour))
+        if h is None:
+            h = self.hour[(scan_point_id, hour)] = _empty(scan_point_id, hour)
+        return m, h
+
+    def add_wifi(self, scan_point_id: Optional[int], received_at: datetime, rssi: Optional[int]) -> None:
+        if scan_point_id is None:
+            return
+        for cell in self._cells(scan_point_id, received_at):
+            cell["wifi_count"] += 1
+            if rssi is not None:
+                _extend(cell, "rssi_n", "rssi_sum", "rssi_min", "rssi_max", rssi)
+
+    def add_dht22(self, scan_point_id: Optional[int], received_at: datetime,
+                  temperature_c: float, humidity_pct: float) -> None:
+        if scan_point_id is None:
+            return
+        for cell in self._cells(scan_point_id, received_at):
+            _extend(cell, "dht_count", "temp_sum", "temp_min", "temp_max", temperature_c)
+            cell["hum_sum"] += humidity_pct
+            cell["hum_min"] = humidity_pct if cell["hum_min"] is None else min(cell["hum_min"], humidity_pct)
+            cell["hum_max"] = humidity_pct if cell["hum_max"] is None else max(cell["hum_max"], humidity_pct)
+
+    def add_mq135(self, scan_point_id: Optional[int], received_at: datetime,
+                  ppm: float, raw_value: Optional[int]) -> None:
+        if scan_point_id is None:
+            return
+        for cell in self._cells(scan_point_id, received_at):
+            _extend(cell, "mq_count", "ppm_sum", "ppm_min", "ppm_max", ppm)
+            if raw_value is not None:
+                cell["raw_n"]   += 1
+                cell["raw_sum"] += raw_value
+
+    def add_rows(self, wifi: Iterable[dict], dht22: Iterable[dict], mq135: Iterable[dict]) -> None:
+        """Add row dicts as built by ingest.py (wifi_row / dht22_row / mq135_row)."""
+        for r in wifi:
+            self.add_wifi(r["scan_point_id"], r["received_at"], r["rssi"])
+        for r in dht22:
+            self.add_dht22(r["scan_point_id"], r["received_at"], r["temperature_c"], r["humidity_pct"])
+        for r in mq135:
+            self.add_mq135(r["scan_point_id"], r["received_at"], r["ppm"], r["raw_value"])
+
+    def upsert(self, db) -> None:
+        """
+        Add the cells to rollup_1m / rollup_1h in the caller's transaction
+        (a Session or a Connection).  Keys are written in sorted order so two
+        concurrent batches never lock the same buckets in opposite orders.
+        """
+        for table, cells in zip(ROLLUP_TABLES, (self.minute, self.hour)):
+            if not cells:
+                continue
+            stmt = pg_insert(table)
+            ex   = stmt.excluded
+            set_ = {c: table.c[c] + ex[c] for c in _SUMS}
+            set_.update({c: func.least(table.c[c], ex[c]) for c in _MINS})
+            set_.update({c: func.greatest(table.c[c], ex[c]) for c in _MAXS})
+            stmt = stmt.on_conflict_do_update(index_elements=["scan_point_id", "bucket_start"], set_=set_)
+            db.execute(stmt, [cells[k] for k in sorted(cells)])
+
+
+# ── Reading ──────────────────────────────────────────────────────────────────
+
+def window(now: datetime, bucket_minutes: int, n_buckets: int) -> Tuple[datetime, timedelta]:
+    """
+    (start, step) of the n_buckets buckets ending with the one that holds now,
+    aligned to the UTC clock (so they are made of whole rollup buckets).
+    """
+    step  = timedelta(minutes=bucket_minutes)
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    end   = epoch + ((now - epoch) // step + 1) * step
+    return end - n_buckets * step, step
+
+
+def window_between(lo: datetime, hi: datetime, bucket_minutes: int) -> Tuple[datetime, int]:
+    """(start, n_buckets) of the UTC-aligned buckets of bucket_minutes that cover [lo, hi)."""
+    step  = timedelta(minutes=bucket_minutes)
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    start = epoch + ((lo - epoch) // step) * step
+    return start, max(1, -((start - hi) // step))
+
+
+def table_for(bucket_minutes: int):
+    """The rollup table whose buckets make up history buckets of bucket_minutes."""
+    return ROLLUP_TABLES[0] if bucket_minutes < 60 or bucket_minutes % 60 else ROLLUP_TABLES[1]
+
+
+def merge(buckets: Dict[int, dict], i: int, values: dict) -> None:
+    """Add the rollup column values to bucket i (sums added, minima / maxima kept)."""
+    cell = buckets.get(i)
+    if cell is None:
+        buckets[i] = dict(values)
+        return
+    for c, v in values.items():
+        if v is None:
+            continue
+        if cell[c] is None:
+            cell[c] = v
+        elif c in _MINS:
+            cell[c] = min(cell[c], v)
+        elif c in _MAXS:
+            cell[c] = max(cell[c], v)
+        else:
+            cell[c] += v
+
+
+def read_buckets(db, scan_point_id: int, start: datetime, bucket_minutes: int, n_buckets: int,
+                 columns: Iterable[str]) -> Dict[int, dict]:
+    """
+    The given rollup columns for one scan point, merged into n_buckets buckets
+    of bucket_minutes from start (see window() / window_between()).  Reads
+    rollup_1m for buckets shorter than an hour, rollup_1h otherwise.
+
+    The bucketing happens in Postgres — date_bin() onto the window's buckets
+    and GROUP BY, with generate_series() filling the empty ones — so exactly
+    n_buckets small rows come back however many rollup rows the window spans.
+    Returns {bucket index: {column: value}} for every bucket; an empty bucket
+    has zero counts and sums and NULL minima / maxima.
+    """
+    table = table_for(bucket_minutes)
+    columns = list(columns)
+    step = timedelta(minutes=bucket_minutes)
+
+    def aggregate(c: str) -> str:
+        if c in _MINS:
+            return f"min({c}) AS {c}"
+        if c in _MAXS:
+            return f"max({c}) AS {c}"
+        # sum() of an integer column is numeric; keep them integers
+        return f"sum({c})" + ("" if isinstance(table.c[c].type, Float) else "::bigint") + f" AS {c}"
+
+    def gap_filled(c: str) -> str:
+        return f"b.{c}" if c in _MINS or c in _MAXS else f"coalesce(b.{c}, 0) AS {c}"
+
+    rows = db.execute(text(f"""
+        WITH b AS (
+            SELECT date_bin(:step, bucket_start, :start) AS bucket_start, {", ".join(map(aggregate, columns))}
+            FROM {table.name}
+            WHERE scan_point_id = :sp AND bucket_start >= :start AND bucket_start < :end
+            GROUP BY 1
+        )
+        SELECT g.i, {", ".join(map(gap_filled, columns))}
+        FROM generate_series(0, :n - 1) AS g(i)
+        LEFT JOIN b ON b.bucket_start = :start + g.i * CAST(:step AS interval)
+        ORDER BY g.i
+    """), {"sp": scan_point_id, "start": start, "end": start + n_buckets * step, "step": step, "n": n_buckets}).all()
+    return {i: dict(zip(columns, values)) for i, *values in rows}
+
+
+# ── Rebuild from the raw tables ──────────────────────────────────────────────
+
+_REBUILD_1M = """
+INSERT INTO rollup_1m (scan_point_id, bucket_start,
+       wifi_count, rssi_n, rssi_sum, rssi_min, rssi_max,
+       dht_count, temp_sum, temp_min, temp_max, hum_sum, hum_min, hum_max,
+       mq_count, ppm_sum, ppm_min, ppm_max, raw_n, raw_sum)
+SELECT scan_point_id, bucket_start,
+       sum(wifi_count), sum(rssi_n), sum(rssi_sum), min(rssi_min), max(rssi_max),
+       sum(dht_count), sum(temp_sum), min(temp_min), max(temp_max), sum(hum_sum), min(hum_min), max(hum_max),
+       sum(mq_count), sum(ppm_sum), min(ppm_min), max(ppm_max), sum(raw_n), sum(raw_sum)
+FROM (
+    SELECT scan_point_id, date_trunc('minute', received_at) AS bucket_start,
+           count(*) AS wifi_count, count(rssi) AS rssi_n, coalesce(sum(rssi), 0) AS rssi_sum,
+           min(rssi) AS rssi_min, max(rssi) AS rssi_max,
+           0 AS dht_count, 0.0 AS temp_sum, NULL::float AS temp_min, NULL::float AS temp_max,
+           0.0 AS hum_sum, NULL::float AS hum_min, NULL::float AS hum_max,
+           0 AS mq_count, 0.0 AS ppm_sum, NULL::float AS ppm_min, NULL::float AS ppm_max,
+           0 AS raw_n, 0 AS raw_sum
+    FROM wifi_scan
+    WHERE scan_point_id IS NOT NULL AND received_at >= :lo AND received_at < :hi
+    GROUP BY 1, 2
+    UNION ALL
+    SELECT scan_point_id, date_trunc('minute', received_at),
+           0, 0, 0, NULL, NULL,
+           count(*), sum(temperature_c), min(temperature_c), max(temperature_c),
+           sum(humidity_pct), min(humidity_pct), max(humidity_pct),
+           0, 0.0, NULL, NULL, 0, 0
+    FROM dht22_reading
+    WHERE scan_point_id IS NOT NULL AND received_at >= :lo AND received_at < :hi
+    GROUP BY 1, 2
+    UNION ALL
+    SELECT scan_point_id, date_trunc('minute', received_at),
+           0, 0, 0, NULL, NULL,
+           0, 0.0, NULL, NULL, 0.0, NULL, NULL,
+           count(*), sum(ppm), min(ppm), max(ppm), count(raw_value), coalesce(sum(raw_value), 0)
+    FROM mq135_reading
+    WHERE scan_point_id IS NOT NULL AND received_at >= :lo AND received_at < :hi
+    GROUP BY 1, 2
+) AS per_table
+GROUP BY scan_point_id, bucket_start
+"""
+
+_REBUILD_1H = """
+INSERT INTO rollup_1h (scan_point_id, bucket_start,
+       wifi_count, rssi_n, rssi_sum, rssi_min, rssi_max,
+       dht_count, temp_sum, temp_min, temp_max, hum_sum, hum_min, hum_max,
+       mq_count, ppm_sum, ppm_min, ppm_max, raw_n, raw_sum)
+SELECT scan_point_id, date_trunc('hour', bucket_start),
+       sum(wifi_count), sum(rssi_n), sum(rssi_sum), min(rssi_min), max(rssi_max),
+       sum(dht_count), sum(temp_sum), min(temp_min), max(temp_max), sum(hum_sum), min(hum_min), max(hum_max),
+       sum(mq_count), sum(ppm_sum), min(ppm_min), max(ppm_max), sum(raw_n), sum(raw_sum)
+FROM rollup_1m
+WHERE bucket_start >= :lo AND bucket_start < :hi
+GROUP BY 1, 2
+"""
+
+
+def rebuild(db, lo: datetime, hi: datetime) -> None:
+    """
+    Recompute both rollups for [lo, hi) from the raw tables, replacing what is
+    there, in the caller's transaction.  lo and hi must be whole UTC hours.
+    Meant for ranges that are no longer receiving live ingest.
+    """
+    params = {"lo": lo, "hi": hi}
+    db.execute(text("SET LOCAL TimeZone = 'UTC'"))
+    for table in ROLLUP_TABLES:
+        db.execute(table.delete().where(table.c.bucket_start >= lo, table.c.bucket_start < hi))
+    db.execute(text(_REBUILD_1M), params)
+    db.execute(text(_REBUILD_1H), params)
+
+
+# Each sensor's rollup columns, as aggregates of its reading table.
+_SENSOR_COLUMNS = {
+    "wifi_scan": {
+        "wifi_count": "count(*)", "rssi_n": "count(rssi)", "rssi_sum": "coalesce(sum(rssi), 0)",
+        "rssi_min": "min(rssi)", "rssi_max": "max(rssi)",
+    },
+    "dht22_reading": {
+        "dht_count": "count(*)",
+        "temp_sum": "sum(temperature_c)", "temp_min": "min(temperature_c)", "temp_max": "max(temperature_c)",
+        "hum_sum": "sum(humidity_pct)", "hum_min": "min(humidity_pct)", "hum_max": "max(humidity_pct)",
+    },
+    "mq135_reading": {
+        "mq_count": "count(*)", "ppm_sum": "sum(ppm)", "ppm_min": "min(ppm)", "ppm_max": "max(ppm)",
+        "raw_n": "count(raw_value)", "raw_sum": "coalesce(sum(raw_value), 0)",
+    },
+}
+
+
+def rebuild_sensor(db, sensor_table: str, lo: datetime, hi: datetime) -> None:
+    """
+    Recompute only sensor_table's columns of both rollups for [lo, hi), in the
+    caller's transaction, leaving the other sensors' columns as they are —
+    safe when those sensors' raw rows have already expired (retention.py).
+    lo and hi must be whole UTC hours.
+    """
+    exprs  = _SENSOR_COLUMNS[sensor_table]
+    params = {"lo": lo, "hi": hi}
+    db.execute(text("SET LOCAL TimeZone = 'UTC'"))
+    for table, unit in zip(ROLLUP_TABLES, ("minute", "hour")):
+        in_range = table.c.bucket_start >= lo, table.c.bucket_start < hi
+        db.execute(table.update().where(*in_range).values(
+            {c: (0 if c in _SUMS else None) for c in exprs}
+        ))
+        others  = [c for c in _SUMS + _MINS + _MAXS if c not in exprs]
+        columns = ["scan_point_id", "bucket_start", *exprs, *others]
+        values  = ["scan_point_id", f"date_trunc('{unit}', received_at)", *exprs.values(),
+                   *("0" if c in _SUMS else "NULL" for c in others)]
+        db.execute(text(
+            f"INSERT INTO {table.name} ({', '.join(columns)}) "
+            f"SELECT {', '.join(values)} FROM {sensor_table} "
+            "WHERE scan_point_id IS NOT NULL AND received_at >= :lo AND received_at < :hi "
+            "GROUP BY 1, 2 "
+            "ON CONFLICT (scan_point_id, bucket_start) DO UPDATE SET "
+            + ", ".join(f"{c} = excluded.{c}" for c in exprs)
+        ), params)
+        db.execute(table.delete().where(
+            *in_range, table.c.wifi_count == 0, table.c.dht_count == 0, table.c.mq_count == 0,
+        ))
+
+
+def main() -> None:
+    from database import SessionLocal
+
+    p = argparse.ArgumentParser(description="Rebuild rollup_1m / rollup_1h from the reading tables")
+    sub = p.add_subparsers(dest="command", required=True)
+    rb = sub.add_parser("rebuild", help="recompute a time range, one day per transaction")
+    rb.add_argument("--since", required=True, help="ISO date/time (UTC), e.g. 2025-10-01")
+    rb.add_argument("--until", help="ISO date/time (UTC); default: the start of the current hour")
+    args = p.parse_args()
+
+    def _hour(value: str) -> datetime:
+        ts = datetime.fromisoformat(value)
+        ts = ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+        return ts.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+    now   = datetime.now(timezone.utc)
+    lo    = _hour(args.since)
+    until = _hour(args.until) if args.until else now.replace(minute=0, second=0, microsecond=0)
+    while lo < until:
+        hi = min(lo + timedelta(days=1), until)
+        db = SessionLocal()
+        try:
+            rebuild(db, lo, hi)
+            db.commit()
+        finally:
+            db.close()
+        print(f"rebuilt {lo:%Y-%m-%d %H:%M} – {hi:%Y-%m-%d %H:%M}")
+        lo = hi
+
+
+if __name__ == "__main__":
+    main()
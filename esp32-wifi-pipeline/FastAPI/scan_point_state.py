@@ -0,0 +1,182 @@
+# scan_point_state.py
+#
+# One row per scan point with its latest readings (scan_point_state, models.py):
+#
+#   wifi_count, rssi_n, rssi_sum, last_scan_at    running totals of wifi_scan
+#   temperature_c, humidity_pct, dht_at           newest dht22_reading
+#   ppm, raw_value, mq_at                         newest mq135_reading
+#
+# write_batch() (ingest.py) and import_history.py upsert it in the same
+# transaction as the readings.  A reading only replaces the stored one if it is
+# newer, so backfills of old data never overwrite a live value.  The heatmap
+# endpoints and /alerts read these rows — one per point, however long the
+# history.  Every write also gives the row a new version (a sequence), which
+# response_cache.py sums per floor plan to see what has changed.
+#
+# rebuild() recomputes every row, for data written before this table existed
+# or loaded some other way.  The WiFi totals are lifetime totals: they are
+# summed from rollup_1h, which outlives the raw wifi_scan rows (retention.py),
+# not from wifi_scan itself — so a rebuild after the raw tier has expired
+# keeps counting the expired scans.  last_scan_at comes from wifi_scan while it
+# has rows for the point, else it is the start of the newest hour with scans.
+# The newest DHT22 / MQ-135 readings come from their raw tables.  Rollups of
+# data loaded some other way need `python rollups.py rebuild` first.
+#
+#   python scan_point_state.py rebuild
+
+import argparse
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import case, func, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import SCAN_POINT_STATE_VERSION, ScanPointStateDB
+
+_TABLE = ScanPointStateDB.__table__
+
+
+def _empty(scan_point_id: int) -> dict:
+    return {
+        "scan_point_id": scan_point_id,
+        "wifi_count": 0, "rssi_n": 0, "rssi_sum": 0, "last_scan_at": None,
+        "temperature_c": None, "humidity_pct": None, "dht_at": None,
+        "ppm": None, "raw_value": None, "mq_at": None,
+    }
+
+
+class StateBatch:
+    """Per-point state changes of a batch of rows, applied by upsert()."""
+
+    def __init__(self):
+        self.points: Dict[int, dict] = {}
+
+    def _point(self, scan_point_id: int) -> dict:
+        p = self.points.get(scan_point_id)
+        if p is None:
+            p = self.points[scan_point_id] = _empty(scan_point_id)
+        return p
+
+    def add_wifi(self, scan_point_id: Optional[int], received_at: datetime, rssi: Optional[int]) -> None:
+        if scan_point_id is None:
+            return
+        p = self._point(scan_point_id)
+        p["wifi_count"] += 1
+        if rssi is not None:
+            p["rssi_n"]   += 1
+            p["rssi_sum"] += rssi
+        if p["last_scan_at"] is None or received_at > p["last_scan_at"]:
+            p["last_scan_at"] = received_at
+
+    def add_dht22(self, scan_point_id: Optional[int], received_at: datetime,
+                  temperature_c: float, humidity_pct: float) -> None:
+        if scan_point_id is None:
+            return
+        p = self._point(scan_point_id)
+        if p["dht_at"] is None or received_at >= p["dht_at"]:
+            p.update(temperature_c=temperature_c, humidity_pct=humidity_pct, dht_at=received_at)
+
+    def add_mq135(self, scan_point_id: Optional[int], received_at: datetime,
+                  ppm: float, raw_value: Optional[int]) -> None:
+        if scan_point_id is None:
+            return
+        p = self._point(scan_point_id)
+        if p["mq_at"] is None or received_at >= p["mq_at"]:
+            p.update(ppm=ppm, raw_value=raw_value, mq_at=received_at)
+
+    def add_rows(self, wifi: Iterable[dict], dht22: Iterable[dict], mq135: Iterable[dict]) -> None:
+        """Add row dicts as built by ingest.py (wifi_row / dht22_row / mq135_row)."""
+        for r in wifi:
+            self.add_wifi(r["scan_point_id"], r["received_at"], r["rssi"])
+        for r in dht22:
+            self.add_dht22(r["scan_point_id"], r["received_at"], r["temperature_c"], r["humidity_pct"])
+        for r in mq135:
+            self.add_mq135(r["scan_point_id"], r["received_at"], r["ppm"], r["raw_value"])
+
+    def upsert(self, db) -> None:
+        """
+        Apply the changes in the caller's transaction (a Session or a
+        Connection), in scan point order so concurrent batches lock rows in
+        the same order.
+        """
+        if not self.points:
+            return
+        stmt = pg_insert(_TABLE)
+        ex, c = stmt.excluded, _TABLE.c
+
+        def _newer(at: str):
+            return (ex[at].isnot(None)) & (c[at].is_(None) | (ex[at] >= c[at]))
+
+        set_ = {
+            "wifi_count":   c.wifi_count + ex.wifi_count,
+            "rssi_n":       c.rssi_n + ex.rssi_n,
+            "rssi_sum":     c.rssi_sum + ex.rssi_sum,
+            "last_scan_at": func.greatest(c.last_scan_at, ex.last_scan_at),
+            "updated_at":   func.clock_timestamp(),
+            "version":      SCAN_POINT_STATE_VERSION.next_value(),
+        }
+        for at, columns in (("dht_at", ("temperature_c", "humidity_pct", "dht_at")),
+                            ("mq_at",  ("ppm", "raw_value", "mq_at"))):
+            for col in columns:
+                set_[col] = case((_newer(at), ex[col]), else_=c[col])
+        stmt = stmt.on_conflict_do_update(index_elements=["scan_point_id"], set_=set_)
+        db.execute(stmt, [self.points[k] for k in sorted(self.points)])
+
+
+_REBUILD = """
+INSERT INTO scan_point_state AS s
+    (scan_point_id, wifi_count, rssi_n, rssi_sum, last_scan_at,
+     temperature_c, humidity_pct, dht_at, ppm, raw_value, mq_at)
+SELECT sp.id,
+       coalesce(w.n, 0), coalesce(w.rssi_n, 0), coalesce(w.rssi_sum, 0), coalesce(l.last_at, w.last_hour),
+       d.temperature_c, d.humidity_pct, d.received_at,
+       m.ppm, m.raw_value, m.received_at
+FROM scan_point sp
+LEFT JOIN (
+    SELECT scan_point_id, sum(wifi_count) AS n, sum(rssi_n) AS rssi_n, sum(rssi_sum) AS rssi_sum,
+           max(bucket_start) FILTER (WHERE wifi_count > 0) AS last_hour
+    FROM rollup_1h GROUP BY scan_point_id
+) w ON w.scan_point_id = sp.id
+LEFT JOIN (
+    SELECT scan_point_id, max(received_at) AS last_at
+    FROM wifi_scan WHERE scan_point_id IS NOT NULL GROUP BY scan_point_id
+) l ON l.scan_point_id = sp.id
+LEFT JOIN (
+    SELECT DISTINCT ON (scan_point_id) scan_point_id, temperature_c, humidity_pct, received_at
+    FROM dht22_reading WHERE scan_point_id IS NOT NULL
+    ORDER BY scan_point_id, received_at DESC, id DESC
+) d ON d.scan_point_id = sp.id
+LEFT JOIN (
+    SELECT DISTINCT ON (scan_point_id) scan_point_id, ppm, raw_value, received_at
+    FROM mq135_reading WHERE scan_point_id IS NOT NULL
+    ORDER BY scan_point_id, received_at DESC, id DESC
+) m ON m.scan_point_id = sp.id
+"""
+
+
+def rebuild(db) -> None:
+    """Recompute every scan point's state (see module notes), in the caller's transaction."""
+    db.execute(text("LOCK TABLE scan_point_state IN EXCLUSIVE MODE"))   # ingest waits; reads carry on
+    db.execute(_TABLE.delete())
+    db.execute(text(_REBUILD))
+
+
+def main() -> None:
+    from database import SessionLocal
+
+    p = argparse.ArgumentParser(description="Recompute scan_point_state from the reading tables")
+    sub = p.add_subparsers(dest="command", required=True)
+    sub.add_parser("rebuild", help="recompute every scan point (one full pass over the reading tables)")
+    p.parse_args()
+
+    db = SessionLocal()
+    try:
+        rebuild(db)
+        db.commit()
+        print(f"scan_point_state: {db.query(ScanPointStateDB).count()} scan points")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -90,10 +90,18 @@ WHERE b.name = 'Engineering Building A' AND fp.floor_name = 'Ground Floor'
 -- Point 2 (Lab 1.12)     — medium signal, busy    → esp32-b  avg ~-61 dBm
 -- Point 3 (Office Area)  — no device assigned     → no rows
 -- Point 4 (Conference)   — weak signal, moderate  → esp32-c  avg ~-75 dBm
+--
+-- The rows are collected in seed_scan first: wifi_scan stores an
+-- access_point id instead of ssid / bssid (see migrate_access_point.sql).
+
+CREATE TEMP TABLE seed_scan (
+    node TEXT, ssid TEXT, bssid TEXT, rssi SMALLINT, channel SMALLINT,
+    received_at TIMESTAMPTZ, scan_point_id INTEGER
+) ON COMMIT DROP;
 
 -- ── Point 1: Lecture Hall 101 — Strong Signal ─────────────────────────────────
 
-INSERT INTO wifi_scan (node, ssid, bssid, rssi, channel, received_at, scan_point_id)
+INSERT INTO seed_scan (node, ssid, bssid, rssi, channel, received_at, scan_point_id)
 SELECT
     'esp32-a',
     ssid,
@@ -151,7 +159,7 @@ CROSS JOIN (
 
 -- ── Point 2: Lab 1.12 — Medium Signal ────────────────────────────────────────
 
-INSERT INTO wifi_scan (node, ssid, bssid, rssi, channel, received_at, scan_point_id)
+INSERT INTO seed_scan (node, ssid, bssid, rssi, channel, received_at, scan_point_id)
 SELECT
     'esp32-b',
     ssid,
@@ -201,7 +209,7 @@ CROSS JOIN (
 
 -- ── Point 4: Conference Room — Weak Signal ────────────────────────────────────
 
-INSERT INTO wifi_scan (node, ssid, bssid, rssi, channel, received_at, scan_point_id)
+INSERT INTO seed_scan (node, ssid, bssid, rssi, channel, received_at, scan_point_id)
 SELECT
     'esp32-c',
     ssid,
@@ -241,6 +249,23 @@ CROSS JOIN (
     LIMIT 1
 ) AS sp;
 
+-- ── Access points and wifi_scan ───────────────────────────────────────────────
+
+INSERT INTO access_point (mac, bssid_text, ssid)
+SELECT DISTINCT ('x' || lpad(replace(bssid, ':', ''), 16, '0'))::bit(64)::bigint, bssid, ssid
+FROM seed_scan s
+WHERE NOT EXISTS (SELECT 1 FROM access_point ap
+                  WHERE ap.bssid_text = s.bssid AND ap.ssid = s.ssid AND ap.enc IS NULL);
+
+INSERT INTO wifi_scan (node, access_point_id, rssi, channel, received_at, scan_point_id)
+SELECT s.node, ap.id, s.rssi, s.channel, s.received_at, s.scan_point_id
+FROM seed_scan s
+CROSS JOIN LATERAL (
+    SELECT id FROM access_point ap
+    WHERE ap.bssid_text = s.bssid AND ap.ssid = s.ssid AND ap.enc IS NULL
+    ORDER BY id LIMIT 1
+) AS ap;
+
 COMMIT;
 
 -- ── Verification queries (run these manually to confirm) ─────────────────────
@@ -6,7 +6,12 @@
 # Install dependencies first:
 #   pip install pytest requests python-dotenv
 
+import gzip
+import json
 import os
+import struct
+import time
+import uuid
 import pytest
 import requests
 
@@ -186,6 +191,235 @@ class TestIngest:
         if res.status_code == 200:
             assert res.json()["status"] == "Assigned"
 
+    def test_ingest_bad_row_is_rejected_alone(self):
+        """POST /ingest keeps the good scans when one scan entry is malformed."""
+        res = requests.post(f"{BASE_URL}/ingest", json={
+            "node": KNOWN_NODE,
+            "scans": [{"ssid": "TestNet", "bssid": "aa:bb:cc:dd:ee:ff",
+                        "rssi": -70, "channel": 1, "enc": 4},
+                      {"ssid": "BadNet", "bssid": "aa:bb:cc:dd:ee:00",
+                        "rssi": "not-a-number", "channel": 1, "enc": 4}]
+        })
+        # Accept 200 (assigned) or 403 (not assigned yet)
+        assert res.status_code in [200, 403]
+        if res.status_code == 200:
+            assert res.json()["accepted"] == 1
+            assert res.json()["rejected"] == 1
+
+
+    def test_ingest_rssi_out_of_smallint_range_is_rejected(self):
+        """POST /ingest rejects an rssi that does not fit wifi_scan's SMALLINT column."""
+        res = requests.post(f"{BASE_URL}/ingest", json={
+            "node": KNOWN_NODE,
+            "scans": [{"ssid": "TestNet", "bssid": "aa:bb:cc:dd:ee:ff",
+                        "rssi": -70, "channel": 1, "enc": 4},
+                      {"ssid": "TestNet", "bssid": "aa:bb:cc:dd:ee:ff",
+                        "rssi": 40000, "channel": 1, "enc": 4}]
+        })
+        assert res.status_code in [200, 403]
+        if res.status_code == 200:
+            assert res.json()["accepted"] == 1
+            assert res.json()["rejected"] == 1
+
+    def test_raw_scans_return_bssid_as_sent(self):
+        """GET /wifi/rawScans still returns ssid / bssid / enc, spelled as ingested."""
+        bssid = f"0a-1b-2c-{uuid.uuid4().hex[:2]}-{uuid.uuid4().hex[:2]}-{uuid.uuid4().hex[:2]}"
+        res = requests.post(f"{BASE_URL}/ingest", json={
+            "node": KNOWN_NODE,
+            "scans": [{"ssid": "CompatNet", "bssid": bssid, "rssi": -61, "channel": 11, "enc": "WPA2"}]
+        })
+        assert res.status_code in [200, 403]
+        if res.status_code == 200:
+            rows = requests.get(f"{BASE_URL}/wifi/rawScans", params={"limit": 50}).json()["rows"]
+            row = next(r for r in rows if r["bssid"] == bssid)
+            assert (row["ssid"], row["rssi"], row["channel"], row["enc"]) == ("CompatNet", -61, 11, "WPA2")
+
+    def test_ingest_async_mode_returns_202(self):
+        """POST /ingest?mode=async queues the batch and answers 202 (or 403/429)."""
+        res = requests.post(f"{BASE_URL}/ingest?mode=async", json={
+            "node": KNOWN_NODE,
+            "scans": [{"ssid": "TestNet", "bssid": "aa:bb:cc:dd:ee:ff",
+                        "rssi": -70, "channel": 1, "enc": 4}]
+        })
+        assert res.status_code in [202, 403, 429]
+        if res.status_code == 202:
+            assert res.json()["status"] == "Queued"
+        if res.status_code == 429:
+            assert "Retry-After" in res.headers
+
+    def test_ingest_invalid_mode_returns_422(self):
+        """POST /ingest?mode=bogus is rejected by validation."""
+        res = requests.post(f"{BASE_URL}/ingest?mode=bogus", json={
+            "node": KNOWN_NODE, "scans": [{"ssid": "TestNet", "rssi": -70}]
+        })
+        assert res.status_code == 422
+
+    def test_ingest_metrics_returns_queue_stats(self):
+        """GET /metrics/ingest exposes the write-behind queue depth."""
+        res = requests.get(f"{BASE_URL}/metrics/ingest")
+        assert res.status_code == 200
+        assert "depth_rows" in res.json()["queue"]
+
+    def test_ingest_metrics_reports_partitions(self):
+        """GET /metrics/ingest lists the partition count of each reading table."""
+        res = requests.get(f"{BASE_URL}/metrics/ingest")
+        assert res.status_code == 200
+        partitions = res.json()["partitions"]["partitions"]
+        assert set(partitions) <= {"wifi_scan", "dht22_reading", "mq135_reading"}
+
+    def test_ingest_metrics_reports_retention(self):
+        """GET /metrics/ingest shows the retention tiers and what has been expired."""
+        res = requests.get(f"{BASE_URL}/metrics/ingest")
+        assert res.status_code == 200
+        retention = res.json()["retention"]
+        assert {"wifi_scan", "rollup_1m", "rollup_1h"} <= set(retention["tiers_days"])
+        assert set(retention["deleted"]) == set(retention["tiers_days"])
+
+    def test_ingest_metrics_reports_archive(self):
+        """GET /metrics/ingest says whether the Parquet archive is enabled and what it holds."""
+        res = requests.get(f"{BASE_URL}/metrics/ingest")
+        assert res.status_code == 200
+        archive = res.json()["archive"]
+        assert isinstance(archive["enabled"], bool)
+        assert archive["rows_archived"] >= 0
+        assert set(res.json()["retention"]["archived"]) == {"wifi_scan", "dht22_reading", "mq135_reading"}
+
+    def test_ingest_packed_body_is_accepted(self):
+        """POST /ingest with the packed binary layout stores the scans like JSON."""
+        node = KNOWN_NODE.encode()
+        body = (struct.pack("<2sBB", b"MS", 1, len(node)) + node
+                + struct.pack("<B", 0) + struct.pack("<H", 1)
+                + struct.pack("<6sbBBB", bytes.fromhex("aabbccddeeff"), -70, 1, 4, 7) + b"TestNet")
+        res = requests.post(f"{BASE_URL}/ingest", data=body,
+                            headers={"Content-Type": "application/x-mssia-packed"})
+        assert res.status_code in [200, 403]
+        if res.status_code == 200:
+            assert res.json()["accepted"] == 1
+
+    def test_ingest_gzip_body_is_accepted(self):
+        """POST /ingest with Content-Encoding: gzip is inflated before decoding."""
+        body = gzip.compress(json.dumps({
+            "node": KNOWN_NODE,
+            "scans": [{"ssid": "TestNet", "bssid": "aa:bb:cc:dd:ee:ff",
+                        "rssi": -70, "channel": 1, "enc": 4}] * 20
+        }).encode())
+        res = requests.post(f"{BASE_URL}/ingest", data=body,
+                            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+        assert res.status_code in [200, 403]
+        if res.status_code == 200:
+            assert res.json()["accepted"] == 20
+
+    def test_ingest_gzip_bomb_returns_413(self):
+        """A small gzip body that inflates past the size cap is refused with 413."""
+        body = gzip.compress(b" " * (64 * 1024 * 1024))
+        res = requests.post(f"{BASE_URL}/ingest", data=body,
+                            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+        assert res.status_code == 413
+
+    def test_ingest_retry_with_same_batch_id_is_duplicate(self):
+        """POST /ingest twice with the same batch_id stores the readings once."""
+        payload = {
+            "node": KNOWN_NODE,
+            "batch_id": uuid.uuid4().hex,
+            "scans": [{"ssid": "TestNet", "bssid": "aa:bb:cc:dd:ee:ff",
+                        "rssi": -70, "channel": 1, "enc": 4}]
+        }
+        first  = requests.post(f"{BASE_URL}/ingest", json=payload)
+        second = requests.post(f"{BASE_URL}/ingest", json=payload)
+        assert first.status_code in [200, 403]
+        if first.status_code == 200:
+            assert first.json()["status"] == "Assigned"
+            assert second.status_code == 200
+            assert second.json()["status"] == "Duplicate"
+            assert second.json()["accepted"] == 0
+
+    def test_ingest_unknown_content_type_returns_415(self):
+        """POST /ingest with an unsupported Content-Type returns 415."""
+        res = requests.post(f"{BASE_URL}/ingest", data="node=x",
+                            headers={"Content-Type": "text/plain"})
+        assert res.status_code == 415
+
+
+class TestIngestBatch:
+    def test_ingest_batch_reports_status_per_envelope(self):
+        """POST /ingest/batch returns one result per envelope, in order."""
+        res = requests.post(f"{BASE_URL}/ingest/batch", json=[
+            {"node": KNOWN_NODE,
+             "scans": [{"ssid": "TestNet", "bssid": "aa:bb:cc:dd:ee:ff",
+                        "rssi": -70, "channel": 1, "enc": 4}]},
+            {"node": UNKNOWN_NODE,
+             "scans": [{"ssid": "TestNet", "rssi": -65}]},
+            {"scans": [{"ssid": "TestNet", "rssi": -65}]},
+        ])
+        assert res.status_code in [200, 202]
+        results = res.json()["results"]
+        assert [r["index"] for r in results] == [0, 1, 2]
+        assert results[0]["code"] in [200, 202, 403]
+        assert results[1]["code"] == 403
+        assert results[2]["code"] == 400
+
+    def test_ingest_batch_empty_returns_400(self):
+        """POST /ingest/batch with an empty array returns 400."""
+        res = requests.post(f"{BASE_URL}/ingest/batch", json=[])
+        assert res.status_code == 400
+
+
+class TestIngestBackfill:
+    def test_backfill_stores_records_at_device_time(self):
+        """POST /ingest/backfill anchors millis() stamps to the upload's uptime_ms."""
+        res = requests.post(f"{BASE_URL}/ingest/backfill", json={
+            "node": KNOWN_NODE,
+            "uptime_ms": 3_600_000,
+            "records": [
+                {"ts_ms": 1_800_000, "scans": [{"ssid": "TestNet", "bssid": "aa:bb:cc:dd:ee:ff",
+                                                "rssi": -70, "channel": 1, "enc": 4}]},
+                {"ts_ms": 600_000, "scans": [{"ssid": "TestNet", "bssid": "aa:bb:cc:dd:ee:ff",
+                                              "rssi": -72, "channel": 1, "enc": 4}]},
+            ]
+        })
+        assert res.status_code in [200, 403]
+        if res.status_code == 200:
+            body = res.json()
+            assert body["accepted_records"] == 2
+            assert body["rows"] == 2
+            assert body["oldest"] < body["newest"]
+
+    def test_backfill_rejects_future_record_alone(self):
+        """A record far in the future is rejected; the rest of the upload is kept."""
+        res = requests.post(f"{BASE_URL}/ingest/backfill", json={
+            "node": KNOWN_NODE,
+            "records": [
+                {"ts": time.time() - 3600, "scans": [{"ssid": "TestNet", "rssi": -70}]},
+                {"ts": "2999-01-01T00:00:00Z", "scans": [{"ssid": "TestNet", "rssi": -70}]},
+            ]
+        })
+        assert res.status_code in [200, 403]
+        if res.status_code == 200:
+            assert res.json()["accepted_records"] == 1
+            assert [r["index"] for r in res.json()["rejected_records"]] == [1]
+
+    def test_backfill_missing_records_returns_400(self):
+        """POST /ingest/backfill without records returns 400."""
+        res = requests.post(f"{BASE_URL}/ingest/backfill", json={"node": KNOWN_NODE})
+        assert res.status_code == 400
+
+    def test_backfilled_reading_appears_in_history(self):
+        """A backfilled DHT22 reading is rolled up and served by dht22-history."""
+        res = requests.post(f"{BASE_URL}/ingest/backfill", json={
+            "node": KNOWN_NODE,
+            "records": [{"ts": time.time() - 1800,
+                         "temperature": {"temperature_c": 21.5, "humidity_pct": 40.0}}],
+        })
+        assert res.status_code in [200, 403]
+        if res.status_code == 200:
+            point_id = res.json()["scan_point_id"]
+            history = requests.get(f"{BASE_URL}/scan-points/{point_id}/dht22-history?time_range=1h").json()
+            assert history["bucket_minutes"] == 1
+            assert history["count"] >= 1
+            reading = history["readings"][0]
+            assert reading["samples"] >= 1
+            assert reading["temperature_min"] <= reading["temperature_c"] <= reading["temperature_max"]
+
 
 # ── Buildings ─────────────────────────────────────────────────────────────────
 
@@ -231,6 +465,121 @@ class TestHeatmap:
         if res.status_code == 200:
             assert isinstance(res.json(), list)
 
+    def test_dht22_heatmap_keeps_newest_reading_over_backfill(self):
+        """An older backfilled reading does not replace the point's latest one."""
+        def backfill(age_s, temp_c):
+            return requests.post(f"{BASE_URL}/ingest/backfill", json={
+                "node": KNOWN_NODE,
+                "records": [{"ts": time.time() - age_s,
+                             "temperature": {"temperature_c": temp_c, "humidity_pct": 45.0}}],
+            })
+        res = backfill(5, 22.25)
+        assert res.status_code in [200, 403]
+        if res.status_code == 200:
+            assert backfill(7200, 5.0).status_code == 200
+            point_id = res.json()["scan_point_id"]
+            device = next(d for d in requests.get(f"{BASE_URL}/devices").json()["devices"]
+                          if d["scan_point_id"] == point_id)
+            points = requests.get(f"{BASE_URL}/heatmap/floorplan/{device['floorplan_id']}/dht22").json()
+            point = next(p for p in points if p["scan_point_id"] == point_id)
+            assert point["temperature_c"] != 5.0
+            assert point["received_at"] is not None
+
+    def test_mq135_heatmap_many_floorplans(self):
+        """GET /heatmap/mq135?floorplan_id=..&floorplan_id=.. returns the points of every floor plan."""
+        floorplan_id = requests.get(f"{BASE_URL}/devices").json()["devices"][0]["floorplan_id"]
+        single = requests.get(f"{BASE_URL}/heatmap/floorplan/{floorplan_id}/mq135").json()
+        res = requests.get(f"{BASE_URL}/heatmap/mq135", params={"floorplan_id": [floorplan_id, floorplan_id]})
+        assert res.status_code == 200
+        points = res.json()
+        assert all(p["floorplan_id"] == floorplan_id for p in points)
+        assert [{k: v for k, v in p.items() if k != "floorplan_id"} for p in points] == single
+
+    def test_mq135_heatmap_many_unknown_floorplan_returns_404(self):
+        """GET /heatmap/mq135 with an unknown floor plan id returns 404."""
+        res = requests.get(f"{BASE_URL}/heatmap/mq135", params={"floorplan_id": [999999]})
+        assert res.status_code == 404
+
+    def test_combined_heatmap_matches_layer_endpoints(self):
+        """GET /heatmap/floorplan/{id}/combined returns what the per-sensor heatmaps return."""
+        floorplan_id = requests.get(f"{BASE_URL}/devices").json()["devices"][0]["floorplan_id"]
+        res = requests.get(f"{BASE_URL}/heatmap/floorplan/{floorplan_id}/combined")
+        assert res.status_code == 200
+        data = res.json()
+        assert data["layers"] == ["wifi", "temperature", "humidity", "air"]
+        dht22 = {p["scan_point_id"]: p for p in requests.get(f"{BASE_URL}/heatmap/floorplan/{floorplan_id}/dht22").json()}
+        mq135 = {p["scan_point_id"]: p for p in requests.get(f"{BASE_URL}/heatmap/floorplan/{floorplan_id}/mq135").json()}
+        assert {p["scan_point_id"] for p in data["points"]} == set(dht22)
+        for point in data["points"]:
+            assert point["temperature"]["temperature_c"] == dht22[point["scan_point_id"]]["temperature_c"]
+            assert point["air"]["air_level"] == mq135[point["scan_point_id"]]["air_level"]
+
+    def test_combined_heatmap_selected_layers(self):
+        """?layers= returns only the requested layers; unknown layers return 422."""
+        floorplan_id = requests.get(f"{BASE_URL}/devices").json()["devices"][0]["floorplan_id"]
+        url = f"{BASE_URL}/heatmap/floorplan/{floorplan_id}/combined"
+        data = requests.get(url, params={"layers": "air,wifi"}).json()
+        assert data["layers"] == ["wifi", "air"]
+        assert all("temperature" not in p and "wifi" in p and "air" in p for p in data["points"])
+        assert requests.get(url, params={"layers": "noise"}).status_code == 422
+
+    def test_combined_heatmap_unknown_floorplan_returns_404(self):
+        """GET /heatmap/floorplan/999999/combined returns 404."""
+        assert requests.get(f"{BASE_URL}/heatmap/floorplan/999999/combined").status_code == 404
+
+    def test_alerts_returns_list(self):
+        """GET /alerts returns 200 with an alerts array."""
+        res = requests.get(f"{BASE_URL}/alerts")
+        assert res.status_code == 200
+        assert isinstance(res.json()["alerts"], list)
+
+
+# ── Conditional GET ───────────────────────────────────────────────────────────
+
+class TestConditionalGet:
+    def _heatmap_url(self):
+        floorplan_id = next(d for d in requests.get(f"{BASE_URL}/devices").json()["devices"]
+                            if d["node"] == KNOWN_NODE)["floorplan_id"]
+        return f"{BASE_URL}/heatmap/floorplan/{floorplan_id}/combined"
+
+    def test_heatmap_if_none_match_returns_304(self):
+        """A heatmap response carries a weak ETag; sending it back returns 304 with no body."""
+        url = self._heatmap_url()
+        res = requests.get(url)
+        assert res.status_code == 200
+        etag = res.headers.get("ETag")
+        if etag is None:
+            pytest.skip("response cache not running (watermarks not loaded yet)")
+        assert etag.startswith('W/"')
+        again = requests.get(url, headers={"If-None-Match": etag})
+        assert again.status_code == 304
+        assert again.headers["ETag"] == etag
+        assert again.content == b""
+
+    def test_if_none_match_on_unknown_floorplan_returns_404(self):
+        """If-None-Match: * does not turn a missing floor plan into a 304."""
+        res = requests.get(f"{BASE_URL}/heatmap/floorplan/999999/combined", headers={"If-None-Match": "*"})
+        assert res.status_code == 404
+
+    def test_ingest_changes_heatmap_etag(self):
+        """New readings on a floor plan give its heatmap a new ETag and the new data."""
+        url = self._heatmap_url()
+        before = requests.get(url)
+        res = requests.post(f"{BASE_URL}/ingest", json={
+            "node": KNOWN_NODE,
+            "scans": [{"ssid": "TestNet", "bssid": "aa:bb:cc:dd:ee:ff",
+                        "rssi": -70, "channel": 1, "enc": 4}]
+        })
+        assert res.status_code in [200, 403]
+        if res.status_code != 200 or "ETag" not in before.headers:
+            return
+        after = requests.get(url, headers={"If-None-Match": before.headers["ETag"]})
+        assert after.status_code == 200
+        # uncached (no ETag) until the next watermark poll, then a new tag
+        assert after.headers.get("ETag") != before.headers["ETag"]
+        samples = lambda r: sum(p["wifi"]["samples"] for p in r.json()["points"])
+        assert samples(after) > samples(before)
+
 
 # ── WiFi History ──────────────────────────────────────────────────────────────
 
@@ -253,6 +602,101 @@ class TestWifiHistory:
             assert res.status_code in [200, 404], \
                 f"Range {time_range} returned unexpected status {res.status_code}"
 
+    def test_wifi_history_custom_window(self):
+        """GET /scan-points/{id}/wifi-history?from=&to=&bucket= returns one bucket per period."""
+        point_id = requests.get(f"{BASE_URL}/devices").json()["devices"][0]["scan_point_id"]
+        res = requests.get(f"{BASE_URL}/scan-points/{point_id}/wifi-history",
+                           params={"from": "2026-01-01T00:00:00Z", "to": "2026-01-01T06:00:00Z", "bucket": 15})
+        assert res.status_code == 200
+        data = res.json()
+        assert data["range"] == "custom"
+        assert data["n_buckets"] == 24
+        assert len(data["buckets"]) == 24
+        assert data["buckets"][1]["bucket_start"] == "2026-01-01T00:15:00+00:00"
+
+    def test_wifi_history_custom_window_picks_bucket(self):
+        """Without bucket, a custom window is split into at most 100 buckets."""
+        point_id = requests.get(f"{BASE_URL}/devices").json()["devices"][0]["scan_point_id"]
+        res = requests.get(f"{BASE_URL}/scan-points/{point_id}/wifi-history",
+                           params={"from": "2026-01-01T00:00:00Z", "to": "2026-01-03T00:00:00Z"})
+        assert res.status_code == 200
+        assert res.json()["bucket_minutes"] == 30
+        assert len(res.json()["buckets"]) == 96
+
+    def test_wifi_history_invalid_window_returns_400(self):
+        """from after to, or too many buckets, returns 400."""
+        point_id = requests.get(f"{BASE_URL}/devices").json()["devices"][0]["scan_point_id"]
+        url = f"{BASE_URL}/scan-points/{point_id}/wifi-history"
+        res = requests.get(url, params={"from": "2026-01-02T00:00:00Z", "to": "2026-01-01T00:00:00Z"})
+        assert res.status_code == 400
+        res = requests.get(url, params={"from": "2025-01-01T00:00:00Z", "to": "2026-01-01T00:00:00Z", "bucket": 1})
+        assert res.status_code == 400
+
+
+# ── Sensor History ────────────────────────────────────────────────────────────
+
+class TestSensorHistory:
+    def _point_id(self):
+        return requests.get(f"{BASE_URL}/devices").json()["devices"][0]["scan_point_id"]
+
+    def test_envelope_caps_points(self):
+        """max_points widens the buckets so at most that many readings come back."""
+        for sensor in ["dht22", "mq135"]:
+            res = requests.get(f"{BASE_URL}/scan-points/{self._point_id()}/{sensor}-history",
+                               params={"time_range": "30d", "max_points": 50})
+            assert res.status_code == 200
+            data = res.json()
+            assert data["downsample"] == "envelope"
+            assert data["bucket_minutes"] == 1440
+            assert data["count"] <= 50
+
+    def test_lttb_returns_minutes(self):
+        """downsample=lttb picks at most max_points 1-minute readings."""
+        for sensor in ["dht22", "mq135"]:
+            res = requests.get(f"{BASE_URL}/scan-points/{self._point_id()}/{sensor}-history",
+                               params={"time_range": "24h", "max_points": 20, "downsample": "lttb"})
+            assert res.status_code == 200
+            data = res.json()
+            assert data["bucket_minutes"] == 1
+            assert data["count"] <= 20
+            times = [r["received_at"] for r in data["readings"]]
+            assert times == sorted(times)
+
+    def test_invalid_max_points_returns_422(self):
+        """max_points below 3 or an unknown downsample method returns 422."""
+        url = f"{BASE_URL}/scan-points/{self._point_id()}/dht22-history"
+        assert requests.get(url, params={"max_points": 2}).status_code == 422
+        assert requests.get(url, params={"max_points": 10, "downsample": "median"}).status_code == 422
+
+
+# ── Scan Points ───────────────────────────────────────────────────────────────
+
+class TestScanPoints:
+    def _floorplan_id(self):
+        return requests.get(f"{BASE_URL}/devices").json()["devices"][0]["floorplan_id"]
+
+    def test_list_scan_points_skips_counts_by_default(self):
+        """GET /floorplans/{id}/scan-points leaves scan_count out unless asked."""
+        res = requests.get(f"{BASE_URL}/floorplans/{self._floorplan_id()}/scan-points")
+        assert res.status_code == 200
+        points = res.json()["scan_points"]
+        assert points
+        assert all("scan_count" not in p for p in points)
+
+    def test_list_scan_points_include_counts(self):
+        """?include=counts adds each point's scan_count."""
+        res = requests.get(f"{BASE_URL}/floorplans/{self._floorplan_id()}/scan-points",
+                           params={"include": "counts"})
+        assert res.status_code == 200
+        points = res.json()["scan_points"]
+        assert all(isinstance(p["scan_count"], int) and p["scan_count"] >= 0 for p in points)
+
+    def test_list_scan_points_invalid_include_returns_422(self):
+        """An unknown include value returns 422."""
+        res = requests.get(f"{BASE_URL}/floorplans/{self._floorplan_id()}/scan-points",
+                           params={"include": "everything"})
+        assert res.status_code == 422
+
 
 # ── Devices ───────────────────────────────────────────────────────────────────
 
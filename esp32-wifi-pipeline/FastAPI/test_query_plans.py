@@ -0,0 +1,164 @@
+"""
+test_query_plans.py — query plan regression suite for the read endpoints.
+
+Seeds a synthetic dataset (PLAN_TEST_ROWS WiFi scans plus DHT22 / MQ-135
+readings, their rollups and scan_point_state) inside a transaction that is
+rolled back at the end, calls every GET endpoint in-process, captures the
+SQL each one runs, and EXPLAINs it against the seeded tables.  A test fails
+when a plan reads a large relation (more than SEQ_SCAN_MAX_ROWS rows) with a
+sequential scan — a missing or unusable index.
+
+Needs a reachable Postgres (DATABASE_URL), not the API server.
+
+Run:
+    pytest test_query_plans.py -v
+"""
+
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from database import engine, get_db
+
+try:
+    with engine.connect():
+        pass
+except OperationalError:
+    pytest.skip("Postgres not reachable (DATABASE_URL)", allow_module_level=True)
+
+from fastapi.testclient import TestClient
+
+import main
+import rollups
+import scan_point_state
+
+ROWS              = int(os.getenv("PLAN_TEST_ROWS", "200000"))
+SEQ_SCAN_MAX_ROWS = 10_000
+
+# Endpoints that never end (server-sent events) are left out.
+SKIP_PATHS = {"/events/floorplan/{floorplan_id}/heatmap"}
+
+# Query strings tried for each path, on top of the defaults.
+VARIANTS = {
+    "/scan-points/{point_id}/wifi-history":  ["time_range=1h", "time_range=24h", "time_range=7d",
+                                              "from=2026-01-01T00:00:00Z&bucket=360"],
+    "/scan-points/{point_id}/dht22-history": ["time_range=1h", "time_range=30d", "time_range=30d&max_points=1000",
+                                              "time_range=30d&max_points=500&downsample=lttb"],
+    "/scan-points/{point_id}/mq135-history": ["time_range=1h", "time_range=30d", "time_range=30d&max_points=1000",
+                                              "time_range=30d&max_points=500&downsample=lttb"],
+    "/floorplans/{floorplan_id}/scan-points": ["include=counts"],
+    "/heatmap/floorplan/{floorplan_id}/combined": ["layers=air"],
+    "/heatmap/mq135":                        ["floorplan_id={floorplan_id}&floorplan_id=1"],
+    "/wifi/rawScans":                        ["limit=1000"],
+}
+
+
+@pytest.fixture(scope="module")
+def seeded():
+    """A session on a connection whose transaction holds the synthetic data; rolled back afterwards."""
+    conn = engine.connect()
+    trans = conn.begin()
+    db = Session(bind=conn, join_transaction_mode="create_savepoint")
+    now = datetime.now(timezone.utc)
+    lo = now - timedelta(days=10)
+    params = {"rows": ROWS, "lo": lo, "span": (now - lo).total_seconds()}
+
+    building_id = db.execute(text(
+        "INSERT INTO building (name) VALUES ('plan-test ' || gen_random_uuid()) RETURNING id"
+    )).scalar()
+    floorplan_id = db.execute(text(
+        "INSERT INTO floor_plan (building_id, floor_name, image_url) VALUES (:b, 'Plan test', '/x.png') RETURNING id"
+    ), {"b": building_id}).scalar()
+    db.execute(text(
+        "INSERT INTO scan_point (floorplan_id, x, y, assigned_node) "
+        "SELECT :fp, random(), random(), 'PLAN-TEST-' || i FROM generate_series(1, 20) i"
+    ), {"fp": floorplan_id})
+    points = db.execute(text("SELECT id FROM scan_point WHERE floorplan_id = :fp ORDER BY id"),
+                        {"fp": floorplan_id}).scalars().all()
+    params["sp0"], params["nsp"] = points[0], len(points)
+    db.execute(text(
+        "INSERT INTO access_point (mac, ssid, enc) "
+        "SELECT 200000000000 + i, 'plan-test-' || (i % 40), 'WPA2' FROM generate_series(1, 500) i"
+    ))
+    params["ap0"] = db.execute(text("SELECT min(id) FROM access_point WHERE mac > 200000000000")).scalar()
+
+    db.execute(text(
+        "INSERT INTO wifi_scan (received_at, node, scan_point_id, access_point_id, rssi, channel) "
+        "SELECT :lo + make_interval(secs => random() * :span), 'PLAN-TEST-' || (i % :nsp + 1), "
+        "       :sp0 + i % :nsp, :ap0 + i % 500, -40 - (i % 50), 1 + i % 11 "
+        "FROM generate_series(1, :rows) i"
+    ), params)
+    db.execute(text(
+        "INSERT INTO dht22_reading (received_at, node, scan_point_id, temperature_c, humidity_pct) "
+        "SELECT :lo + make_interval(secs => random() * :span), 'PLAN-TEST-' || (i % :nsp + 1), "
+        "       :sp0 + i % :nsp, 18 + random() * 6, 35 + random() * 30 "
+        "FROM generate_series(1, :rows / 4) i"
+    ), params)
+    db.execute(text(
+        "INSERT INTO mq135_reading (received_at, node, scan_point_id, ppm, raw_value) "
+        "SELECT :lo + make_interval(secs => random() * :span), 'PLAN-TEST-' || (i % :nsp + 1), "
+        "       :sp0 + i % :nsp, 1500 + random() * 1500, 1500 + (i % 1500) "
+        "FROM generate_series(1, :rows / 4) i"
+    ), params)
+    rollups.rebuild(db, lo, now + timedelta(hours=1))
+    scan_point_state.rebuild(db)
+    for table in ("access_point", "wifi_scan", "dht22_reading", "mq135_reading",
+                  "rollup_1m", "rollup_1h", "scan_point", "scan_point_state"):
+        db.execute(text(f"ANALYZE {table}"))
+
+    yield db, {"floorplan_id": floorplan_id, "point_id": points[0], "building_id": building_id}
+
+    db.close()
+    trans.rollback()
+    conn.close()
+
+
+def _read_endpoints():
+    for route in main.app.routes:
+        if "GET" in getattr(route, "methods", ()) and route.path not in SKIP_PATHS:
+            for query in [""] + VARIANTS.get(route.path, []):
+                yield route.path, query
+
+
+def _seq_scans(plan, sizes):
+    """(relation, rows) of every sequential scan in a JSON plan of a relation larger than SEQ_SCAN_MAX_ROWS."""
+    found = []
+    if plan.get("Node Type") == "Seq Scan" and sizes.get(plan["Relation Name"], 0) > SEQ_SCAN_MAX_ROWS:
+        found.append((plan["Relation Name"], sizes[plan["Relation Name"]]))
+    for child in plan.get("Plans", []):
+        found.extend(_seq_scans(child, sizes))
+    return found
+
+
+@pytest.mark.parametrize("path,query", list(_read_endpoints()))
+def test_read_endpoint_uses_indexes(seeded, path, query):
+    db, ids = seeded
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if re.match(r"\s*(SELECT|WITH)\b", statement, re.IGNORECASE):
+            statements.append((statement, parameters))
+
+    main.app.dependency_overrides[get_db] = lambda: db
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        url = (path + (f"?{query}" if query else "")).format(**ids)
+        res = TestClient(main.app).get(url)
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+        main.app.dependency_overrides.clear()
+    assert res.status_code < 500, res.text
+
+    sizes = dict(db.execute(text(
+        "SELECT relname, reltuples::bigint FROM pg_class WHERE relkind IN ('r', 'p', 'm')"
+    )).all())
+    cursor = db.connection().connection.cursor()
+    for statement, parameters in statements:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        plan = cursor.fetchone()[0][0]["Plan"]
+        assert not _seq_scans(plan, sizes), f"{url}: sequential scan in\n{statement}"
@@ -19,7 +19,7 @@ SELECT
     w.room_id,
     r.name AS room_name,
     b.name AS building_name
-FROM wifi_scan w
+FROM wifi_scan_v w
 LEFT JOIN room r ON w.room_id = r.id
 LEFT JOIN building b ON r.building_id = b.id
 ORDER BY w.id DESC
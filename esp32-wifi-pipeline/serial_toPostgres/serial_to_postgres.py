@@ -1,119 +1,254 @@
 #serial_to_postgres.py
 """
-Reads Wi-Fi scan JSON data from the ESP32 over serial
-and inserts each record into a PostgreSQL database.
-
-
+Serial bridge: reads ESP32 readings over USB serial and stores them in the
+same PostgreSQL database, tables and scan points as the FastAPI /ingest.
+
+Accepted lines (one JSON object per line, anything else is ignored):
+  {"node": "...", "scans": [...], "temperature": {...}, "air_quality": {...}}   same as /ingest
+  {"node": "...", "ssid": "...", "bssid": "...", "rssi": -65, ...}            one scan per line
+
+Pipeline:
+  reader thread   serial port → parsed lines → bounded queue   (reconnects the port;
+                  when the queue is full, lines go straight to the spool)
+  main thread     queue → node→scan_point (assignments.py) → rows (ingest.py)
+  flusher thread  write-behind queue → one multi-row INSERT every N rows / T ms
+                  (ingest_queue.py); while Postgres is down the rows go to the
+                  on-disk spool and are replayed when it is back (ingest_spool.py)
+
+Nothing is printed per record — a one-line status every few seconds instead,
+so the bridge keeps up with the port at full baud rate.
+
+Usage:
+  pip install pyserial -r ../FastAPI/requirements.txt
+  python serial_to_postgres.py --port /dev/cu.usbserial-130 --baud 115200
+  (DATABASE_URL and the other settings are read from the environment / .env,
+   exactly like the API.)
 """
 
+import argparse
 import json
-import serial
-import psycopg2
+import logging
+import os
+import queue
+import sys
+import threading
+import time
 from datetime import datetime, timezone
 
-# Serial and Database setup 
-PORT = "/dev/cu.usbserial-130"   
-BAUD = 115200                     
-
-DB_CONFIG = {
-    "host": "localhost",
-    "dbname": "wifi_db",
-    "user": "wifiuser",
-    "password": "Password",       # Same password I used when creating the DB user
-}
-
-TABLE = "wifi_scan"  # use the singular table name
-
-
-# Connect to Postgres database
-try:
-    conn = psycopg2.connect(**DB_CONFIG)
-    conn.autocommit = True
-    cur = conn.cursor()
-    print("Connected to PostgreSQL.")
-except Exception as e:
-    print("Couldn’t connect to the database:", e)
-    exit()
-
-
-# Create table if it does not exist
-cur.execute(f"""
-CREATE TABLE IF NOT EXISTS {TABLE} (
-    id BIGSERIAL PRIMARY KEY,
-    received_at TIMESTAMPTZ NOT NULL DEFAULT now(),
-    node TEXT,
-    device_ts_ms BIGINT,
-    ssid TEXT,
-    bssid TEXT,
-    rssi INT,
-    channel INT,
-    enc TEXT
-);
-""")
-
-# Add a uniqueness rule to avoid duplicate entries
-cur.execute(f"""
-CREATE UNIQUE INDEX IF NOT EXISTS uniq_wifi_key
-ON {TABLE} (device_ts_ms, bssid);
-""")
-
-
-# Connect to the ESP32 serial port 
-try:
-    ser = serial.Serial(PORT, BAUD, timeout=2)
-    print(f"Reading from {PORT} at {BAUD} baud... (Ctrl+C to stop)\n")
-except Exception as e:
-    print("Serial connection error:", e)
-    cur.close()
-    conn.close()
-    exit()
-
-
-# Keep reading and saving data 
-try:
-    while True:
-        raw = ser.readline()
-        if not raw:
-            continue
+import serial
 
+FASTAPI_DIR    = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "FastAPI")
+MAX_LINE_BYTES = 64 * 1024
+
+log = logging.getLogger("serial_bridge")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="ESP32 serial → PostgreSQL bridge")
+    p.add_argument("--port", default=os.getenv("SERIAL_PORT", "/dev/cu.usbserial-130"))
+    p.add_argument("--baud", type=int, default=int(os.getenv("SERIAL_BAUD", "115200")))
+    p.add_argument("--flush-rows", type=int, default=int(os.getenv("INGEST_FLUSH_ROWS", "5000")),
+                   help="flush once this many rows are waiting")
+    p.add_argument("--flush-ms", type=int, default=int(os.getenv("INGEST_FLUSH_MS", "250")),
+                   help="flush at least this often")
+    p.add_argument("--queue-lines", type=int, default=int(os.getenv("SERIAL_QUEUE_LINES", "200000")),
+                   help="parsed lines buffered between the reader and the database")
+    p.add_argument("--spool-dir", default=os.getenv("SPOOL_DIR", "serial_spool"))
+    p.add_argument("--status-every", type=float, default=5.0, help="seconds between status lines")
+    return p.parse_args()
+
+
+class SerialReader(threading.Thread):
+    """Reads lines from the port as fast as they arrive; reopens the port if it goes away."""
+
+    def __init__(self, port: str, baud: int, out: "queue.Queue", spill=None):
+        super().__init__(name="serial-reader", daemon=True)
+        self.port, self.baud, self.out = port, baud, out
+        self.spill      = spill   # (received_at, data) → False if the node has no scan point
+        self.stopping   = threading.Event()
+        self.lines      = 0
+        self.bad_lines  = 0
+        self.spilled    = 0
+        self.unassigned = 0
+        self.reconnects = 0
+
+    def _put(self, item) -> None:
         try:
-            data = json.loads(raw.decode("utf-8", errors="replace").strip())
-        except json.JSONDecodeError:
-            continue  
-
-        print("", data) 
-
-        # Writing each scan into Postgres
+            self.out.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        # Database far behind — write the line to the spool rather than stall
+        # the port (the UART buffer would overflow instead).
+        if self.spill is not None:
+            try:
+                if self.spill(item):
+                    self.spilled += 1
+                else:
+                    self.unassigned += 1
+                return
+            except Exception as e:
+                log.warning("cannot spool overflow line (%s); waiting for the queue", e)
+        # Nowhere to put it: wait for room rather than lose an accepted line.
+        self.out.put(item)
+
+    def _handle(self, raw: bytes, received_at: datetime) -> None:
+        if not raw.strip():
+            return
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            self.bad_lines += 1   # boot banners, debug prints, torn lines
+            return
+        if not isinstance(data, dict) or not isinstance(data.get("node"), str):
+            self.bad_lines += 1
+            return
+        self.lines += 1
+        self._put((received_at, data))
+
+    def run(self) -> None:
+        backoff = 1.0
+        while not self.stopping.is_set():
+            try:
+                ser = serial.Serial(self.port, self.baud, timeout=1)
+            except serial.SerialException as e:
+                log.warning("cannot open %s (%s); retrying in %.0fs", self.port, e, backoff)
+                self.stopping.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            log.info("reading %s at %d baud", self.port, self.baud)
+            backoff = 1.0
+            pending = b""
+            try:
+                while not self.stopping.is_set():
+                    # Read whatever the driver has buffered in one call — pyserial's
+                    # readline() reads a byte at a time and falls behind at high baud.
+                    chunk = ser.read(ser.in_waiting or 1)
+                    if not chunk:
+                        continue
+                    received_at = datetime.now(timezone.utc)
+                    *complete, pending = (pending + chunk).split(b"\n")
+                    if len(pending) > MAX_LINE_BYTES:
+                        pending = b""   # no newline in sight — garbage on the line
+                    for raw in complete:
+                        self._handle(raw, received_at)
+            except serial.SerialException as e:
+                self.reconnects += 1
+                log.warning("serial port lost (%s); reconnecting", e)
+            finally:
+                ser.close()
+
+
+def main() -> None:
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    # The write path is the API's own — configure it before importing it.
+    os.environ["INGEST_FLUSH_ROWS"] = str(args.flush_rows)
+    os.environ["INGEST_FLUSH_MS"]   = str(args.flush_ms)
+    os.environ["SPOOL_DIR"]         = args.spool_dir
+    sys.path.insert(0, FASTAPI_DIR)
+    from sqlalchemy.exc import InterfaceError, OperationalError
+    from database import SessionLocal
+    from assignments import assignment_cache
+    from ingest import IngestBatch
+    from ingest_queue import ingest_queue
+    from ingest_spool import SpoolFull, ingest_spool
+
+    def lookup(node: str):
+        # Short-lived session: the map is normally served from memory, and a
+        # session held open across a database restart would fail on close.
+        db = SessionLocal()
         try:
-            cur.execute(f"""
-                INSERT INTO {TABLE}
-                (received_at, node, device_ts_ms, ssid, bssid, rssi, channel, enc)
-                VALUES (NOW(), %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (device_ts_ms, bssid) DO NOTHING
-                RETURNING id;
-            """, (
-                data.get("node"),
-                data.get("ts"),        # ESP32 key is 'ts'
-                data.get("ssid"),
-                data.get("bssid"),
-                data.get("rssi"),
-                data.get("channel"),
-                data.get("enc"),
-            ))
-
-            row = cur.fetchone()
-            if row:
-                print("Inserted row id:", row[0])
-            else:
-                print("Duplicate entry skipped")
-
-        except Exception as e:
-            print("Problem inserting data:", e)
-
-except KeyboardInterrupt:
-    print("\nStopped manually.")
-finally:
-    ser.close()
-    cur.close()
-    conn.close()
-    print("All connections closed.")
\ No newline at end of file
+            return assignment_cache.lookup(db, node)
+        finally:
+            try:
+                db.close()
+            except (OperationalError, InterfaceError):
+                pass
+
+    def to_batch(item):
+        """The rows of a parsed line, or None if its node has no scan point (lookup may raise)."""
+        received_at, data = item
+        node = data["node"]
+        scan_point_id = lookup(node)
+        if scan_point_id is None:
+            return None
+        payload = data if "scans" in data else {"scans": [data]}
+        batch = IngestBatch()
+        batch.add_payload(node, scan_point_id, received_at, payload)
+        return batch
+
+    def spill(item) -> bool:
+        # Reader thread, queue full: straight to the spool (SpoolFull and lookup errors propagate).
+        batch = to_batch(item)
+        if batch is None:
+            return False
+        if batch:
+            ingest_spool.append(batch, wait=False)
+        return True
+
+    lines  = queue.Queue(maxsize=args.queue_lines)
+    reader = SerialReader(args.port, args.baud, lines, spill)
+    ingest_spool.start()
+    ingest_queue.start()
+    reader.start()
+
+    stored = unassigned = 0
+    last_status = time.monotonic()
+    last_stored = 0
+    held = None   # a line that could not be handed on yet — retried before the next one
+
+    try:
+        while True:
+            now = time.monotonic()
+            if now - last_status >= args.status_every:
+                q, s = ingest_queue.stats(), ingest_spool.stats()
+                log.info(
+                    "lines=%d rows/s=%.0f queued=%d written=%d spooled=%d pending_spool=%d "
+                    "unassigned=%d bad=%d spilled=%d",
+                    reader.lines, (stored - last_stored) / (now - last_status), lines.qsize() + q["depth_rows"],
+                    q["rows_written"], q["rows_spooled"], s["pending_records"],
+                    unassigned + reader.unassigned, reader.bad_lines, reader.spilled,
+                )
+                last_status, last_stored = now, stored
+
+            item = held
+            held = None
+            if item is None:
+                try:
+                    item = lines.get(timeout=0.5)
+                except queue.Empty:
+                    pass
+
+            if item is not None:
+                try:
+                    batch = to_batch(item)
+                except (OperationalError, InterfaceError):
+                    # No assignment map yet and Postgres is down — wait for it.
+                    held = item
+                    time.sleep(1.0)
+                    continue
+                if batch is None:
+                    unassigned += 1
+                else:
+                    if batch and not ingest_queue.offer(batch):
+                        try:
+                            ingest_spool.append(batch, wait=False)
+                        except SpoolFull:
+                            held = item
+                            time.sleep(ingest_queue.retry_after_s())
+                            continue
+                    stored += len(batch)
+    except KeyboardInterrupt:
+        print("\nStopped manually.")
+    finally:
+        reader.stopping.set()
+        reader.join(3)
+        ingest_queue.stop()   # flush what is still queued
+        ingest_spool.stop()
+        print("All connections closed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,317 @@
-# Step 5: Serial → JSON → SQLite
+# Step 5: Serial → JSON → SQLite (edge logger) and SQLite → FastAPI (sync)
+#
+# For survey laptops with no network: log everything the ESP32 prints over
+# USB into a local SQLite file, then upload it later.
+#
+#   python serial_to_sqliteCopy.py log  --port /dev/cu.usbserial-130
+#   python serial_to_sqliteCopy.py sync --url http://3.230.116.138:8000
+#
+# log   Reads the port, keeps the lines that are JSON readings, and writes them
+#       in batched transactions (every --commit-rows rows or --commit-ms ms) to
+#       wifi_scan / dht22_reading / mq135_reading tables shaped like the
+#       server's.  The database runs in WAL mode with synchronous=NORMAL, so a
+#       commit is one sequential WAL append rather than several fsyncs.
+#
+# sync  Streams the rows not uploaded yet to POST /ingest/backfill, one
+#       gzip-compressed upload per node of up to --batch-rows rows per table,
+#       stamped with the time each line was logged.  Each upload's range and
+#       batch_id are saved before it is sent, so an upload interrupted halfway
+#       is re-sent identically and the server stores it once.  The scan point
+#       is resolved by the server from the node at upload time.
+#
+# Accepted lines: a full /ingest payload {"node", "scans", "temperature",
+# "air_quality"} or a single scan {"node", "ssid", "bssid", "rssi", ...}.
+
+import argparse
+import gzip
 import json
-from datetime import datetime
-import serial # pyright: ignore[reportMissingModuleSource]
+import socket
 import sqlite3
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
 
-PORT = "/dev/cu.usbserial-130"       # ← change to your port, e.g. /dev/cu.SLAB_USBtoUART
-BAUD = 115200
 DB_PATH = "wifi_scans.db"
-TABLE = "wifi_scan"
-
-ser = serial.Serial(PORT, BAUD, timeout=2)
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cur = conn.cursor()
-
-print(f"Reading {PORT} @ {BAUD}. Ctrl+C to stop.")
-try:
-    while True:
-        raw = ser.readline()
-        if not raw:
-            continue
-        line = raw.decode("utf-8", errors="replace").strip()
-        if not line:
-            continue
-        try:
-            obj = json.loads(line)
-        except json.JSONDecodeError:
-            # ignore any non-JSON banner lines
-            continue
-
-        cur.execute(f"""
-            INSERT INTO {TABLE} (received_at, node, device_ts_ms, ssid, bssid, rssi, channel, enc)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            datetime.utcnow().isoformat(timespec="seconds"),
-            obj.get("node"),
-            obj.get("ts"),
-            obj.get("ssid"),
-            obj.get("bssid"),
-            obj.get("rssi"),
-            obj.get("channel"),
-            obj.get("enc"),
-        ))
-        conn.commit()
-except KeyboardInterrupt:
-    print("\nStopping.")
-finally:
-    try: ser.close()
-    except: pass
-    conn.close()
\ No newline at end of file
+PORT    = "/dev/cu.usbserial-130"       # ← change to your port, e.g. /dev/cu.SLAB_USBtoUART
+BAUD    = 115200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS wifi_scan (
+  id          INTEGER PRIMARY KEY AUTOINCREMENT,
+  received_at TEXT NOT NULL,
+  node        TEXT NOT NULL,
+  ssid        TEXT,
+  bssid       TEXT,
+  rssi        INTEGER,
+  channel     INTEGER,
+  enc         TEXT
+);
+CREATE TABLE IF NOT EXISTS dht22_reading (
+  id            INTEGER PRIMARY KEY AUTOINCREMENT,
+  received_at   TEXT NOT NULL,
+  node          TEXT NOT NULL,
+  temperature_c REAL,
+  humidity_pct  REAL
+);
+CREATE TABLE IF NOT EXISTS mq135_reading (
+  id          INTEGER PRIMARY KEY AUTOINCREMENT,
+  received_at TEXT NOT NULL,
+  node        TEXT NOT NULL,
+  ppm         REAL,
+  raw_value   INTEGER
+);
+CREATE INDEX IF NOT EXISTS ix_wifi_scan_node_id     ON wifi_scan (node, id);
+CREATE INDEX IF NOT EXISTS ix_dht22_reading_node_id ON dht22_reading (node, id);
+CREATE INDEX IF NOT EXISTS ix_mq135_reading_node_id ON mq135_reading (node, id);
+
+-- sync watermark: rows of this node with id <= last_id are on the server
+CREATE TABLE IF NOT EXISTS sync_state (
+  node     TEXT NOT NULL,
+  tbl      TEXT NOT NULL,
+  last_id  INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (node, tbl)
+);
+-- upload in flight: re-sent unchanged (same rows, same batch_id) until it succeeds
+CREATE TABLE IF NOT EXISTS sync_pending (
+  node      TEXT PRIMARY KEY,
+  batch_id  TEXT NOT NULL,
+  wifi_to   INTEGER NOT NULL,
+  dht22_to  INTEGER NOT NULL,
+  mq135_to  INTEGER NOT NULL
+);
+"""
+
+TABLES = {
+    "wifi":  ("wifi_scan",     ("ssid", "bssid", "rssi", "channel", "enc")),
+    "dht22": ("dht22_reading", ("temperature_c", "humidity_pct")),
+    "mq135": ("mq135_reading", ("ppm", "raw_value")),
+}
+
+
+def init_db(path: str = DB_PATH) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")      # readers (sync) never block the logger
+    conn.execute("PRAGMA synchronous=NORMAL")    # fsync at checkpoints, not every commit
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-16000")     # 16 MB page cache
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.executescript(SCHEMA)
+    conn.commit()
+    return conn
+
+
+# ── log ──────────────────────────────────────────────────────────────────────
+
+def rows_from_line(obj: dict, received_at: str):
+    """(wifi rows, dht22 rows, mq135 rows) for one parsed line."""
+    node  = obj["node"]
+    scans = obj.get("scans") if "scans" in obj else [obj]
+    wifi  = [
+        (received_at, node, s.get("ssid"), s.get("bssid"), s.get("rssi"), s.get("channel"),
+         None if s.get("enc") is None else str(s.get("enc")))
+        for s in (scans if isinstance(scans, list) else []) if isinstance(s, dict)
+    ]
+    dht, mq = [], []
+    temp = obj.get("temperature")
+    if isinstance(temp, dict) and temp.get("temperature_c") is not None:
+        dht.append((received_at, node, temp.get("temperature_c"), temp.get("humidity_pct")))
+    air = obj.get("air_quality")
+    if isinstance(air, dict) and air.get("ppm") is not None:
+        mq.append((received_at, node, air.get("ppm"), air.get("raw_value")))
+    return wifi, dht, mq
+
+
+def log_serial(args) -> None:
+    import serial # pyright: ignore[reportMissingModuleSource]
+
+    conn = init_db(args.db)
+    inserts = {
+        key: f"INSERT INTO {table} (received_at, node, {', '.join(cols)}) "
+             f"VALUES ({', '.join('?' * (len(cols) + 2))})"
+        for key, (table, cols) in TABLES.items()
+    }
+    pending = {key: [] for key in TABLES}
+    n_pending, last_commit, total, bad = 0, time.monotonic(), 0, 0
+
+    def commit():
+        nonlocal n_pending, last_commit, total
+        if n_pending:
+            with conn:   # one transaction for the whole batch
+                for key, rows in pending.items():
+                    if rows:
+                        conn.executemany(inserts[key], rows)
+                        rows.clear()
+            total += n_pending
+        n_pending, last_commit = 0, time.monotonic()
+
+    ser = serial.Serial(args.port, args.baud, timeout=0.1)
+    print(f"Reading {args.port} @ {args.baud} into {args.db}. Ctrl+C to stop.")
+    buf = b""
+    last_status = time.monotonic()
+    try:
+        while True:
+            chunk = ser.read(ser.in_waiting or 1)
+            if chunk:
+                received_at = datetime.now(timezone.utc).isoformat()
+                *complete, buf = (buf + chunk).split(b"\n")
+                for raw in complete:
+                    try:
+                        obj = json.loads(raw)
+                    except ValueError:
+                        bad += bool(raw.strip())   # ignore any non-JSON banner lines
+                        continue
+                    if not isinstance(obj, dict) or not isinstance(obj.get("node"), str):
+                        bad += 1
+                        continue
+                    for key, rows in zip(TABLES, rows_from_line(obj, received_at)):
+                        pending[key].extend(rows)
+                        n_pending += len(rows)
+
+            now = time.monotonic()
+            if n_pending >= args.commit_rows or (n_pending and (now - last_commit) * 1000 >= args.commit_ms):
+                commit()
+            if now - last_status >= 10:
+                print(f"{total} rows logged, {bad} non-JSON lines")
+                last_status = now
+    except KeyboardInterrupt:
+        print("\nStopping.")
+    finally:
+        commit()
+        try: ser.close()
+        except: pass
+        conn.close()
+
+
+# ── sync ─────────────────────────────────────────────────────────────────────
+
+def _watermarks(conn, node):
+    marks = dict(conn.execute("SELECT tbl, last_id FROM sync_state WHERE node = ?", (node,)).fetchall())
+    return {key: marks.get(key, 0) for key in TABLES}
+
+
+def _plan_upload(conn, node, batch_rows):
+    """Upper id per table of the next upload for this node — saved before sending."""
+    pending = conn.execute(
+        "SELECT batch_id, wifi_to, dht22_to, mq135_to FROM sync_pending WHERE node = ?", (node,)
+    ).fetchone()
+    if pending:
+        return pending[0], dict(zip(TABLES, pending[1:]))
+
+    marks, upper = _watermarks(conn, node), {}
+    for key, (table, _) in TABLES.items():
+        row = conn.execute(
+            f"SELECT max(id) FROM (SELECT id FROM {table} WHERE node = ? AND id > ? ORDER BY id LIMIT ?)",
+            (node, marks[key], batch_rows),
+        ).fetchone()
+        upper[key] = row[0] or marks[key]
+    if upper == marks:
+        return None, None
+    batch_id = f"edge-{socket.gethostname()}-" + "-".join(f"{marks[k]}.{upper[k]}" for k in TABLES)
+    with conn:
+        conn.execute(
+            "INSERT INTO sync_pending (node, batch_id, wifi_to, dht22_to, mq135_to) VALUES (?, ?, ?, ?, ?)",
+            (node, batch_id[-128:], upper["wifi"], upper["dht22"], upper["mq135"]),
+        )
+    return batch_id[-128:], upper
+
+
+def _build_records(conn, node, marks, upper):
+    """
+    Backfill records for the planned id ranges: scans logged at the same
+    moment share one record; each sensor reading is a record of its own.
+    """
+    scans   = defaultdict(list)
+    records = []
+    for key, (table, cols) in TABLES.items():
+        for row in conn.execute(
+            f"SELECT received_at, {', '.join(cols)} FROM {table} WHERE node = ? AND id > ? AND id <= ? ORDER BY id",
+            (node, marks[key], upper[key]),
+        ):
+            values = dict(zip(cols, row[1:]))
+            if key == "wifi":
+                scans[row[0]].append(values)
+            elif key == "dht22":
+                records.append({"ts": row[0], "temperature": values})
+            else:
+                records.append({"ts": row[0], "air_quality": values})
+    return [{"ts": ts, "scans": s} for ts, s in scans.items()] + records
+
+
+def sync_to_server(args) -> None:
+    import requests
+
+    conn = init_db(args.db)
+    url  = args.url.rstrip("/") + "/ingest/backfill"
+    nodes = [r[0] for r in conn.execute(
+        "SELECT node FROM wifi_scan UNION SELECT node FROM dht22_reading UNION SELECT node FROM mq135_reading"
+    )]
+    uploaded = failed = 0
+    for node in nodes:
+        while True:
+            batch_id, upper = _plan_upload(conn, node, args.batch_rows)
+            if batch_id is None:
+                break
+            marks   = _watermarks(conn, node)
+            records = _build_records(conn, node, marks, upper)
+            body    = gzip.compress(json.dumps({"node": node, "batch_id": batch_id, "records": records}).encode())
+            started = time.monotonic()
+            try:
+                res = requests.post(url, data=body, timeout=args.timeout, headers={
+                    "Content-Type": "application/json", "Content-Encoding": "gzip",
+                })
+            except requests.RequestException as e:
+                print(f"{node}: upload failed ({e}) — will resend on the next sync")
+                failed += 1
+                break
+            if res.status_code not in (200, 202):
+                print(f"{node}: server answered {res.status_code} {res.text[:200]} — will resend on the next sync")
+                failed += 1
+                break
+
+            result = res.json()
+            with conn:
+                for key in TABLES:
+                    conn.execute(
+                        "INSERT INTO sync_state (node, tbl, last_id) VALUES (?, ?, ?) "
+                        "ON CONFLICT (node, tbl) DO UPDATE SET last_id = excluded.last_id",
+                        (node, key, upper[key]),
+                    )
+                conn.execute("DELETE FROM sync_pending WHERE node = ?", (node,))
+            uploaded += 1
+            print(f"{node}: {len(records)} records, {result.get('rows', 0)} rows {result.get('status')} "
+                  f"({len(body) / 1024:.0f} KiB gzip, {time.monotonic() - started:.1f}s)"
+                  + (f", {len(result['rejected_records'])} records rejected" if result.get("rejected_records") else ""))
+    conn.close()
+    print(f"Sync finished: {uploaded} uploads, {failed} nodes to retry.")
+    if failed:
+        sys.exit(1)
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="ESP32 serial → SQLite edge logger, and SQLite → FastAPI sync")
+    p.add_argument("--db", default=DB_PATH)
+    sub = p.add_subparsers(dest="command")
+
+    log = sub.add_parser("log", help="log the serial port into SQLite (default)")
+    log.add_argument("--port", default=PORT)
+    log.add_argument("--baud", type=int, default=BAUD)
+    log.add_argument("--commit-rows", type=int, default=1000, help="commit after this many rows")
+    log.add_argument("--commit-ms", type=int, default=1000, help="commit at least this often")
+
+    sync = sub.add_parser("sync", help="upload rows not yet on the server")
+    sync.add_argument("--url", default="http://localhost:8000", help="FastAPI base URL")
+    sync.add_argument("--batch-rows", type=int, default=3000, help="rows per table per upload")
+    sync.add_argument("--timeout", type=float, default=60.0)
+
+    args = p.parse_args()
+    if args.command == "sync":
+        sync_to_server(args)
+    else:
+        if args.command is None:
+            args = p.parse_args(sys.argv[1:] + ["log"])
+        log_serial(args)
+
+
+if __name__ == "__main__":
+    main()
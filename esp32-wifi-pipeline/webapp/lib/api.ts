@@ -38,7 +38,7 @@ export type ScanPoint = {
   y: number;                   // 0.0 – 1.0
   label: string | null;        // e.g. "Near window", "Lab bench 3"
   created_at: string;
-  scan_count: number;          // how many wifi_scans are tagged to this point
+  scan_count?: number;         // wifi_scans recorded at this point — only with { counts: true }
   assigned_node: string | null; // which ESP32 is currently here (if any)
   is_active: boolean;
 };
@@ -197,8 +197,12 @@ export async function deleteRoom(id: number): Promise<void> {
 
 // ── Scan Points ────────────────────────────────────────────────────────────────
 
-export async function fetchScanPoints(floorplanId: number): Promise<ScanPoint[]> {
-  const res = await fetch(`${API_BASE}/floorplans/${floorplanId}/scan-points`, { cache: "no-store" });
+export async function fetchScanPoints(
+  floorplanId: number,
+  opts: { counts?: boolean } = {}
+): Promise<ScanPoint[]> {
+  const query = opts.counts ? "?include=counts" : "";
+  const res = await fetch(`${API_BASE}/floorplans/${floorplanId}/scan-points${query}`, { cache: "no-store" });
   const data = await handleJson<{ scan_points: ScanPoint[] }>(res);
   return data.scan_points ?? [];
 }
@@ -321,13 +325,43 @@ export async function deleteFloorPlan(id: number): Promise<void> {
 
 
 // ── Heatmap ────────────────────────────────────────────────────────────────────
+// Heatmap and alert fetches use cache: "no-cache" — the browser keeps the last
+// body and revalidates it with its ETag, so an unchanged floor costs a 304.
 
 export async function fetchFloorplanHeatmap(floorplanId: number): Promise<HeatmapPoint[]> {
   // Note: no session_id needed — queries scan_point directly
-  const res = await fetch(`${API_BASE}/heatmap/floorplan/${floorplanId}`, { cache: "no-store" });
+  const res = await fetch(`${API_BASE}/heatmap/floorplan/${floorplanId}`, { cache: "no-cache" });
   return handleJson(res);
 }
 
+// Every heatmap layer of a floor plan in one request — only the layers asked
+// for are present on each point.
+export type HeatmapLayer = "wifi" | "temperature" | "humidity" | "air";
+
+export type CombinedHeatmapPoint = {
+  scan_point_id: number;
+  label:         string;
+  x:             number | null;
+  y:             number | null;
+  assigned_node: string | null;
+  wifi?:        { avg_rssi: number | null; level: SignalLevel; samples: number; last_scan_at: string | null };
+  temperature?: { temperature_c: number | null; temp_level: "cool" | "warm" | "hot" | null; received_at: string | null };
+  humidity?:    { humidity_pct: number | null; humidity_level: "low" | "medium" | "high" | null; received_at: string | null };
+  air?:         { ppm: number | null; raw_value: number | null; air_level: "good" | "moderate" | "poor" | null; received_at: string | null };
+};
+
+export async function fetchCombinedHeatmap(
+  floorplanId: number,
+  layers: HeatmapLayer[] = ["wifi", "temperature", "humidity", "air"]
+): Promise<CombinedHeatmapPoint[]> {
+  const res = await fetch(
+    `${API_BASE}/heatmap/floorplan/${floorplanId}/combined?layers=${layers.join(",")}`,
+    { cache: "no-cache" }
+  );
+  const data = await handleJson<{ points: CombinedHeatmapPoint[] }>(res);
+  return data.points ?? [];
+}
+
 
 // ── Floor Plan — Replace Image ─────────────────────────────────────────────────
 // Replaces the image file for an existing floor plan.
@@ -392,7 +426,9 @@ export type WifiHistoryBucket = {
 export type WifiHistoryResponse = {
   scan_point_id: number;
   label: string | null;
-  range: TimeRange;
+  range: TimeRange | "custom";
+  from?: string;           // custom windows only: first bucket start (ISO UTC)
+  to?: string;             // custom windows only: end of the last bucket
   bucket_minutes: number;
   n_buckets: number;
   total_scans: number;
@@ -411,30 +447,73 @@ export async function fetchWifiHistory(
   return data.buckets ?? [];
 }
 
+// Any window: from / to (to defaults to now on the server), bucket size in
+// minutes — omitted, the server picks one giving at most ~100 buckets.
+export async function fetchWifiHistoryWindow(
+  scanPointId: number,
+  from: Date,
+  to?: Date,
+  bucketMinutes?: number
+): Promise<WifiHistoryResponse> {
+  const params = new URLSearchParams({ from: from.toISOString() });
+  if (to) params.set("to", to.toISOString());
+  if (bucketMinutes) params.set("bucket", String(bucketMinutes));
+  const res = await fetch(
+    `${API_BASE}/scan-points/${scanPointId}/wifi-history?${params}`,
+    { cache: "no-store" }
+  );
+  return handleJson<WifiHistoryResponse>(res);
+}
+
 // ─── Temperature / Humidity ───────────────────────────────────────────────────
 
+// History readings are per-bucket averages (bucket_minutes wide); the raw
+// views (tempHumidityHistory) return single readings without the extra fields.
 export type Dht22Reading = {
-  received_at:   string;   // ISO UTC timestamp
+  received_at:   string;   // ISO UTC timestamp (bucket start for history)
   temperature_c: number;   // degrees Celsius
   humidity_pct:  number;   // relative humidity %
+  temperature_min?: number;
+  temperature_max?: number;
+  humidity_min?:    number;
+  humidity_max?:    number;
+  samples?:         number;   // readings averaged into this one
 };
 
+// max_points caps the readings returned: "envelope" widens the buckets
+// (min/avg/max each), "lttb" keeps the 1-minute averages that preserve the
+// curve's shape.
+export type HistoryDownsample = {
+  maxPoints?:  number;
+  method?:     "envelope" | "lttb";
+};
+
+function historyQuery(time_range: string, opts: HistoryDownsample): string {
+  const params = new URLSearchParams({ time_range });
+  if (opts.maxPoints) params.set("max_points", String(opts.maxPoints));
+  if (opts.method) params.set("downsample", opts.method);
+  return params.toString();
+}
+
 export type TemperatureHistoryResponse = {
   scan_point_id: number;
   time_range:    string;
+  bucket_minutes: number;
+  downsample:    "envelope" | "lttb" | null;
   count:         number;
   readings:      Dht22Reading[];
 };
 
 export async function fetchDht22History(
   scanPointId: number,
-  time_range: string = "24h"
+  time_range: string = "24h",
+  opts: HistoryDownsample = {}
 ): Promise<Dht22Reading[]> {
   // Uses FastAPI directly (not the Next.js /api proxy) — same pattern as
   // the inline fetches in UserHeatmapViewer which are confirmed working.
   const base = process.env.NEXT_PUBLIC_API_URL ?? "http://localhost:8000";
   const res = await fetch(
-    `${base}/scan-points/${scanPointId}/dht22-history?time_range=${time_range}`,
+    `${base}/scan-points/${scanPointId}/dht22-history?${historyQuery(time_range, opts)}`,
     { cache: "no-store" }
   );
   const data = await handleJson<TemperatureHistoryResponse>(res);
@@ -463,7 +542,7 @@ export async function fetchDht22Heatmap(floorplanId: number): Promise<Dht22Heatm
   const base = process.env.NEXT_PUBLIC_API_URL ?? "http://localhost:8000";
   const res = await fetch(
     `${base}/heatmap/floorplan/${floorplanId}/dht22`,
-    { cache: "no-store" }
+    { cache: "no-cache" }
   );
   return handleJson<Dht22HeatmapPoint[]>(res);
 }
@@ -475,11 +554,16 @@ export type Mq135Reading = {
   received_at: string;   // ISO UTC timestamp
   ppm:         number;   // raw ADC value used as air quality indicator
   raw_value:   number;   // same as ppm — stored separately for future calibration
+  ppm_min?:    number;
+  ppm_max?:    number;
+  samples?:    number;   // readings averaged into this one (history)
 };
 
 export type Mq135HistoryResponse = {
   scan_point_id: number;
   time_range:    string;
+  bucket_minutes: number;
+  downsample:    "envelope" | "lttb" | null;
   count:         number;
   readings:      Mq135Reading[];
 };
@@ -498,11 +582,12 @@ export type Mq135HeatmapPoint = {
 
 export async function fetchMq135History(
   scanPointId: number,
-  time_range: string = "24h"
+  time_range: string = "24h",
+  opts: HistoryDownsample = {}
 ): Promise<Mq135Reading[]> {
   const base = process.env.NEXT_PUBLIC_API_URL ?? "http://localhost:8000";
   const res = await fetch(
-    `${base}/scan-points/${scanPointId}/mq135-history?time_range=${time_range}`,
+    `${base}/scan-points/${scanPointId}/mq135-history?${historyQuery(time_range, opts)}`,
     { cache: "no-store" }
   );
   const data = await handleJson<Mq135HistoryResponse>(res);
@@ -513,11 +598,23 @@ export async function fetchMq135Heatmap(floorplanId: number): Promise<Mq135Heatm
   const base = process.env.NEXT_PUBLIC_API_URL ?? "http://localhost:8000";
   const res = await fetch(
     `${base}/heatmap/floorplan/${floorplanId}/mq135`,
-    { cache: "no-store" }
+    { cache: "no-cache" }
   );
   return handleJson<Mq135HeatmapPoint[]>(res);
 }
 
+// Several floor plans (e.g. a whole building) in one request; each point
+// carries its floorplan_id.
+export async function fetchMq135HeatmapMany(
+  floorplanIds: number[]
+): Promise<(Mq135HeatmapPoint & { floorplan_id: number })[]> {
+  const base = process.env.NEXT_PUBLIC_API_URL ?? "http://localhost:8000";
+  const params = new URLSearchParams();
+  floorplanIds.forEach((id) => params.append("floorplan_id", String(id)));
+  const res = await fetch(`${base}/heatmap/mq135?${params}`, { cache: "no-cache" });
+  return handleJson<(Mq135HeatmapPoint & { floorplan_id: number })[]>(res);
+}
+
 
 // ─── Alerts ───────────────────────────────────────────────────────────────────
 
@@ -536,7 +633,7 @@ export type Alert = {
 
 export async function fetchAlerts(): Promise<Alert[]> {
   const base = process.env.NEXT_PUBLIC_API_URL ?? "http://localhost:8000";
-  const res  = await fetch(`${base}/alerts`, { cache: "no-store" });
+  const res  = await fetch(`${base}/alerts`, { cache: "no-cache" });
   const data = await handleJson<{ alerts: Alert[] }>(res);
   return data.alerts ?? [];
 }
\ No newline at end of file
@@ -6,7 +6,10 @@ export async function fetchFloorplanHeatmap(
 ): Promise<HeatmapPoint[]> {
   const res = await fetch(
     `${API_BASE}/heatmap/floorplan/${floorplanId}`,
-    { cache: "no-store" }
+    { cache: "no-cache" }
   );
   return handleJson(res);
 }
+
+export { fetchCombinedHeatmap } from "../api";
+export type { CombinedHeatmapPoint, HeatmapLayer } from "../api";
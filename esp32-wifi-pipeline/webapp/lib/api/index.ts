@@ -51,7 +51,8 @@ export {
   deleteFloorPlan,
 } from "./floorplans";
 
-export { fetchFloorplanHeatmap } from "./heatmap";
+export { fetchFloorplanHeatmap, fetchCombinedHeatmap } from "./heatmap";
+export type { CombinedHeatmapPoint, HeatmapLayer } from "./heatmap";
 
 export {
   fetchWifiHistory,
@@ -63,5 +64,5 @@ export type { TimeRange, Dht22Reading } from "./dht22";
 export { fetchDht22Heatmap } from "./dht22";
 export type { Dht22HeatmapPoint } from "./dht22";
 
-export { fetchMq135History, fetchMq135Heatmap } from "./mq135";
+export { fetchMq135History, fetchMq135Heatmap, fetchMq135HeatmapMany } from "./mq135";
 export type { Mq135Reading, Mq135HeatmapPoint } from "./mq135";
\ No newline at end of file
@@ -4,6 +4,6 @@
 // Uses FastAPI directly (not the Next.js /api proxy) to avoid
 // Turbopack route resolution issues seen with dht22-history.
  
-export { fetchMq135History, fetchMq135Heatmap } from "../api";
+export { fetchMq135History, fetchMq135Heatmap, fetchMq135HeatmapMany } from "../api";
 export type { Mq135Reading, Mq135HeatmapPoint } from "../api";
  
\ No newline at end of file
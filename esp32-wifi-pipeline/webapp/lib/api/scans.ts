@@ -18,9 +18,13 @@ export async function fetchRecentScans(limit = 25): Promise<WifiScan[]> {
 // The admin clicks the map → a pin is created here.
 // All sensor data from an assigned device is tagged with scan_point_id.
 
-export async function fetchScanPoints(floorplanId: number): Promise<ScanPoint[]> {
+export async function fetchScanPoints(
+  floorplanId: number,
+  opts: { counts?: boolean } = {}
+): Promise<ScanPoint[]> {
+  const query = opts.counts ? "?include=counts" : "";
   const res = await fetch(
-    `${API_BASE}/floorplans/${floorplanId}/scan-points`,
+    `${API_BASE}/floorplans/${floorplanId}/scan-points${query}`,
     { cache: "no-store" }
   );
   const data = await handleJson<ScanPointsResponse>(res);
@@ -54,7 +54,7 @@ export type ScanPoint = {
   assigned_node: string | null; // ESP32 node id currently here
   assigned_at: string | null;   // when device was last assigned
   is_active: boolean;           // true if assigned_node is set
-  scan_count: number;           // how many wifi_scan rows tagged to this point
+  scan_count?: number;          // wifi_scan rows recorded at this point — only with { counts: true }
   created_at: string;
 };
 
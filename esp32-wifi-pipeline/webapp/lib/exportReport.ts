@@ -8,8 +8,8 @@
  *                      dynamically imported so it never runs on the server).
  */
 
-import type { ScanPoint, HeatmapPoint, Dht22HeatmapPoint, Mq135HeatmapPoint } from "@/lib/api";
-import { fetchFloorplanHeatmap, fetchDht22Heatmap, fetchMq135Heatmap } from "@/lib/api";
+import type { ScanPoint, CombinedHeatmapPoint } from "@/lib/api";
+import { fetchCombinedHeatmap } from "@/lib/api";
 
 // ── Types ──────────────────────────────────────────────────────────────────────
 
@@ -30,16 +30,16 @@ export async function collectExportData(
   floorplanId: number,
   scanPoints:  ScanPoint[],
 ): Promise<ExportRow[]> {
-  const [heatmap, dht22, mq135] = await Promise.all([
-    fetchFloorplanHeatmap(floorplanId).catch(() => [] as HeatmapPoint[]),
-    fetchDht22Heatmap(floorplanId).catch(() => []    as Dht22HeatmapPoint[]),
-    fetchMq135Heatmap(floorplanId).catch(() => []    as Mq135HeatmapPoint[]),
-  ]);
+  // One request for every layer (wifi, temperature, humidity, air)
+  const combined = await fetchCombinedHeatmap(floorplanId).catch(() => [] as CombinedHeatmapPoint[]);
+  const byPoint  = new Map(combined.map(c => [c.scan_point_id, c]));
 
   return scanPoints.map((pt, i) => {
-    const h = heatmap.find(h => h.room_id === pt.id);
-    const d = dht22.find(d  => d.scan_point_id === pt.id);
-    const m = mq135.find(m  => m.scan_point_id === pt.id);
+    const c = byPoint.get(pt.id);
+    const h = c?.wifi;
+    const t = c?.temperature;
+    const u = c?.humidity;
+    const m = c?.air;
 
     return {
       index:        i + 1,
@@ -47,8 +47,8 @@ export async function collectExportData(
       assignedNode: pt.assigned_node ?? "—",
       signalLevel:  h?.level   ? capitalize(h.level)        : "—",
       avgRssi:      h?.avg_rssi != null ? `${h.avg_rssi.toFixed(1)} dBm` : "—",
-      tempC:        d?.temperature_c != null ? `${d.temperature_c.toFixed(1)} °C` : "—",
-      humidityPct:  d?.humidity_pct  != null ? `${d.humidity_pct.toFixed(1)} %`   : "—",
+      tempC:        t?.temperature_c != null ? `${t.temperature_c.toFixed(1)} °C` : "—",
+      humidityPct:  u?.humidity_pct  != null ? `${u.humidity_pct.toFixed(1)} %`   : "—",
       airQuality:   m?.air_level ? capitalize(m.air_level)  : "—",
     };
   });